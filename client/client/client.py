@@ -1,5 +1,6 @@
 """
-Module defines classes and functions to handle client connection.
+Module defines classes and functions to handle client connection, handlers are registered in RECV_HANDLERS and
+SEND_HANDLERS.
 
 Classes:
 DisconnectedError -- Exception raised when connection is closed.
@@ -8,13 +9,29 @@ Client -- Class storing information about client.
 Functions:
 recv_hello -- Called when chosen nickname is taken.
 recv_text -- Called when client received text message.
+recv_features -- Called when server agreed on features.
+recv_presence -- Called when users joined or left.
+recv_ping -- Called when server checks if connection works.
 send_hello -- Send message to check if nickname is available.
 send_text -- Send text message.
-send_active -- Ask server which users are active.
+send_active -- List active users known from presence messages or ask server about them.
+send_msg -- Send private message.
+send_join -- Join room.
+send_part -- Leave room.
+send_rooms -- Ask server which rooms exist.
+send_history -- Ask server for last messages.
 """
 import asyncio
+import random
 import sys
-from .message import cut_message, create_message
+from protocol.message import FrameParser, Registry, CHUNK_SIZE, ENCODERS, TEXT_FRAMING, BINARY_FRAMING, DEFLATE
+
+# Handlers of messages received from server and of commands typed by user, functions below register themselves.
+RECV_HANDLERS = Registry()
+SEND_HANDLERS = Registry()
+# Seconds of the first reconnection backoff, it doubles with every failed attempt up to MAX_BACKOFF.
+BACKOFF = 0.5
+MAX_BACKOFF = 30.0
 
 
 class DisconnectedError(Exception):
@@ -38,6 +55,15 @@ class Client:
     reader -- StreamReader returned after connection is opened.
     writer -- StreamWriter returned after connection is opened.
     con_handling -- Task handling connection.
+    features -- Features requested in hello message.
+    agreed_features -- Features server agreed on.
+    framing -- Framing of messages sent to server, deflate or binary if it was agreed on.
+    room -- Room text messages are sent to, None if they go to everyone.
+    roster -- Nicks of active users kept up to date by presence messages, None if server doesn't send them.
+    reconnect -- If true, client connects again when server closes connection.
+    attempt -- Number of reconnection attempts since server sent something.
+    token -- Token session is resumed with after reconnection, None if server didn't agree on resume.
+    seq -- The highest sequence number of received message, server resends messages after it on resume.
 
     Magic methods:
     __init__ -- Initialize instance.
@@ -48,11 +74,13 @@ class Client:
     stop_connection -- Close connection with server.
     send -- Send message to server.
     read_input -- Read input from infile and send it.
+    create_message -- Create message in framing agreed on with server.
 
     Static methods:
     check_type -- Check type of message read from user.
     """
-    def __init__(self, loop, recv_handlers, send_handlers, address, port, nick, infile=sys.stdin, outfile=sys.stdout):
+    def __init__(self, loop, recv_handlers, send_handlers, address, port, nick, infile=sys.stdin, outfile=sys.stdout,
+                 features=(), reconnect=False):
         """Initialize instance."""
         self.loop = loop
         self.recv_handlers = recv_handlers
@@ -65,6 +93,15 @@ class Client:
         self.reader = None
         self.writer = None
         self.con_handling = None
+        self.features = tuple(features)
+        self.agreed_features = frozenset()
+        self.framing = TEXT_FRAMING
+        self.room = None
+        self.roster = None
+        self.reconnect = reconnect
+        self.attempt = 0
+        self.token = None
+        self.seq = 0
 
     def start_connection(self):
         """
@@ -80,26 +117,57 @@ class Client:
         """
         Coroutine handling connection.
 
-        First check if user's nickname is available. Then if connection isn't closed data is read line by line until
-        line indicating end of message is read. Then message is interpreted and handled.
+        First check if user's nickname is available. Then if connection isn't closed data is read in large chunks and
+        fed to FrameParser, each message completed by the chunk is handled in order. When server closes connection
+        and reconnect is set, client connects again after randomized exponential backoff, so clients of restarted
+        server don't come back all at once. Client with token resumes its session, server then rejoins its room and
+        sends messages it missed, otherwise client rejoins its room itself.
         """
         try:
-            self.send_handlers[b'hello'](client=self)
-            while True:
-                msg_lines = []
-                while True:
-                    msg_line = await self.reader.readline()
-                    if not msg_line:
-                        raise DisconnectedError
-                    msg_lines.append(msg_line)
-                    if msg_line == b'#\n':
-                        break
-                message = cut_message(msg_lines)
-                self.recv_handlers[message[b'type']](message=message, client=self)
-        except (asyncio.CancelledError, DisconnectedError):
+            while await self._handle_session() and self.reconnect:
+                await self._reconnect()
+        except asyncio.CancelledError:
             pass
 
-        self.writer.close()
+    async def _handle_session(self):
+        """Handle one connection, return True if it was closed by server."""
+        parser = FrameParser()
+        received = False
+        try:
+            self.send_handlers[b'hello'](client=self)
+            if self.room is not None and self.token is None:
+                self.writer.write(self.create_message(type=b'join', room=self.room))
+            while True:
+                data = await self.reader.read(CHUNK_SIZE)
+                if not data:
+                    raise DisconnectedError
+                # Refused connection gets one text message and is closed, backoff is reset only when connection
+                # outlived its first data, or by features answer to hello.
+                if received:
+                    self.attempt = 0
+                received = True
+                for message in parser.feed(data):
+                    self.recv_handlers[message[b'type']](message=message, client=self)
+        except (DisconnectedError, ConnectionError):
+            return True
+        finally:
+            self.writer.close()
+
+    async def _reconnect(self):
+        """Open new connection after backoff, state agreed on with old server is forgotten."""
+        while True:
+            delay = random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2 ** self.attempt))
+            self.attempt += 1
+            print('Connection lost, reconnecting in {:.1f} s.'.format(delay), file=self.outfile)
+            await asyncio.sleep(delay)
+            try:
+                self.reader, self.writer = await asyncio.open_connection(self.address, self.port)
+            except OSError:
+                continue
+            self.agreed_features = frozenset()
+            self.framing = TEXT_FRAMING
+            self.roster = None
+            return
 
     def stop_connection(self):
         """Close connection with server."""
@@ -124,13 +192,18 @@ class Client:
         input_msg = self.infile.readline().encode()
         self.send(input_msg)
 
+    def create_message(self, **kwargs):
+        """Create message in framing agreed on with server, kwargs are the same as of message.create_message."""
+        return ENCODERS[self.framing](**kwargs)
+
     @staticmethod
     def check_type(message):
         """
         Check type of message read from user.
 
         Commands are in form of /command: arguments. If /command is omitted message is intepreted as text message.
-        Colon is only necessary when command takes arguments. Arguments are separated with whitespaces.
+        Colon is only necessary when command takes arguments. Arguments are separated with whitespaces. Words between
+        command and colon are part of arguments, for example /msg nick: text has arguments nick: text.
         """
         if message.startswith(b'/'):
             pos = message.find(b':')
@@ -138,11 +211,15 @@ class Client:
                 command, args = message[1:pos], message[pos + 1:]
             else:
                 command, args = message[1:], b''
-            return command.strip(), args
+            command = command.strip()
+            if b' ' in command:
+                command, args = message[1:].lstrip().split(None, 1)
+            return command, args
         else:
             return b'text', message
 
 
+@RECV_HANDLERS.register(b'hello')
 def recv_hello(client, **kwargs):
     """
     Called when chosen nickname is taken.
@@ -152,30 +229,155 @@ def recv_hello(client, **kwargs):
     client.con_handling.cancel()
 
 
+@RECV_HANDLERS.register(b'text')
 def recv_text(message, client, **kwargs):
     """
     Handler called when client receives text message.
 
-    Message is just displayed.
+    Message is just displayed, messages sent to room are prefixed with its name. Sequence number is remembered, so
+    messages missed while connection was lost can be resent.
     """
     text = message[b'text']
+    if b'seq' in message:
+        client.seq = max(client.seq, int(message[b'seq']))
+    if b'room' in message:
+        text = b'[' + message[b'room'] + b'] ' + text
     print(text.decode(), end='', file=client.outfile)
 
 
+@RECV_HANDLERS.register(b'features')
+def recv_features(message, client, **kwargs):
+    """
+    Called when server agreed on features.
+
+    Server answers with features message only if client requested some features, it lists those which will be used.
+    Server which agreed on resume sends token, if it isn't the one client resumed with server forgot the session, for
+    example because it was restarted, and client rejoins its room. Answer means hello succeeded, so backoff of
+    reconnection is reset.
+    """
+    client.attempt = 0
+    client.agreed_features = frozenset(message[b'features'].split())
+    if DEFLATE in client.agreed_features:
+        client.framing = DEFLATE
+    elif BINARY_FRAMING in client.agreed_features:
+        client.framing = BINARY_FRAMING
+    token = message.get(b'token')
+    if client.token is not None and token != client.token:
+        client.seq = 0
+        if client.room is not None:
+            client.writer.write(client.create_message(type=b'join', room=client.room))
+    client.token = token
+
+
+@RECV_HANDLERS.register(b'presence')
+def recv_presence(message, client, **kwargs):
+    """
+    Called when users joined or left.
+
+    The first presence message lists all active users, next ones list only changes, so active users are known without
+    asking server.
+    """
+    if client.roster is None:
+        client.roster = set()
+    client.roster.update(message.get(b'joined', b'').splitlines())
+    client.roster.difference_update(message.get(b'left', b'').splitlines())
+
+
+@RECV_HANDLERS.register(b'ping')
+def recv_ping(client, **kwargs):
+    """Called when server checks if connection works, it's answered with pong message."""
+    client.writer.write(client.create_message(type=b'pong'))
+
+
+@SEND_HANDLERS.register(b'hello')
 def send_hello(client, **kwargs):
-    """Send nickname to check if it is taken."""
-    message = create_message(type=b'hello', nick=client.nick.encode())
-    client.writer.write(message)
+    """
+    Send nickname to check if it is taken.
+
+    Features client would like to use are listed in the same message, servers which don't know them ignore them.
+    Client reconnecting with token asks to resume its session after the last message it got.
+    """
+    sections = {'type': b'hello', 'nick': client.nick.encode()}
+    if client.features:
+        sections['features'] = b' '.join(client.features)
+    if client.token is not None:
+        sections['token'] = client.token
+        sections['seq'] = b'%d' % client.seq
+    client.writer.write(client.create_message(**sections))
 
 
+@SEND_HANDLERS.register(b'text')
 def send_text(client, msg_args, **kwargs):
-    """Send text message to other client(s)."""
+    """Send text message to other client(s), to members of room if client joined one."""
     text = client.nick.encode() + b': ' + msg_args
-    message = create_message(type=b'text', text=text)
+    if client.room is not None:
+        message = client.create_message(type=b'text', text=text, room=client.room)
+    else:
+        message = client.create_message(type=b'text', text=text)
+    client.writer.write(message)
+
+
+@SEND_HANDLERS.register(b'active')
+def send_active(client, msg_args=b'', **kwargs):
+    """
+    List active users, only those whose nicks start with argument if it's given.
+
+    With presence feature users are listed from roster without asking server, otherwise server is asked.
+    """
+    prefix = msg_args.strip()
+    if client.roster is not None:
+        nick = client.nick.encode()
+        nicks = sorted(active for active in client.roster if active.startswith(prefix))
+        if nicks:
+            text = b''.join(active + b' (you)\n' if active == nick else active + b'\n' for active in nicks)
+        else:
+            text = b'There is no active user starting with ' + prefix + b'.\n'
+        print(text.decode(), end='', file=client.outfile)
+        return
+    if prefix:
+        message = client.create_message(type=b'active', nick=prefix)
+    else:
+        message = client.create_message(type=b'active')
+    client.writer.write(message)
+
+
+@SEND_HANDLERS.register(b'msg')
+def send_msg(client, msg_args, **kwargs):
+    """Send private message, arguments are nick of receiver, colon and text."""
+    nick, _, text = msg_args.partition(b':')
+    text = client.nick.encode() + b' (private): ' + text.lstrip(b' ')
+    message = client.create_message(type=b'msg', nick=nick.strip(), text=text)
+    client.writer.write(message)
+
+
+@SEND_HANDLERS.register(b'join')
+def send_join(client, msg_args, **kwargs):
+    """Join room, text messages are sent to it from now on."""
+    room = msg_args.strip()
+    message = client.create_message(type=b'join', room=room)
+    client.writer.write(message)
+    client.room = room
+
+
+@SEND_HANDLERS.register(b'part')
+def send_part(client, msg_args, **kwargs):
+    """Leave room given in arguments or current room, text messages go to everyone after current room is left."""
+    room = msg_args.strip() or client.room or b''
+    message = client.create_message(type=b'part', room=room)
+    client.writer.write(message)
+    if room == client.room:
+        client.room = None
+
+
+@SEND_HANDLERS.register(b'rooms')
+def send_rooms(client, **kwargs):
+    """Ask server which rooms exist."""
+    message = client.create_message(type=b'rooms')
     client.writer.write(message)
 
 
-def send_active(client, **kwargs):
-    """Ask server about active users."""
-    message = create_message(type=b'active')
+@SEND_HANDLERS.register(b'history')
+def send_history(client, msg_args, **kwargs):
+    """Ask server for last messages, argument is their number."""
+    message = client.create_message(type=b'history', count=msg_args.strip())
     client.writer.write(message)
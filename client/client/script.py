@@ -5,12 +5,12 @@ Functions:
 sigint_handler -- Handle keyboard interrupt.
 got_stdin -- Handler called when there is new user input.
 """
-import asyncio
 import signal
 import sys
 from argparse import ArgumentParser, SUPPRESS
+from protocol import message
+from protocol import loops
 from . import client
-from . import message
 
 
 def sigint_handler(cl):
@@ -28,13 +28,22 @@ def main():
     parser.add_argument('address', default=SUPPRESS, help='Server address.')
     parser.add_argument('port', default=SUPPRESS, help="Server port.")
     parser.add_argument('nick', default=SUPPRESS, help="User nickname.")
+    parser.add_argument('--framing', choices=('text', 'binary', 'deflate'), default='deflate',
+                        help='Framing requested from server, deflate is binary framing with compressed messages. '
+                             'Servers not supporting it use binary framing, those not supporting binary use text.')
+    parser.add_argument('--loop', choices=loops.LOOPS, default='auto',
+                        help='Event loop implementation, auto uses uvloop when it is installed.')
+    parser.add_argument('--no-reconnect', action='store_true',
+                        help='Exit when server closes connection instead of connecting again.')
     args = parser.parse_args()
 
-    loop = asyncio.get_event_loop()
+    loop = loops.new_event_loop(args.loop)
 
-    recv_handlers = message.get_handlers(client, 'recv_')
-    send_handlers = message.get_handlers(client, 'send_')
-    cl = client.Client(loop, recv_handlers, send_handlers, args.address, args.port, args.nick)
+    features = {'text': [], 'binary': [message.BINARY_FRAMING],
+                'deflate': [message.BINARY_FRAMING, message.DEFLATE]}[args.framing]
+    features += [message.PRESENCE, message.KEEPALIVE, message.RESUME]
+    cl = client.Client(loop, client.RECV_HANDLERS, client.SEND_HANDLERS, args.address, args.port, args.nick,
+                       features=features, reconnect=not args.no_reconnect)
     loop.add_signal_handler(signal.SIGINT, sigint_handler, cl)
     loop.add_reader(sys.stdin, got_stdin, cl)
 
@@ -2,8 +2,8 @@ import asyncio
 import io
 import unittest
 import unittest.mock as um
+from protocol import message
 from .. import client
-from .. import message
 
 
 class TestClient(unittest.TestCase):
@@ -18,10 +18,10 @@ class TestClient(unittest.TestCase):
         send_handlers = {b'hello': mock_handler1, b'text': mock_handler2, b'active': mock_handler3}
         cl = client.Client(self.loop, um.Mock(), send_handlers, um.Mock(), um.Mock(), 'nick')
 
-        async def mock_readline():
+        async def mock_read(n=-1):
             await asyncio.sleep(1)
         cl.reader = um.Mock()
-        cl.reader.readline = mock_readline
+        cl.reader.read = mock_read
         cl.writer = um.Mock()
 
         handling = self.loop.create_task(cl.handle_connection())
@@ -42,7 +42,7 @@ class TestClient(unittest.TestCase):
         ]
         i = -1
 
-        async def mock_readline():
+        async def mock_read(n=-1):
             nonlocal i
             await asyncio.sleep(0.05)
             i += 1
@@ -53,7 +53,7 @@ class TestClient(unittest.TestCase):
         recv_handlers = {b'hello': mock_handler1, b'text': mock_handler2, b'active': mock_handler3}
         cl = client.Client(self.loop, recv_handlers, send_handlers, um.Mock(), um.Mock(), um.Mock())
         cl.reader = um.Mock()
-        cl.reader.readline = mock_readline
+        cl.reader.read = mock_read
         cl.writer = um.Mock()
 
         handling = self.loop.create_task(cl.handle_connection())
@@ -63,6 +63,76 @@ class TestClient(unittest.TestCase):
         mock_handler2.assert_called()
         mock_handler3.assert_not_called()
 
+    def test_reconnect(self):
+        """Test if client connects again after server closed connection, says hello and rejoins its room."""
+        received = []
+
+        async def handle(reader, writer):
+            parser = message.FrameParser()
+            messages = []
+            while len(messages) < 2:
+                messages.extend(parser.feed(await reader.read(message.CHUNK_SIZE)))
+            received.append(messages)
+            writer.close()
+
+        async def run():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            cl = client.Client(self.loop, client.RECV_HANDLERS, client.SEND_HANDLERS, '127.0.0.1', port, 'nick',
+                               outfile=io.StringIO(), reconnect=True)
+            cl.reader, cl.writer = await asyncio.open_connection('127.0.0.1', port)
+            cl.room = b'room'
+            cl.framing = message.BINARY_FRAMING
+            with um.patch.object(client, 'BACKOFF', 0.01):
+                cl.con_handling = asyncio.ensure_future(cl.handle_connection())
+                while len(received) < 3:
+                    await asyncio.sleep(0.01)
+                cl.stop_connection()
+                await cl.con_handling
+            server.close()
+            await server.wait_closed()
+            return cl
+
+        cl = self.loop.run_until_complete(run())
+        hello, join = {b'type': b'hello', b'nick': b'nick'}, {b'type': b'join', b'room': b'room'}
+        self.assertEqual(received[:3], [[hello, join]] * 3)
+        self.assertEqual(cl.framing, message.TEXT_FRAMING)
+        self.assertIn('Connection lost', cl.outfile.getvalue())
+
+    def test_reconnect_refused(self):
+        """Test if backoff keeps growing while server refuses connection and is reset by answer to hello."""
+        connections = 0
+
+        async def handle(reader, writer):
+            nonlocal connections
+            connections += 1
+            if connections < 4:
+                writer.write(message.create_message(type=b'text', text=b'Server is full, try again later.\n'))
+                writer.close()
+            else:
+                writer.write(message.create_message(type=b'features', features=b''))
+
+        async def run():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            cl = client.Client(self.loop, client.RECV_HANDLERS, client.SEND_HANDLERS, '127.0.0.1', port, 'nick',
+                               outfile=io.StringIO(), reconnect=True)
+            cl.reader, cl.writer = await asyncio.open_connection('127.0.0.1', port)
+            attempts = []
+            with um.patch.object(client, 'BACKOFF', 0.01):
+                cl.con_handling = asyncio.ensure_future(cl.handle_connection())
+                while connections < 4:
+                    attempts.append(cl.attempt)
+                    await asyncio.sleep(0.005)
+                await asyncio.sleep(0.05)
+                cl.stop_connection()
+                await cl.con_handling
+            server.close()
+            await server.wait_closed()
+            return max(attempts), cl.attempt
+
+        self.assertEqual(self.loop.run_until_complete(run()), (3, 0))
+
     def test_send(self):
         """Test if correct send_handlers are called."""
         mock_handler1, mock_handler2, mock_handler3 = um.Mock(), um.Mock(), um.Mock()
@@ -77,6 +147,19 @@ class TestClient(unittest.TestCase):
         cl.send(msg)
         mock_handler2.assert_called()
 
+    def test_check_type(self):
+        """Test if commands and their arguments are recognized."""
+        msgs = (b'Text.\n', b'/active\n', b'/join: python\n', b'/msg nick: Hi: there.\n')
+        real_results = (
+            (b'text', b'Text.\n'),
+            (b'active', b''),
+            (b'join', b' python\n'),
+            (b'msg', b'nick: Hi: there.\n'),
+        )
+        for msg, real_result in zip(msgs, real_results):
+            with self.subTest(msg=msg):
+                self.assertEqual(client.Client.check_type(msg), real_result)
+
 
 class TestRecvHandlers(unittest.TestCase):
     def test_recv_text(self):
@@ -98,6 +181,27 @@ class TestRecvHandlers(unittest.TestCase):
                 client.recv_text(msg, cl)
                 self.assertEqual(outfile.getvalue(), real_result)
 
+    def test_recv_features(self):
+        """Test if agreed features are remembered and binary framing is used for sending."""
+        cl = client.Client(um.Mock(), um.Mock(), um.Mock(), um.Mock(), um.Mock(), 'nickname')
+        cl.writer = um.Mock()
+        client.recv_features({b'type': b'features', b'features': b'binary'}, cl)
+        self.assertEqual(cl.framing, message.BINARY_FRAMING)
+        client.send_active(cl)
+        cl.writer.write.assert_called_with(b'\x00\x08\x01\x06active')
+        client.recv_features({b'type': b'features', b'features': b'binary deflate'}, cl)
+        self.assertEqual(cl.framing, message.DEFLATE)
+        client.send_text(cl, b'Long text. ' * 20)
+        self.assertEqual(message.FrameParser().feed(cl.writer.write.call_args[0][0]),
+                         [{b'type': b'text', b'text': b'nickname: ' + b'Long text. ' * 20}])
+
+    def test_recv_text_room(self):
+        """Test if messages sent to room are prefixed with its name."""
+        cl = client.Client(um.Mock(), um.Mock(), um.Mock(), um.Mock(), um.Mock(), um.Mock())
+        cl.outfile = io.StringIO()
+        client.recv_text({b'type': b'text', b'text': b'nick: Hi.\n', b'room': b'python'}, cl)
+        self.assertEqual(cl.outfile.getvalue(), '[python] nick: Hi.\n')
+
 
 class TestSendHanlders(unittest.TestCase):
     def test_send_hello(self):
@@ -107,6 +211,14 @@ class TestSendHanlders(unittest.TestCase):
         client.send_hello(cl)
         cl.writer.write.assert_called_with(b'#type\nhello\n#nick\nnickname\n#\n')
 
+    def test_send_hello_features(self):
+        """Test if requested features are listed in hello message."""
+        cl = client.Client(um.Mock(), um.Mock(), um.Mock(), um.Mock(), um.Mock(), 'nickname',
+                           features=[b'binary'])
+        cl.writer = um.Mock()
+        client.send_hello(cl)
+        cl.writer.write.assert_called_with(b'#type\nhello\n#nick\nnickname\n#features\nbinary\n#\n')
+
     def test_send_text(self):
         """Test if correct message is sent."""
         cl = client.Client(um.Mock(), um.Mock(), um.Mock(), um.Mock(), um.Mock(), 'nickname')
@@ -115,70 +227,80 @@ class TestSendHanlders(unittest.TestCase):
         client.send_text(cl, msg_args)
         cl.writer.write.assert_called_with(b'#type\ntext\n#text\nnickname: Text message.\n#\n')
 
+    def test_send_msg(self):
+        """Test if correct message is sent."""
+        cl = client.Client(um.Mock(), um.Mock(), um.Mock(), um.Mock(), um.Mock(), 'nickname')
+        cl.writer = um.Mock()
+        client.send_msg(cl, b'friend: Hi.\n')
+        cl.writer.write.assert_called_with(b'#type\nmsg\n#nick\nfriend\n#text\nnickname (private): Hi.\\\n\n#\n')
+
     def test_send_active(self):
         """Test if correct message is sent."""
         cl = client.Client(um.Mock(), um.Mock(), um.Mock(), um.Mock(), um.Mock(), 'nickname')
         cl.writer = um.Mock()
         client.send_active(cl)
         cl.writer.write.assert_called_with(b'#type\nactive\n#\n')
+        client.send_active(cl, b' user\n')
+        cl.writer.write.assert_called_with(b'#type\nactive\n#nick\nuser\n#\n')
 
+    def test_presence(self):
+        """Test if roster follows presence messages and active users are listed without asking server."""
+        cl = client.Client(um.Mock(), um.Mock(), um.Mock(), um.Mock(), um.Mock(), 'nickname')
+        cl.writer = um.Mock()
+        cl.outfile = io.StringIO()
+        client.recv_presence({b'type': b'presence', b'joined': b'user\nnickname\nfriend\n'}, cl)
+        client.recv_presence({b'type': b'presence', b'joined': b'new\n', b'left': b'user\n'}, cl)
+        self.assertEqual(cl.roster, {b'nickname', b'friend', b'new'})
 
-class TestMessage(unittest.TestCase):
-    def test_cut_message(self):
-        all_msg_lines = (
-            [
-                b'#type\n',
-                b'text\\\n',
-                b'\n',
-                b'#content\n',
-                b'message\n',
-                b'#\n',
-            ],
-            [
-                b'#type\n',
-                b'#\n',
-            ],
-            [
-                b'#\n',
-            ]
-        )
-        real_results = (
-            {
-                b'type': b'text\n',
-                b'content': b'message',
-            },
-            {
-                b'type': b'',
-            },
-            {}
-        )
+        client.send_active(cl)
+        client.send_active(cl, b'n')
+        client.send_active(cl, b'x')
+        cl.writer.write.assert_not_called()
+        self.assertEqual(cl.outfile.getvalue(), 'friend\nnew\nnickname (you)\nnew\nnickname (you)\n'
+                                                'There is no active user starting with x.\n')
 
-        for msg_lines, real_result in zip(all_msg_lines, real_results):
-            with self.subTest(msg_lines=msg_lines, real_result=real_result):
-                self.assertDictEqual(message.cut_message(msg_lines), real_result)
+    def test_resume(self):
+        """Test if hello resumes session after the last received message and room is rejoined if server forgot it."""
+        cl = client.Client(um.Mock(), um.Mock(), um.Mock(), um.Mock(), um.Mock(), 'nickname', outfile=io.StringIO(),
+                           features=[b'resume'])
+        cl.writer = um.Mock()
+        client.recv_features({b'type': b'features', b'features': b'resume', b'token': b'abc'}, cl)
+        client.recv_text({b'type': b'text', b'text': b'b\n', b'seq': b'7'}, cl)
+        client.recv_text({b'type': b'text', b'text': b'a\n', b'room': b'r', b'seq': b'5'}, cl)
+        self.assertEqual((cl.token, cl.seq), (b'abc', 7))
+        client.send_hello(cl)
+        cl.writer.write.assert_called_with(b'#type\nhello\n#nick\nnickname\n#features\nresume\n#token\nabc\n'
+                                           b'#seq\n7\n#\n')
+        client.recv_features({b'type': b'features', b'features': b'resume', b'token': b'abc'}, cl)
+        cl.room = b'r'
+        client.recv_features({b'type': b'features', b'features': b'resume', b'token': b'def'}, cl)
+        cl.writer.write.assert_called_with(b'#type\njoin\n#room\nr\n#\n')
+        self.assertEqual((cl.token, cl.seq), (b'def', 0))
 
-    def test_create_message(self):
-        args = (
-            dict(type=b'text', content=b'Text message.\n'),
-            dict(type=b''),
-            dict(),
-        )
-        real_msgs = (
-            b'#type\ntext\n#content\nText message.\\\n\n#\n',
-            b'#type\n\n#\n',
-            b'#\n',
-        )
+    def test_recv_ping(self):
+        """Test if ping is answered with pong."""
+        cl = client.Client(um.Mock(), um.Mock(), um.Mock(), um.Mock(), um.Mock(), 'nickname')
+        cl.writer = um.Mock()
+        client.recv_ping(message={b'type': b'ping'}, client=cl)
+        cl.writer.write.assert_called_with(b'#type\npong\n#\n')
 
-        for arg, real_msg in zip(args, real_msgs):
-            with self.subTest(arg=arg, real_msg=real_msg):
-                self.assertEqual(message.create_message(**arg), real_msg)
+    def test_send_history(self):
+        """Test if count is sent without whitespace."""
+        cl = client.Client(um.Mock(), um.Mock(), um.Mock(), um.Mock(), um.Mock(), 'nickname')
+        cl.writer = um.Mock()
+        client.send_history(cl, b' 5\n')
+        cl.writer.write.assert_called_with(b'#type\nhistory\n#count\n5\n#\n')
 
-    def test_get_handlers(self):
-        mock_module = um.Mock()
-        mock_module.f = lambda: None
-        mock_module.recv_hello = lambda: None
-        mock_module.recv_text = lambda: None
-        mock_module.recvhi = lambda: None
 
-        handlers = message.get_handlers(mock_module, 'recv_')
-        self.assertDictEqual(handlers, {b'hello': mock_module.recv_hello, b'text': mock_module.recv_text})
+class TestRoomHandlers(unittest.TestCase):
+    def test_join_text_part(self):
+        """Test if text messages go to joined room until it is left."""
+        cl = client.Client(um.Mock(), um.Mock(), um.Mock(), um.Mock(), um.Mock(), 'nickname')
+        cl.writer = um.Mock()
+        client.send_join(cl, b' python\n')
+        cl.writer.write.assert_called_with(b'#type\njoin\n#room\npython\n#\n')
+        client.send_text(cl, b'Hi.')
+        cl.writer.write.assert_called_with(b'#type\ntext\n#text\nnickname: Hi.\n#room\npython\n#\n')
+        client.send_part(cl, b'\n')
+        cl.writer.write.assert_called_with(b'#type\npart\n#room\npython\n#\n')
+        self.assertIsNone(cl.room)
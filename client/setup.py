@@ -7,6 +7,10 @@ setup(
     url='https://github.com/worstof3/chat/client',
     author='Łukasz Karpiński',
     packages=['client'],
+    install_requires=['chat-protocol'],
+    extras_require={
+        'uvloop': ['uvloop']
+    },
     test_suite='client.tests',
     entry_points={
         'console_scripts': [
@@ -0,0 +1,47 @@
+"""
+Module defines factories of event loops.
+
+Loop named uvloop is used only if uvloop package is installed, auto picks it when it's available and stock asyncio
+loop otherwise.
+
+Functions:
+get_loop_factory -- Return function creating event loops of given kind.
+new_event_loop -- Create event loop of given kind and set it as current.
+"""
+import asyncio
+
+LOOPS = ('auto', 'asyncio', 'uvloop')
+
+
+def get_loop_factory(name='auto'):
+    """
+    Return function creating event loops of given kind.
+
+    Args:
+    name -- One of LOOPS.
+
+    Returns:
+    Function without arguments returning new event loop.
+
+    Raises:
+    ValueError -- Name is unknown.
+    ImportError -- Name is uvloop and uvloop isn't installed.
+    """
+    if name not in LOOPS:
+        raise ValueError('Unknown event loop {!r}.'.format(name))
+    if name == 'asyncio':
+        return asyncio.new_event_loop
+    try:
+        import uvloop
+    except ImportError:
+        if name == 'uvloop':
+            raise
+        return asyncio.new_event_loop
+    return uvloop.new_event_loop
+
+
+def new_event_loop(name='auto'):
+    """Create event loop of given kind and set it as current, see get_loop_factory."""
+    loop = get_loop_factory(name)()
+    asyncio.set_event_loop(loop)
+    return loop
@@ -0,0 +1,785 @@
+"""
+Module defines functions to help creating, reading and handling messages, it's shared by server and client.
+
+Messages are in the following format (\n are newlines added in processing):
+#header1\n
+section1\n
+#header2\n
+section2\n
+.
+.
+.
+#headerN\n
+sectionN\n
+#\n.
+For example
+#type\n
+type_of_message\n
+#content\n
+content_of_message\n
+#\n
+Headers can't have newlines.
+Newline and # characters in each section are escaped with backslash when message is created. In other words
+the only newline and # characters, which are not escaped are the ones added in process of message creation. It's
+acceptable to have # in header but not recommended.
+
+Peers which agreed on binary framing in hello message can also send messages in the following format:
+0x00 varint(length of sections) section1 section2 ... sectionN
+where each section is
+varint(header id) varint(length of content) content
+Header id is position of header in HEADERS counting from 1. Headers not in HEADERS have id 0 which is followed by
+varint(length of header) header. Varints are unsigned LEB128 of at most 10 bytes. Contents aren't escaped. Text
+messages never start with 0x00 byte, so both formats can be read from the same connection.
+
+Peers which agreed on deflate feature besides binary framing can also send binary messages with compressed sections:
+0x01 varint(length of compressed sections) deflate(section1 section2 ... sectionN)
+Sections are compressed with raw deflate and preset dictionary ZDICT, so even short chat messages get shorter.
+Messages whose sections are shorter than DEFLATE_THRESHOLD or don't get shorter are sent as binary messages. Deflate
+is framing of its own in ENCODERS, so message broadcast to many peers is compressed only once.
+
+In lazy mode FrameParser returns LazyMessage instances instead of dictionaries. Their sections are views of received
+frame, they are unescaped only when handler reads them. Sections forwarded with OutgoingMessage are copied only once,
+when outgoing message is joined, and sections of text messages forwarded in text framing aren't escaped again.
+
+Handlers of messages are registered in Registry with its register decorator when their module is imported. Registry
+is flat dictionary mapping types of messages to handlers, so dispatching message is one lookup.
+
+Classes:
+FrameTooLargeError -- Exception raised when received message is longer than parser allows.
+CorruptFrameError -- Exception raised when received binary message is malformed or can't be inflated.
+MalformedMessageError -- Exception raised when received message has unknown type or lacks section its handler needs.
+FrameParser -- Incremental parser of messages read in chunks.
+Section -- Content of section kept as view of received frame.
+LazyMessage -- Received message with sections unescaped on access.
+OutgoingMessage -- Message encoded lazily, at most once for each framing.
+Registry -- Map types of messages to handlers registered with decorator.
+
+Functions:
+cut_message -- Cut message to sections defined by headers.
+cut_frame -- Cut complete message to sections defined by headers.
+cut_binary_frame -- Cut sections of binary message.
+create_message -- Create message according to protocol described in module help.
+create_binary_message -- Create message in binary format described in module help.
+create_deflated_message -- Create binary message with sections compressed if it makes them shorter.
+inflate -- Decompress sections of compressed binary message.
+payload -- Return content of section in form which is forwarded without copying.
+encode_varint -- Encode unsigned integer as varint.
+decode_varint -- Decode varint from data.
+get_handlers -- Read handlers of messages from module by names of functions.
+"""
+import inspect
+import zlib
+from collections.abc import Mapping
+
+CHUNK_SIZE = 64 * 1024
+
+TEXT_FRAMING = b'text'
+BINARY_FRAMING = b'binary'
+# Feature of peers which get presence messages listing nicks which joined and left.
+PRESENCE = b'presence'
+# Feature of peers which answer ping message with pong message.
+KEEPALIVE = b'keepalive'
+# Feature and framing of peers which compress binary messages with preset dictionary.
+DEFLATE = b'deflate'
+# Feature of peers which resume lost session with token and get messages they missed, numbered in seq section.
+RESUME = b'resume'
+BINARY_MAGIC = 0
+DEFLATE_MAGIC = 1
+# Varint of 64-bit integer has at most this many bytes, longer ones are refused.
+MAX_VARINT_LENGTH = 10
+# Sections shorter than this many bytes are sent uncompressed.
+DEFLATE_THRESHOLD = 32
+DEFLATE_LEVEL = 6
+# Compressed message inflating to more bytes is refused even if parser has no max_size.
+MAX_INFLATED_SIZE = 4 * 1024 * 1024
+# Preset dictionary of deflate, word runs found in at least two conversations of chat corpus in server/corpus, picked
+# by build_dictionary of server benchmark, which writes it with --zdict-out. The most common ones are at the end,
+# followed by starts of bodies of private and text messages. It's part of protocol, peers have to use the same bytes,
+# so it can't be changed without new feature name.
+ZDICT = (
+    b'I\'d big fix oh, try use call each give good\nhmm, loop\nmake more much nice once open pull says send test them'
+    b' wait week\n\xf0\x9f\x8e\x89\nERROR I get I see all any check doing every few fixed here, let\'s lol\nnice, per'
+    b' rerun see set tests\nthat, those three was while write a look accept again, ah ok, before closes failed finish'
+    b' if the is the it and missed of the one is p99 is python recent sounds take a way to you\'re then they went wer'
+    b'e work \xf0\x9f\x91\x8d\nand add another are the back to clients\ncollect did you for the get the has if it\'s '
+    b'it only like to minutes\nneed to package release running someone version why I\'m workers\nwriting I have a add'
+    b' a anything could done, dropping editable everyone\nhave one it keeps it\'s not looks messages\nprobably protoc'
+    b'ol still sure, the chat the main the same the test\nto about too long will do, you have you need I run the I\'l'
+    b'l just broadcast but everyone!\nfrom how it\'s just like questions\nshould be the tests then\nthis when yes, it'
+    b'\'s have a right, to the I can take confirmed, it doesn\'t server and the tests?\nI can after already doesn\'t '
+    b'joined room keeps know if you look at the most of now\nok, tests thanks!\nthanks, that\'s what the history the '
+    b'old we\'re need what with I don\'t have can you also reconnecting it\'s the messages not yet, the last I have c'
+    b'an you paste it, let me not on the thanks\nwe should add are you using?\ngood reconnect which yes, AssertionErr'
+    b'or: I\'ll update the I\'m clients look at don\'t have is there a the server update the does anyone know anyone '
+    b'last thanks that and that\'s a there just the new we should about server there\'s an issue for the client I\'ll'
+    b' have can you should it\'s in the I think that\'s \x01\x03msg\x02\x01\x04text\x03'
+)
+
+# New headers can only be appended, ids of headers are their positions.
+HEADERS = (b'type', b'nick', b'text', b'features', b'room', b'count', b'joined', b'left', b'seq', b'token')
+HEADER_IDS = {header: bytes([i]) for i, header in enumerate(HEADERS, 1)}
+
+
+class FrameTooLargeError(ValueError):
+    """Exception raised when received message is longer than parser allows."""
+    pass
+
+
+class CorruptFrameError(ValueError):
+    """Exception raised when received binary message is malformed or can't be inflated."""
+    pass
+
+
+class MalformedMessageError(ValueError):
+    """Exception raised when received message has unknown type or lacks section its handler needs."""
+    pass
+
+
+class FrameParser:
+    """
+    Incremental parser of messages read in chunks.
+
+    Data is kept in one reusable buffer. Since every newline and # character in sections is escaped, text message ends
+    at the first unescaped newline followed by #\n, so ends of messages are found with bytes.find without looking at
+    single lines. Binary messages are recognized by their first byte and their length is read from the prefix,
+    compressed ones are inflated and returned like binary messages. Length prefix longer than MAX_VARINT_LENGTH bytes
+    is refused and once it's read it's kept, so message arriving in many chunks is decoded only once. With max_size,
+    binary message is refused as soon as its length prefix is read or more than max_size bytes of unfinished prefix are
+    buffered, text message as soon as more than max_size bytes of it are buffered without its end, so peer can't make
+    buffer grow without limit. Compressed message is refused also if it inflates to more than max_size bytes or
+    MAX_INFLATED_SIZE bytes, whichever is less, so a short message can't make parser allocate a lot of memory. Binary
+    and compressed messages can be refused until their framing is agreed on, then they are treated as corrupt.
+
+    Instance attributes:
+    buffer -- Data which doesn't form complete message yet.
+    lazy -- If true, messages are returned as LazyMessage instances.
+    max_size -- Maximal length of message in bytes (of body for binary messages), None means no limit.
+    binary -- If false, binary messages are refused.
+    deflate -- If false, compressed messages are refused.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    feed -- Add data to buffer and return messages completed by it.
+    """
+    def __init__(self, lazy=False, max_size=None, binary=True, deflate=True):
+        """Initialize instance."""
+        self.buffer = bytearray()
+        self.lazy = lazy
+        self.max_size = max_size
+        self.binary = binary
+        self.deflate = deflate
+        self._scanned = 0
+        # Length and offset of body of binary message at start of buffer whose body isn't complete yet.
+        self._pending = None
+
+    def feed(self, data):
+        """
+        Add data to buffer and return messages completed by it.
+
+        Args:
+        data -- Chunk of data read from connection, it can end anywhere in a message.
+
+        Returns:
+        List of cut messages, see cut_message, or LazyMessage instances in lazy mode.
+
+        Raises:
+        FrameTooLargeError -- Message is longer than max_size, parser can't be used any more.
+        CorruptFrameError -- Binary message is malformed, can't be inflated or its framing isn't accepted, parser can't
+        be used any more.
+        """
+        buffer = self.buffer
+        max_size = self.max_size
+        buffer += data
+        messages = []
+        start = 0
+        while start < len(buffer):
+            if buffer[start] == BINARY_MAGIC or buffer[start] == DEFLATE_MAGIC:
+                if not (self.binary if buffer[start] == BINARY_MAGIC else self.deflate):
+                    raise CorruptFrameError('Framing of message {} was not agreed on.'.format(buffer[start]))
+                if start == 0 and self._pending is not None:
+                    length, body = self._pending
+                else:
+                    try:
+                        length, body = decode_varint(buffer, start + 1)
+                    except IndexError:
+                        if max_size is not None and len(buffer) - start > max_size:
+                            raise FrameTooLargeError('Message is longer than {} bytes.'.format(max_size))
+                        break
+                    if max_size is not None and length > max_size:
+                        raise FrameTooLargeError('Message of {} bytes is longer than {} bytes.'.format(length,
+                                                                                                    max_size))
+                end = body + length
+                if end > len(buffer):
+                    # Message is moved to start of buffer below.
+                    self._pending = (length, body - start)
+                    break
+                self._pending = None
+                if buffer[start] == DEFLATE_MAGIC:
+                    sections = inflate(buffer[body:end], MAX_INFLATED_SIZE if max_size is None
+                                       else min(max_size, MAX_INFLATED_SIZE))
+                else:
+                    sections = bytes(buffer[body:end])
+                if self.lazy:
+                    messages.append(LazyMessage(sections, BINARY_FRAMING))
+                else:
+                    messages.append(cut_binary_frame(sections))
+                start = end
+                continue
+            if buffer.startswith(b'#\n', start):
+                end = start + 2
+            else:
+                pos = buffer.find(b'\n#\n', max(start, self._scanned))
+                if pos < 0:
+                    if max_size is not None and len(buffer) - start > max_size:
+                        raise FrameTooLargeError('Message is longer than {} bytes.'.format(max_size))
+                    # Terminator can begin in the last two bytes, they are scanned again with next chunk.
+                    self._scanned = max(start, len(buffer) - 2)
+                    break
+                end = pos + 3
+                if max_size is not None and end - start > max_size:
+                    raise FrameTooLargeError('Message is longer than {} bytes.'.format(max_size))
+            if self.lazy:
+                messages.append(LazyMessage(bytes(buffer[start:end]), TEXT_FRAMING))
+            else:
+                messages.append(cut_frame(bytes(buffer[start:end])))
+            start = end
+        if start:
+            del buffer[:start]
+            self._scanned = max(0, self._scanned - start)
+        return messages
+
+
+def cut_message(msg_lines):
+    """
+    Cut message to sections defined by headers.
+
+    Each section is stored in returned dictionary. Dictionary key for each section is it's header (bytes object). Each
+    newline escaped with backslash is stored without backslash and each newline not escaped is removed. Escaped
+    # characters in each section are stored without backslash.
+
+    Args:
+    msg_lines -- Iterable of message lines. We assume only newline in each line is the one at the end.
+
+    Returns:
+    Dictionary with cut message.
+    """
+    sections = {}
+    lines = iter(msg_lines)
+    header = next(lines)[1:-1]
+
+    while True:
+        if not header:
+            break
+        header_lines = []
+        for line in lines:
+            if line.startswith(b'#'):
+                break
+            line = line.replace(b'\\#', b'#')
+            if line.endswith(b'\\\n'):
+                line = line[:-2] + b'\n'
+            else:
+                line = line[:-1]
+            header_lines.append(line)
+        sections[header] = b''.join(header_lines)
+        header = line[1:-1]
+
+    return sections
+
+
+def cut_frame(frame):
+    """
+    Cut complete message to sections defined by headers.
+
+    Result is the same as of cut_message, but message is given as one bytes object and it's split on unescaped
+    newlines followed by # instead of being processed line by line.
+
+    Args:
+    frame -- Complete message, including final #\n line.
+
+    Returns:
+    Dictionary with cut message.
+    """
+    sections = {}
+    if frame == b'#\n':
+        return sections
+    for part in frame[1:-3].split(b'\n#'):
+        header, _, content = part.partition(b'\n')
+        if b'\\' in content:
+            content = content.replace(b'\\\n', b'\n').replace(b'\\#', b'#')
+        sections[header] = content
+    return sections
+
+
+def cut_binary_frame(body):
+    """
+    Cut sections of binary message.
+
+    Args:
+    body -- Sections of message, without magic byte and length prefix.
+
+    Returns:
+    Dictionary with cut message.
+
+    Raises:
+    CorruptFrameError -- Body has unknown header id or section running past its end.
+    """
+    return {header: body[start:end] for header, (start, end) in _binary_spans(body).items()}
+
+
+class Section:
+    """
+    Content of section kept as view of received frame.
+
+    Instance attributes:
+    view -- Memoryview of content as it is in frame.
+    escaped -- If true, content in view is escaped as in text framing.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+    __bytes__ -- Unescaped content, it's created only once.
+    __len__ -- Size of content in frame.
+
+    Methods:
+    escaped_content -- Return content escaped for text framing.
+    content -- Return unescaped content.
+    """
+    __slots__ = ('view', 'escaped', '_content')
+
+    def __init__(self, view, escaped):
+        """Initialize instance."""
+        self.view = view
+        self.escaped = escaped
+        self._content = None
+
+    def __bytes__(self):
+        """Unescaped content, it's created only once."""
+        if self._content is None:
+            content = self.view.tobytes()
+            if self.escaped and b'\\' in content:
+                content = content.replace(b'\\\n', b'\n').replace(b'\\#', b'#')
+            self._content = content
+        return self._content
+
+    def __len__(self):
+        """Size of content in frame."""
+        return len(self.view)
+
+    def escaped_content(self):
+        """Return content escaped for text framing, view itself if it's escaped already."""
+        if self.escaped:
+            return self.view
+        return bytes(self).replace(b'\n', b'\\\n').replace(b'#', b'\\#')
+
+    def content(self):
+        """Return unescaped content, view itself if there is nothing to unescape."""
+        if self.escaped:
+            return bytes(self)
+        return self.view
+
+
+class LazyMessage(Mapping):
+    """
+    Received message with sections unescaped on access.
+
+    It's read-only mapping of headers to contents like dictionaries returned by cut_frame and cut_binary_frame, only
+    offsets of sections are found when it's created.
+
+    Instance attributes:
+    frame -- Received message.
+    framing -- Framing of frame.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+    __getitem__ -- Return unescaped content of section.
+    __contains__ -- Check if message has section, content isn't unescaped.
+    __iter__ -- Iterate over headers.
+    __len__ -- Number of sections.
+
+    Methods:
+    section -- Return Section for header.
+    """
+    def __init__(self, frame, framing):
+        """
+        Initialize instance.
+
+        Args:
+        frame -- Complete text message or body of binary message, see FrameParser.
+        framing -- TEXT_FRAMING or BINARY_FRAMING.
+        """
+        self.frame = frame
+        self.framing = framing
+        if framing == BINARY_FRAMING:
+            self._spans = _binary_spans(frame)
+        else:
+            self._spans = _text_spans(frame)
+        self._sections = {}
+
+    def __getitem__(self, header):
+        """Return unescaped content of section."""
+        return bytes(self.section(header))
+
+    def __contains__(self, header):
+        """Check if message has section, content isn't unescaped."""
+        return header in self._spans
+
+    def __iter__(self):
+        """Iterate over headers."""
+        return iter(self._spans)
+
+    def __len__(self):
+        """Number of sections."""
+        return len(self._spans)
+
+    def section(self, header):
+        """
+        Return Section for header.
+
+        Raises:
+        KeyError -- Message has no such section.
+        """
+        try:
+            return self._sections[header]
+        except KeyError:
+            start, end = self._spans[header]
+            section = Section(memoryview(self.frame)[start:end], self.framing != BINARY_FRAMING)
+            self._sections[header] = section
+            return section
+
+
+def _text_spans(frame):
+    """Return map headers of text message to (start, end) offsets of contents, like cut_frame cuts them."""
+    spans = {}
+    if frame == b'#\n':
+        return spans
+    limit = len(frame) - 3
+    pos = 1
+    while True:
+        separator = frame.find(b'\n#', pos, limit)
+        part_end = separator if separator >= 0 else limit
+        newline = frame.find(b'\n', pos, part_end)
+        if newline < 0:
+            spans[frame[pos:part_end]] = (part_end, part_end)
+        else:
+            spans[frame[pos:newline]] = (newline + 1, part_end)
+        if separator < 0:
+            return spans
+        pos = separator + 2
+
+
+def _binary_spans(body):
+    """
+    Return map headers of binary message to (start, end) offsets of contents.
+
+    Raises:
+    CorruptFrameError -- Body has unknown header id or section running past its end.
+    """
+    spans = {}
+    pos = 0
+    try:
+        while pos < len(body):
+            header_id, pos = decode_varint(body, pos)
+            if header_id > len(HEADERS):
+                raise CorruptFrameError('Header id {} is unknown.'.format(header_id))
+            if header_id:
+                header = HEADERS[header_id - 1]
+            else:
+                length, pos = decode_varint(body, pos)
+                header = bytes(body[pos:pos + length])
+                pos += length
+            length, pos = decode_varint(body, pos)
+            if pos + length > len(body):
+                raise CorruptFrameError('Section runs past end of message.')
+            spans[header] = (pos, pos + length)
+            pos += length
+    except IndexError:
+        raise CorruptFrameError('Message ends inside section header.') from None
+    return spans
+
+
+def payload(message, header):
+    """
+    Return content of section in form which is forwarded without copying.
+
+    Args:
+    message -- Cut message or LazyMessage.
+    header -- Header of section.
+
+    Returns:
+    Section of LazyMessage, bytes for other messages. Both can be content of OutgoingMessage and create functions.
+    """
+    if isinstance(message, LazyMessage):
+        return message.section(header)
+    return message[header]
+
+
+def create_message(**kwargs):
+    """
+    Create message according to protocol described in module help.
+
+    Each key in kwargs is treated as header and corresponding value is section content. As described above each newline
+    and # character in section content are escaped with backslash. Contents can be Section instances, escaped ones are
+    used as they are.
+
+    Returns:
+    Created message.
+    """
+    msg_lines = []
+    for header, content in kwargs.items():
+        msg_lines.append(b'#' + header.encode() + b'\n')
+        if isinstance(content, Section):
+            content = content.escaped_content()
+        else:
+            content = content.replace(b'\n', b'\\\n').replace(b'#', b'\\#')
+        msg_lines += (content, b'\n')
+    msg_lines.append(b'#\n')
+    message = b''.join(msg_lines)
+    return message
+
+
+def create_binary_message(**kwargs):
+    """
+    Create message in binary format described in module help.
+
+    Each key in kwargs is treated as header and corresponding value is section content, content is copied only once
+    when message is joined. Contents can be Section instances, views of unescaped ones are joined directly.
+
+    Returns:
+    Created message.
+    """
+    msg_parts = [None]
+    length = 0
+    for header, content in kwargs.items():
+        if isinstance(content, Section):
+            content = content.content()
+        header = header.encode()
+        header_id = HEADER_IDS.get(header)
+        if header_id is None:
+            header_id = b'\x00' + encode_varint(len(header)) + header
+        content_length = encode_varint(len(content))
+        msg_parts += (header_id, content_length, content)
+        length += len(header_id) + len(content_length) + len(content)
+    msg_parts[0] = bytes([BINARY_MAGIC]) + encode_varint(length)
+    return b''.join(msg_parts)
+
+
+def create_deflated_message(**kwargs):
+    """
+    Create binary message with sections compressed if it makes them shorter.
+
+    Kwargs are the same as of create_binary_message, message is compressed only if its sections are at least
+    DEFLATE_THRESHOLD bytes long.
+
+    Returns:
+    Created message, compressed or binary.
+    """
+    frame = create_binary_message(**kwargs)
+    length, body = decode_varint(frame, 1)
+    if length < DEFLATE_THRESHOLD:
+        return frame
+    compressor = zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=ZDICT)
+    compressed = compressor.compress(memoryview(frame)[body:]) + compressor.flush()
+    if len(compressed) + 1 >= length:
+        return frame
+    return bytes([DEFLATE_MAGIC]) + encode_varint(len(compressed)) + compressed
+
+
+def inflate(data, max_size=MAX_INFLATED_SIZE):
+    """
+    Decompress sections of compressed binary message.
+
+    Args:
+    data -- Compressed sections, without magic byte and length prefix.
+    max_size -- Maximal length of decompressed sections, None means no limit.
+
+    Returns:
+    Sections, the same as body of binary message.
+
+    Raises:
+    FrameTooLargeError -- Sections inflate to more than max_size bytes.
+    CorruptFrameError -- Data isn't complete compressed stream.
+    """
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=ZDICT)
+    try:
+        if max_size is None:
+            sections = decompressor.decompress(data)
+        else:
+            sections = decompressor.decompress(data, max_size + 1)
+    except zlib.error as exc:
+        raise CorruptFrameError('Compressed message is corrupted.') from exc
+    if max_size is not None and len(sections) > max_size:
+        raise FrameTooLargeError('Message inflates to more than {} bytes.'.format(max_size))
+    if not decompressor.eof:
+        raise CorruptFrameError('Compressed message is incomplete.')
+    return sections
+
+
+ENCODERS = {TEXT_FRAMING: create_message, BINARY_FRAMING: create_binary_message, DEFLATE: create_deflated_message}
+
+
+class OutgoingMessage:
+    """
+    Message encoded lazily, at most once for each framing.
+
+    It's meant for messages sent to many clients, which don't have to use the same framing.
+
+    Instance attributes:
+    sections -- Map headers (str) to contents.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    encode -- Return message in given framing.
+    """
+    def __init__(self, **kwargs):
+        """Initialize instance, kwargs are the same as of create_message."""
+        self.sections = kwargs
+        self._frames = {}
+
+    def encode(self, framing=TEXT_FRAMING):
+        """
+        Return message in given framing.
+
+        Args:
+        framing -- Key of ENCODERS.
+
+        Returns:
+        Encoded message, the same object is returned for each call with the same framing.
+        """
+        try:
+            return self._frames[framing]
+        except KeyError:
+            frame = self._frames[framing] = ENCODERS[framing](**self.sections)
+            return frame
+
+
+def encode_varint(value):
+    """Encode unsigned integer as varint."""
+    data = bytearray()
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def decode_varint(data, pos=0):
+    """
+    Decode varint from data.
+
+    Args:
+    data -- Bytes-like object.
+    pos -- Position where varint starts.
+
+    Returns:
+    Tuple (decoded integer, position after varint).
+
+    Raises:
+    IndexError -- Data ends before varint.
+    CorruptFrameError -- Varint is longer than MAX_VARINT_LENGTH bytes.
+    """
+    result = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+        if shift >= 7 * MAX_VARINT_LENGTH:
+            raise CorruptFrameError('Varint is longer than {} bytes.'.format(MAX_VARINT_LENGTH))
+
+
+class Registry(dict):
+    """
+    Map types of messages to handlers registered with decorator.
+
+    Handlers are registered when module defining them is imported, so registry is ready without looking at members of
+    modules and it's used directly as dispatch table.
+
+    Instance attributes:
+    sections -- Map types of messages to tuples of headers of sections their handlers need, see check.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    register -- Return decorator registering handler of message type.
+    check -- Return handler of received message.
+    """
+    def __init__(self, *args, **kwargs):
+        """Initialize instance, arguments are the same as of dict."""
+        super().__init__(*args, **kwargs)
+        self.sections = {}
+
+    def register(self, msg_type, sections=()):
+        """
+        Return decorator registering handler of message type.
+
+        Args:
+        msg_type -- Type of message (bytes).
+        sections -- Headers of sections handler reads without checking if they are in message.
+
+        Raises:
+        ValueError -- Handler of the type is already registered.
+        """
+        def decorator(handler):
+            if msg_type in self:
+                raise ValueError('Handler of {!r} is already registered.'.format(msg_type))
+            self[msg_type] = handler
+            if sections:
+                self.sections[msg_type] = tuple(sections)
+            return handler
+        return decorator
+
+    def check(self, message):
+        """
+        Return handler of received message.
+
+        Only message is checked, handler isn't called, so exceptions raised by handlers aren't taken for malformed
+        messages.
+
+        Args:
+        message -- Received message, see FrameParser.
+
+        Returns:
+        Tuple (type of message, its handler).
+
+        Raises:
+        MalformedMessageError -- Message has no type, unknown type or lacks section its handler needs.
+        """
+        msg_type = message.get(b'type')
+        handler = self.get(msg_type)
+        if handler is None:
+            raise MalformedMessageError('Type of message {!r} is unknown.'.format(msg_type))
+        for header in self.sections.get(msg_type, ()):
+            if header not in message:
+                raise MalformedMessageError('Message {!r} has no section {!r}.'.format(msg_type, header))
+        return msg_type, handler
+
+
+def get_handlers(module, pattern='recv_'):
+    """
+    Read handlers of messages from module by names of functions.
+
+    Function reads handlers from module. It treats each function with name starting with pattern as handler and rest of
+    its name is considered as message type. Modules of server and client register their handlers in Registry instead,
+    function is kept for modules which don't.
+
+    Args:
+    module -- Module to read handlers from.
+    pattern -- Beginning of function name.
+
+    Returns:
+    Map types of messages to handlers.
+    """
+    functions = inspect.getmembers(module, inspect.isfunction)
+    handlers = {}
+    for name, f in functions:
+        if name.startswith(pattern):
+            msg_type = name[len(pattern):]
+            handlers[msg_type.encode()] = f
+    return handlers
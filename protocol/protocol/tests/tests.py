@@ -0,0 +1,278 @@
+import asyncio
+import unittest
+import unittest.mock as um
+from .. import message
+from .. import loops
+
+
+class TestMessage(unittest.TestCase):
+    def test_cut_message(self):
+        all_msg_lines = (
+            [
+                b'#type\n',
+                b'text\\\n',
+                b'\n',
+                b'#content\n',
+                b'message\n',
+                b'#\n',
+            ],
+            [
+                b'#type\n',
+                b'#\n',
+            ],
+            [
+                b'#\n',
+            ]
+        )
+        real_results = (
+            {
+                b'type': b'text\n',
+                b'content': b'message',
+            },
+            {
+                b'type': b'',
+            },
+            {}
+        )
+
+        for msg_lines, real_result in zip(all_msg_lines, real_results):
+            with self.subTest(msg_lines=msg_lines, real_result=real_result):
+                self.assertDictEqual(message.cut_message(msg_lines), real_result)
+
+    def test_cut_frame(self):
+        frames = (
+            b'#type\ntext\\\n\n#content\nmessage\n#\n',
+            b'#type\n#\n',
+            b'#\n',
+            b'#text\n\\#1\\\nline\n#\n',
+        )
+        real_results = (
+            {b'type': b'text\n', b'content': b'message'},
+            {b'type': b''},
+            {},
+            {b'text': b'#1\nline'},
+        )
+
+        for frame, real_result in zip(frames, real_results):
+            with self.subTest(frame=frame, real_result=real_result):
+                self.assertDictEqual(message.cut_frame(frame), real_result)
+
+    def test_frame_parser(self):
+        """Test if messages are found in chunks split at every possible position."""
+        msgs = [
+            dict(type=b'text', text=b'Line 1.\n#Line 2.\n'),
+            dict(type=b'active'),
+            dict(),
+            dict(type=b'hello', nick=b'user'),
+        ]
+        data = b''.join(message.create_message(**msg) for msg in msgs)
+        real_result = [{k.encode(): v for k, v in msg.items()} for msg in msgs]
+
+        for chunk_size in range(1, len(data) + 1):
+            with self.subTest(chunk_size=chunk_size):
+                parser = message.FrameParser()
+                result = []
+                for i in range(0, len(data), chunk_size):
+                    result.extend(parser.feed(data[i:i + chunk_size]))
+                self.assertEqual(result, real_result)
+                self.assertEqual(parser.buffer, b'')
+
+    def test_binary_message(self):
+        """Test if binary messages round trip and can be mixed with text messages."""
+        msgs = [
+            dict(type=b'text', text=b'Line 1.\n#Line 2.\n' * 100),
+            dict(type=b'hello', custom=b''),
+            dict(),
+        ]
+        data = b''.join(
+            (message.create_binary_message if i % 2 else message.create_message)(**msg)
+            for i, msg in enumerate(msgs * 2)
+        )
+        real_result = [{k.encode(): v for k, v in msg.items()} for msg in msgs * 2]
+
+        for chunk_size in (1, 7, len(data)):
+            with self.subTest(chunk_size=chunk_size):
+                parser = message.FrameParser()
+                result = []
+                for i in range(0, len(data), chunk_size):
+                    result.extend(parser.feed(data[i:i + chunk_size]))
+                self.assertEqual(result, real_result)
+
+    def test_deflated_message(self):
+        """Test if long messages are compressed, short ones stay binary and both are parsed like binary messages."""
+        long = dict(type=b'text', text=b'2017-05-01 12:00:00 INFO worker-3 request handled in 12 ms\n' * 20)
+        short = dict(type=b'text', text=b'Hi.\n')
+        compressed = message.create_deflated_message(**long)
+        self.assertEqual(compressed[0], message.DEFLATE_MAGIC)
+        self.assertLess(len(compressed), len(message.create_binary_message(**long)) // 10)
+        self.assertEqual(message.create_deflated_message(**short), message.create_binary_message(**short))
+        data = compressed + message.create_deflated_message(**short) + compressed
+        real_result = [{k.encode(): v for k, v in msg.items()} for msg in (long, short, long)]
+        for chunk_size in (1, 7, len(data)):
+            with self.subTest(chunk_size=chunk_size):
+                parser = message.FrameParser()
+                result = []
+                for i in range(0, len(data), chunk_size):
+                    result.extend(parser.feed(data[i:i + chunk_size]))
+                self.assertEqual(result, real_result)
+        lazy, = message.FrameParser(lazy=True).feed(compressed)
+        self.assertEqual(lazy, real_result[0])
+
+        with self.assertRaises(message.FrameTooLargeError):
+            message.FrameParser(max_size=len(compressed)).feed(compressed)
+        with self.assertRaises(message.CorruptFrameError):
+            message.FrameParser().feed(bytes([message.DEFLATE_MAGIC, 4]) + b'\xff' * 4)
+        bomb = message.create_deflated_message(type=b'text', text=b'x' * message.MAX_INFLATED_SIZE)
+        self.assertLess(len(bomb), message.MAX_INFLATED_SIZE // 100)
+        with self.assertRaises(message.FrameTooLargeError):
+            message.FrameParser().feed(bomb)
+        for parser, frame in ((message.FrameParser(binary=False), message.create_binary_message(**short)),
+                              (message.FrameParser(deflate=False), compressed)):
+            with self.subTest(frame=frame[:1]):
+                with self.assertRaises(message.CorruptFrameError):
+                    parser.feed(frame)
+
+    def test_malformed_binary_message(self):
+        """Test if unknown header ids and sections running past end of message are refused."""
+        for body in (b'\x7f\x01x', b'\x03\x05ab', b'\x00\x05ab', b'\x03'):
+            with self.subTest(body=body):
+                frame = b'\x00' + message.encode_varint(len(body)) + body
+                with self.assertRaises(message.CorruptFrameError):
+                    message.FrameParser().feed(frame)
+                with self.assertRaises(message.CorruptFrameError):
+                    message.FrameParser(lazy=True).feed(frame)
+
+    def test_max_size(self):
+        """Test if messages longer than max_size are refused before they are buffered whole."""
+        small = message.create_message(type=b'text', text=b'Hi.\n')
+        parser = message.FrameParser(max_size=len(small))
+        self.assertEqual(parser.feed(small), [{b'type': b'text', b'text': b'Hi.\n'}])
+
+        large = message.create_message(type=b'text', text=b'x' * 100)
+        parser = message.FrameParser(max_size=50)
+        self.assertEqual(parser.feed(large[:40]), [])
+        with self.assertRaises(message.FrameTooLargeError):
+            parser.feed(large[40:60])
+        parser = message.FrameParser(max_size=50)
+        with self.assertRaises(message.FrameTooLargeError):
+            parser.feed(large)
+
+        parser = message.FrameParser(max_size=50)
+        with self.assertRaises(message.FrameTooLargeError):
+            parser.feed(message.create_binary_message(type=b'text', text=b'x' * 100)[:5])
+        parser = message.FrameParser(max_size=4)
+        self.assertEqual(parser.feed(b'\x00\xff\xff'), [])
+        with self.assertRaises(message.FrameTooLargeError):
+            parser.feed(b'\xff\xff\xff')
+
+    def test_lazy_message(self):
+        """Test if lazy messages equal cut messages and their sections are forwarded without unescaping."""
+        sections = {'type': b'text', 'text': b'# Line\nanother \\line\n', 'zz': b''}
+        for create in (message.create_message, message.create_binary_message):
+            with self.subTest(create=create.__name__):
+                frame = create(**sections)
+                lazy, = message.FrameParser(lazy=True).feed(frame)
+                self.assertIsInstance(lazy, message.LazyMessage)
+                self.assertIn(b'zz', lazy)
+                self.assertNotIn(b'room', lazy)
+                self.assertEqual(create(**{header.decode(): message.payload(lazy, header) for header in lazy}), frame)
+                text = message.payload(lazy, b'text')
+                self.assertIsInstance(text, message.Section)
+                self.assertIsNone(text._content)
+                self.assertEqual(lazy, message.FrameParser().feed(frame)[0])
+
+        lazy, = message.FrameParser(lazy=True).feed(message.create_message(text=b'#\n'))
+        forwarded = message.create_binary_message(text=message.payload(lazy, b'text'))
+        self.assertEqual(message.FrameParser().feed(forwarded), [{b'text': b'#\n'}])
+
+    def test_varint(self):
+        for value, encoded in ((0, b'\x00'), (127, b'\x7f'), (128, b'\x80\x01'), (300, b'\xac\x02')):
+            with self.subTest(value=value):
+                self.assertEqual(message.encode_varint(value), encoded)
+                self.assertEqual(message.decode_varint(encoded), (value, len(encoded)))
+        self.assertEqual(message.decode_varint(message.encode_varint(2 ** 64 - 1)), (2 ** 64 - 1, 10))
+        with self.assertRaises(message.CorruptFrameError):
+            message.decode_varint(b'\xff' * 10 + b'\x01')
+
+    def test_endless_length_prefix(self):
+        """Test if length prefix which doesn't end is refused after MAX_VARINT_LENGTH bytes."""
+        parser = message.FrameParser()
+        self.assertEqual(parser.feed(b'\x00' + b'\xff' * 5), [])
+        with self.assertRaises(message.CorruptFrameError):
+            parser.feed(b'\xff' * 5)
+
+    def test_pending_length_prefix(self):
+        """Test if length prefix of binary message arriving in many chunks is decoded once."""
+        frame = message.create_binary_message(type=b'text', text=b'x' * 1000)
+        parser = message.FrameParser()
+        with um.patch.object(message, 'decode_varint', wraps=message.decode_varint) as decode:
+            for i in range(0, len(frame) - 10, 10):
+                self.assertEqual(parser.feed(frame[i:i + 10]), [])
+            self.assertEqual(parser.feed(frame[i + 10:]), [{b'type': b'text', b'text': b'x' * 1000}])
+        self.assertEqual([call.args[0] is parser.buffer for call in decode.call_args_list].count(True), 1)
+
+    def test_create_message(self):
+        args = (
+            dict(type=b'text', content=b'Text message.\n'),
+            dict(type=b''),
+            dict(),
+        )
+        real_msgs = (
+            b'#type\ntext\n#content\nText message.\\\n\n#\n',
+            b'#type\n\n#\n',
+            b'#\n',
+        )
+
+        for arg, real_msg in zip(args, real_msgs):
+            with self.subTest(arg=arg, real_msg=real_msg):
+                self.assertEqual(message.create_message(**arg), real_msg)
+
+    def test_get_handlers(self):
+        mock_module = um.Mock()
+        mock_module.f = lambda: None
+        mock_module.recv_hello = lambda: None
+        mock_module.recv_text = lambda: None
+        mock_module.recvhi = lambda: None
+
+        handlers = message.get_handlers(mock_module)
+        self.assertDictEqual(handlers, {b'hello': mock_module.recv_hello, b'text': mock_module.recv_text})
+        mock_module.send_text = lambda: None
+        self.assertDictEqual(message.get_handlers(mock_module, 'send_'), {b'text': mock_module.send_text})
+
+
+class TestRegistry(unittest.TestCase):
+    def test_register(self):
+        """Test if decorator registers handler unchanged and refuses second handler of the same type."""
+        registry = message.Registry()
+
+        @registry.register(b'text')
+        def recv_text():
+            pass
+
+        self.assertIs(registry[b'text'], recv_text)
+        self.assertRaises(ValueError, registry.register(b'text'), lambda: None)
+
+    def test_check(self):
+        """Test if handler is returned for known type with its sections and other messages are malformed."""
+        registry = message.Registry()
+
+        @registry.register(b'join', sections=(b'room',))
+        def recv_join():
+            pass
+
+        lazy, = message.FrameParser(lazy=True).feed(message.create_message(type=b'join', room=b'r'))
+        self.assertEqual(registry.check(lazy), (b'join', recv_join))
+        for sections in ({'type': b'part', 'room': b'r'}, {'room': b'r'}, {'type': b'join'}):
+            with self.subTest(sections=sections):
+                lazy, = message.FrameParser(lazy=True).feed(message.create_message(**sections))
+                with self.assertRaises(message.MalformedMessageError):
+                    registry.check(lazy)
+
+
+class TestLoops(unittest.TestCase):
+    def test_get_loop_factory(self):
+        self.assertIs(loops.get_loop_factory('asyncio'), asyncio.new_event_loop)
+        self.assertRaises(ValueError, loops.get_loop_factory, 'unknown')
+        with um.patch.dict('sys.modules', {'uvloop': None}):
+            self.assertIs(loops.get_loop_factory('auto'), asyncio.new_event_loop)
+            self.assertRaises(ImportError, loops.get_loop_factory, 'uvloop')
@@ -0,0 +1,11 @@
+from setuptools import setup
+
+setup(
+    name='chat-protocol',
+    version='1.0',
+    description='Message protocol and event loops shared by chat server and client.',
+    url='https://github.com/worstof3/chat',
+    author='Łukasz Karpiński',
+    packages=['protocol'],
+    test_suite='protocol.tests',
+)
@@ -0,0 +1,856 @@
+"""
+Benchmarks of server hot paths.
+
+Most benchmarks don't open any sockets, clients get writers which only count written bytes, so results show cost of
+server code alone. Event loops are compared over real connections on localhost, the server and its clients share one
+loop. Run with python -m server.benchmark.
+
+Classes:
+NullWriter -- Writer discarding everything written to it.
+
+Functions:
+make_room -- Create clients registered under unique nicks.
+bench_broadcast -- Measure how many text messages per second are broadcast to a room.
+bench_rooms -- Measure how many text messages per second are sent to rooms.
+bench_active -- Measure how many active users listings per second are answered.
+bench_framing -- Measure how fast large messages are created and parsed in given framing.
+bench_forward -- Measure how fast large messages are parsed and encoded again for forwarding.
+bench_journal -- Measure how many messages per second are appended to persistent log.
+start_server -- Start server listening on free localhost port.
+bench_accept -- Measure how many connections per second server accepts on given event loop.
+bench_loop_broadcast -- Measure broadcast throughput over localhost connections on given event loop.
+bench_storm -- Measure delivery rate and write calls when every client sends messages at once.
+bench_metrics -- Measure how many text messages per second one connection handles with and without metrics.
+chat_corpus -- Return texts of generated chat resembling real one.
+bench_compression -- Measure bytes each client gets per message of chat and broadcast rate in given framing.
+read_documents -- Return messages of documents, paragraphs of each file are its messages.
+corpus_paths -- Return paths of conversations of chat corpus shipped with server sources.
+train_dictionary -- Return preset dictionary of deflate trained on documents.
+build_dictionary -- Return preset dictionary of deflate trained on chat corpus, message.ZDICT is its output.
+deflate_savings -- Return share of bytes saved by compressing binary text messages with dictionary.
+bench_dictionary -- Train dictionary on half of documents and measure savings on the other half.
+main -- Main script.
+"""
+import asyncio
+import glob
+import gzip
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+import zlib
+from argparse import ArgumentParser
+from protocol import message
+from protocol import loops
+from . import server
+from . import journal
+from . import metrics
+from . import outbound
+from .roster import Roster
+
+ROOM_SIZES = (10, 100, 1000, 10000)
+PASTE_SIZES = (1024, 64 * 1024, 1024 * 1024)
+WORDS = (b'the be to of and a in that have I it for not on with he as you do at this but his by from they we say her '
+         b'she or an will my one all would there their what so up out if about who get which go me when make can like '
+         b'time no just him know take people into year your good some could them see other than then now look only '
+         b'come its over think also back after use two how our work first well way even new want because any these '
+         b'give day most us server client build test deploy branch commit merge release bug fix error log config '
+         b'database query cache request response latency thread memory disk network port socket python version '
+         b'update install docs review patch issue').split()
+PHRASES = (b'Hello everyone, how is it going?', b'Good morning everyone!', b'lol', b'ok', b'thanks :)', b'sounds good',
+           b'let me check', b'I\'m not sure', b'Does anyone know how to', b'have you tried', b'I think it\'s',
+           b'It doesn\'t work, ', b'Could you', b'what do you think about')
+CONNECT_TIMEOUT = 30
+LEVELS = (b'DEBUG', b'INFO', b'INFO', b'INFO', b'WARNING', b'ERROR')
+# Starts of bodies of compressed private and text messages, they end message.ZDICT.
+SECTION_HEADERS = b'\x01\x03msg\x02\x01\x04text\x03'
+# Directory of chat corpus, each file is one conversation and its paragraphs are messages prefixed with nick of sender.
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'corpus')
+
+
+class NullWriter:
+    """
+    Writer discarding everything written to it.
+
+    Instance attributes:
+    written -- Number of bytes written so far.
+    calls -- Number of write calls so far.
+
+    Methods:
+    write -- Count bytes of data.
+    writelines -- Count bytes of each data in list.
+    drain -- Coroutine returning immediately.
+    close -- Do nothing.
+    """
+    def __init__(self):
+        """Initialize instance."""
+        self.written = 0
+        self.calls = 0
+
+    def write(self, data):
+        """Count bytes of data."""
+        self.written += len(data)
+        self.calls += 1
+
+    def writelines(self, data):
+        """Count bytes of each data in list."""
+        self.written += sum(map(len, data))
+        self.calls += 1
+
+    async def drain(self):
+        """Coroutine returning immediately."""
+        pass
+
+    def close(self):
+        """Do nothing."""
+        pass
+
+
+def make_room(size, counters=None):
+    """
+    Create clients registered under unique nicks.
+
+    Clients are instances of a fresh Client subclass, so nicks don't leak to other rooms.
+
+    Args:
+    size -- Number of clients.
+    counters -- Metrics of clients, None turns metrics off.
+
+    Returns:
+    List of clients.
+    """
+    client_class = type('BenchClient', (server.Client,),
+                        {'_nicks_clients': {}, '_roster': Roster(), '_rooms_clients': {}, '_metrics': counters})
+    clients = []
+    for i in range(size):
+        client = client_class(None, NullWriter(), None, b'user%d' % i)
+        client.nicks_clients[client.nick] = client
+        client.roster.add(client.nick)
+        clients.append(client)
+    return clients
+
+
+def bench_broadcast(size, text=b'Hello everyone, how is it going?\n', duration=1.0):
+    """
+    Measure how many text messages per second are broadcast to a room.
+
+    Outbound queues are flushed after every batch of messages, so they never overflow.
+
+    Args:
+    size -- Number of clients in the room.
+    text -- Text of each message.
+    duration -- Minimal time of measurement in seconds.
+
+    Returns:
+    Tuple (messages per second, frame writes per second).
+    """
+    clients = make_room(size)
+    sender = clients[0]
+    message = {b'type': b'text', b'text': text}
+    sent = 0
+    batch = max(1, 10000 // size)
+    start = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            server.recv_text(message, sender)
+        for client in clients:
+            client.outbound.flush()
+        sent += batch
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            break
+    return sent / elapsed, sent * (size - 1) / elapsed
+
+
+def bench_rooms(users, rooms, duration=1.0):
+    """
+    Measure how many text messages per second are sent to rooms.
+
+    Users are spread evenly over rooms and every message goes to room of its sender.
+
+    Args:
+    users -- Number of connected users.
+    rooms -- Number of rooms.
+    duration -- Minimal time of measurement in seconds.
+
+    Returns:
+    Messages per second.
+    """
+    clients = make_room(users)
+    for i, client in enumerate(clients):
+        client.join(b'room%d' % (i % rooms))
+    senders = clients[:rooms]
+    messages = [{b'type': b'text', b'text': b'Hello everyone!\n', b'room': b'room%d' % i} for i in range(rooms)]
+    sent = 0
+    start = time.perf_counter()
+    while True:
+        for sender, msg in zip(senders, messages):
+            server.recv_text(msg, sender)
+        for client in clients:
+            client.outbound.flush()
+        sent += rooms
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            break
+    return sent / elapsed
+
+
+def bench_active(users, prefix=b'', duration=1.0):
+    """
+    Measure how many active users listings per second are answered.
+
+    Args:
+    users -- Number of connected users.
+    prefix -- Only nicks starting with it are listed.
+    duration -- Minimal time of measurement in seconds.
+
+    Returns:
+    Listings per second.
+    """
+    clients = make_room(users)
+    sender = clients[0]
+    request = {b'type': b'active', b'nick': prefix} if prefix else {b'type': b'active'}
+    done = 0
+    start = time.perf_counter()
+    while True:
+        server.recv_active(sender, request)
+        sender.outbound.flush()
+        done += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            break
+    return done / elapsed
+
+
+def bench_framing(size, framing, duration=1.0):
+    """
+    Measure how fast large messages are created and parsed in given framing.
+
+    Text of messages looks like pasted log, lines of about 60 characters, some of them starting with #.
+
+    Args:
+    size -- Size of text of each message in bytes.
+    framing -- Key of message.ENCODERS.
+    duration -- Minimal time of measurement in seconds.
+
+    Returns:
+    Megabytes of text per second.
+    """
+    line = b'# 2017-05-01 12:00:00 INFO worker-3 request handled in 12 ms\n'
+    text = (line * (size // len(line) + 1))[:size]
+    encode = message.ENCODERS[framing]
+    parser = message.FrameParser()
+    done = 0
+    start = time.perf_counter()
+    while True:
+        parser.feed(encode(type=b'text', text=text))
+        done += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            break
+    return done * size / elapsed / 1e6
+
+
+def bench_forward(size, framing, lazy, duration=1.0):
+    """
+    Measure how fast large messages are parsed and encoded again for forwarding.
+
+    It's the path of text message through recv_text, message is encoded in the same framing it was received in.
+
+    Args:
+    size -- Size of text of each message in bytes.
+    framing -- Key of message.ENCODERS.
+    lazy -- If true, FrameParser is in lazy mode and text is forwarded with message.payload.
+    duration -- Minimal time of measurement in seconds.
+
+    Returns:
+    Megabytes of text per second.
+    """
+    line = b'# 2017-05-01 12:00:00 INFO worker-3 request handled in 12 ms\n'
+    text = (line * (size // len(line) + 1))[:size]
+    frame = message.ENCODERS[framing](type=b'text', text=text)
+    parser = message.FrameParser(lazy)
+    done = 0
+    start = time.perf_counter()
+    while True:
+        for received in parser.feed(frame):
+            message.OutgoingMessage(type=b'text', text=message.payload(received, b'text')).encode(framing)
+        done += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            break
+    return done * size / elapsed / 1e6
+
+
+def bench_journal(duration=1.0, flush_interval=journal.FLUSH_INTERVAL):
+    """
+    Measure how many messages per second are appended to persistent log.
+
+    Messages are appended in batches with a yield to event loop between them, like they come from clients, and log is
+    flushed in background. Longest time event loop spent in one batch shows if writes block it.
+
+    Args:
+    duration -- Minimal time of measurement in seconds.
+    flush_interval -- Seconds between writes of log.
+
+    Returns:
+    Tuple (messages per second, longest batch in milliseconds).
+    """
+    directory = tempfile.mkdtemp(prefix='chatjournal-')
+    msg = message.OutgoingMessage(type=b'text', text=b'user0: Hello everyone, how is it going?\n')
+
+    async def run():
+        log = journal.Journal(directory, flush_interval=flush_interval)
+        log.start()
+        appended = 0
+        longest = 0
+        start = time.perf_counter()
+        while True:
+            batch_start = time.perf_counter()
+            for _ in range(100):
+                log.append(msg)
+            appended += 100
+            await asyncio.sleep(0)
+            longest = max(longest, time.perf_counter() - batch_start)
+            elapsed = time.perf_counter() - start
+            if elapsed >= duration:
+                break
+        await log.flush()
+        elapsed = time.perf_counter() - start
+        log.close()
+        return appended / elapsed, longest * 1000
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        loop.close()
+        shutil.rmtree(directory)
+
+
+async def start_server(loop, outbound_options=None):
+    """
+    Start server listening on free localhost port.
+
+    Args:
+    loop -- Event loop of server.
+    outbound_options -- Keyword arguments of OutboundQueue of each client.
+
+    Returns:
+    Tuple (Server instance, port).
+    """
+    serverobj = server.Server(loop, server.RECV_HANDLERS, '127.0.0.1', 0, outbound_options)
+    serverobj.server = await asyncio.start_server(serverobj.con_handler, '127.0.0.1', 0)
+    return serverobj, serverobj.server.sockets[0].getsockname()[1]
+
+
+async def _wait_for_nicks(serverobj, clients, timeout=CONNECT_TIMEOUT):
+    """Wait until given number of clients registered nicks, raise RuntimeError after timeout seconds."""
+    deadline = time.monotonic() + timeout
+    while sum(client.nick is not None for client in serverobj.clients) < clients:
+        if time.monotonic() > deadline:
+            raise RuntimeError('Clients did not register nicks in {} seconds.'.format(timeout))
+        await asyncio.sleep(0.01)
+
+
+async def _stop_server(serverobj, writers):
+    """Close client connections and server."""
+    for writer in writers:
+        writer.close()
+    serverobj.stop_server()
+    await serverobj.server.wait_closed()
+    await asyncio.sleep(0.1)
+
+
+def bench_accept(loop_name, connections=1000, concurrency=100):
+    """
+    Measure how many connections per second server accepts on given event loop.
+
+    Connection counts as accepted when server created client for it.
+
+    Args:
+    loop_name -- One of loops.LOOPS.
+    connections -- Number of connections opened.
+    concurrency -- Number of connections opened at once.
+
+    Returns:
+    Connections per second.
+    """
+    async def run(loop):
+        serverobj, port = await start_server(loop)
+        writers = []
+        start = time.perf_counter()
+        for i in range(0, connections, concurrency):
+            opened = await asyncio.gather(*(asyncio.open_connection('127.0.0.1', port)
+                                            for _ in range(min(concurrency, connections - i))))
+            writers.extend(writer for _, writer in opened)
+        while len(serverobj.clients) < connections:
+            await asyncio.sleep(0)
+        elapsed = time.perf_counter() - start
+        await _stop_server(serverobj, writers)
+        return connections / elapsed
+
+    loop = loops.get_loop_factory(loop_name)()
+    try:
+        return loop.run_until_complete(run(loop))
+    finally:
+        loop.close()
+
+
+def bench_loop_broadcast(loop_name, clients=100, messages=1000):
+    """
+    Measure broadcast throughput over localhost connections on given event loop.
+
+    One client sends all messages, the measurement ends when every other client received all of them.
+
+    Args:
+    loop_name -- One of loops.LOOPS.
+    clients -- Number of connected clients.
+    messages -- Number of messages sent.
+
+    Returns:
+    Messages per second.
+    """
+    frame = message.create_message(type=b'text', text=b'user0: Hello everyone, how is it going?\n')
+
+    async def receive(reader, expected):
+        received = 0
+        while received < expected:
+            data = await reader.read(message.CHUNK_SIZE)
+            if not data:
+                break
+            received += len(data)
+
+    async def run(loop):
+        serverobj, port = await start_server(loop)
+        connections = []
+        for i in range(clients):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(message.create_message(type=b'hello', nick=b'user%d' % i))
+            connections.append((reader, writer))
+        await _wait_for_nicks(serverobj, clients)
+        receivers = [loop.create_task(receive(reader, messages * len(frame))) for reader, _ in connections[1:]]
+        sender = connections[0][1]
+        start = time.perf_counter()
+        for _ in range(messages):
+            sender.write(frame)
+        await asyncio.gather(*receivers)
+        elapsed = time.perf_counter() - start
+        await _stop_server(serverobj, [writer for _, writer in connections])
+        return messages / elapsed
+
+    loop = loops.get_loop_factory(loop_name)()
+    try:
+        return loop.run_until_complete(run(loop))
+    finally:
+        loop.close()
+
+
+def bench_storm(clients=1000, messages=1, window=0):
+    """
+    Measure delivery rate and write calls when every client sends messages at once.
+
+    Every client sends its messages right after all clients are connected, the measurement ends when every client
+    received messages of all others.
+
+    Args:
+    clients -- Number of connected clients.
+    messages -- Number of messages sent by each client.
+    window -- Seconds writer tasks wait for more frames, see OutboundQueue.
+
+    Returns:
+    Tuple (delivered frames per second, delivered frames per write call).
+    """
+    frame = message.create_message(type=b'text', text=b'storm: Hello everyone!\n')
+    expected = (clients - 1) * messages
+
+    async def receive(reader):
+        received = 0
+        while received < expected * len(frame):
+            data = await reader.read(message.CHUNK_SIZE)
+            if not data:
+                break
+            received += len(data)
+
+    async def run(loop):
+        # Queues are only made longer than default, so that no frame of the storm is dropped.
+        high_water = max(outbound.HIGH_WATER, 2 * expected * len(frame))
+        serverobj, port = await start_server(loop, {'high_water': high_water, 'window': window})
+        connections = []
+        for i in range(clients):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(message.create_message(type=b'hello', nick=b'user%d' % i))
+            connections.append((reader, writer))
+        await _wait_for_nicks(serverobj, clients)
+        receivers = [loop.create_task(receive(reader)) for reader, _ in connections]
+        start = time.perf_counter()
+        for _, writer in connections:
+            writer.write(frame * messages)
+        await asyncio.gather(*receivers)
+        elapsed = time.perf_counter() - start
+        writes = serverobj.outbound_stats()['writes']
+        await _stop_server(serverobj, [writer for _, writer in connections])
+        return clients * expected / elapsed, clients * expected / writes
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run(loop))
+    finally:
+        loop.close()
+
+
+def bench_metrics(enabled, size=10, messages=100000):
+    """
+    Measure how many text messages per second one connection handles with and without metrics.
+
+    Messages are read by Client.handle_connection from in-memory reader in chunks of 100 and broadcast to room.
+
+    Args:
+    enabled -- If true, metrics are turned on.
+    size -- Number of clients in the room.
+    messages -- Number of messages handled.
+
+    Returns:
+    Messages per second.
+    """
+    clients = make_room(size, metrics.Metrics() if enabled else None)
+    sender = clients[0]
+    chunk = message.create_message(type=b'text', text=b'user0: Hello everyone, how is it going?\n') * 100
+    chunks = messages // 100
+
+    class Reader:
+        async def read(self, n=-1):
+            nonlocal chunks
+            for client in clients:
+                client.outbound.flush()
+            if not chunks:
+                return b''
+            chunks -= 1
+            return chunk
+
+    sender.reader = Reader()
+    sender.recv_handlers = server.RECV_HANDLERS
+    loop = asyncio.new_event_loop()
+    try:
+        start = time.perf_counter()
+        loop.run_until_complete(sender.handle_connection())
+        elapsed = time.perf_counter() - start
+    finally:
+        loop.close()
+    return messages // 100 * 100 / elapsed
+
+
+def chat_corpus(count=10000, seed=0):
+    """
+    Return texts of generated chat resembling real one.
+
+    Most messages are short lines of conversation, some are longer explanations and about one in forty is pasted log
+    or traceback of a few kilobytes. Texts start with nick of sender like those sent by client.
+
+    Args:
+    count -- Number of texts.
+    seed -- Seed of random generator, the same seed gives the same corpus.
+
+    Returns:
+    List of texts.
+    """
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        nick = b'user%d: ' % rng.randrange(50)
+        kind = rng.random()
+        if kind < 0.025:
+            lines = []
+            for _ in range(rng.randrange(10, 80)):
+                lines.append(b'2017-05-01 12:%02d:%02d,%03d %s worker-%d %s %s handled in %d ms\n' % (
+                    rng.randrange(60), rng.randrange(60), rng.randrange(1000), rng.choice(LEVELS), rng.randrange(8),
+                    rng.choice(WORDS), b'/api/v1/' + rng.choice(WORDS), rng.randrange(1, 500)))
+            text = nick + b'here is the log\n' + b''.join(lines)
+        elif kind < 0.04:
+            frames = [b'  File "/usr/lib/python3/site-packages/%s/%s.py", line %d, in %s\n    %s = self.%s(%s)\n' % (
+                rng.choice(WORDS), rng.choice(WORDS), rng.randrange(1, 2000), rng.choice(WORDS), rng.choice(WORDS),
+                rng.choice(WORDS), rng.choice(WORDS)) for _ in range(rng.randrange(3, 15))]
+            text = nick + b'Traceback (most recent call last):\n' + b''.join(frames) + b'KeyError: \'%s\'\n' % (
+                rng.choice(WORDS))
+        elif kind < 0.3:
+            text = nick + rng.choice(PHRASES) + b'\n'
+        else:
+            words = rng.choices(WORDS, k=rng.randrange(3, 40) if kind < 0.9 else rng.randrange(40, 120))
+            text = nick + b' '.join(words).capitalize() + rng.choice((b'.', b'?', b'!', b'')) + b'\n'
+        texts.append(text)
+    return texts
+
+
+def bench_compression(framing, corpus, size=100):
+    """
+    Measure bytes each client gets per message of chat and broadcast rate in given framing.
+
+    Every text of corpus is broadcast to a room, so compressed messages are compressed once for the whole room.
+
+    Args:
+    framing -- Framing of clients, key of message.ENCODERS.
+    corpus -- Texts of messages, see chat_corpus.
+    size -- Number of clients in the room.
+
+    Returns:
+    Tuple (bytes per message received by one client, messages per second).
+    """
+    clients = make_room(size)
+    for client in clients:
+        client.framing = framing
+    sender, receiver = clients[0], clients[1]
+    start = time.perf_counter()
+    for text in corpus:
+        server.recv_text({b'type': b'text', b'text': text}, sender)
+        for client in clients:
+            client.outbound.flush()
+    elapsed = time.perf_counter() - start
+    return receiver.writer.written / len(corpus), len(corpus) / elapsed
+
+
+def read_documents(paths):
+    """
+    Return messages of documents, paragraphs of each file are its messages.
+
+    Files ending with .gz are decompressed. Files with the same content are read once, packages often ship copies of
+    the same text.
+
+    Args:
+    paths -- Paths of files.
+
+    Returns:
+    List of documents, each is list of messages.
+    """
+    documents, seen = [], set()
+    for path in paths:
+        with open(path, 'rb') as file:
+            data = file.read()
+        if path.endswith('.gz'):
+            data = gzip.decompress(data)
+        if data not in seen:
+            seen.add(data)
+            documents.append([paragraph.strip() + b'\n' for paragraph in re.split(rb'\n\s*\n', data)
+                              if paragraph.strip()])
+    return documents
+
+
+def corpus_paths():
+    """Return paths of conversations of chat corpus shipped with server sources, sorted by name."""
+    return sorted(glob.glob(os.path.join(CORPUS_DIR, '*.txt')))
+
+
+def train_dictionary(documents, size=2048, max_words=4, min_documents=2, max_length=32):
+    """
+    Return preset dictionary of deflate trained on documents, it ends with SECTION_HEADERS.
+
+    Candidates are runs of up to max_words words found in at least min_documents documents, so strings repeated only
+    by one document don't get in. They are ranked by number of documents times length, roughly bytes they save, and
+    picked until dictionary has size bytes, strings contained in picked ones are skipped. The most valuable ones are at
+    the end, deflate reaches them with the shortest distances.
+
+    Args:
+    documents -- List of documents, each is list of messages, see read_documents.
+    size -- Size of dictionary in bytes, the last string can exceed it.
+    max_words -- Maximal number of words of one string.
+    min_documents -- Minimal number of documents string has to be found in.
+    max_length -- Maximal length of one string in bytes.
+
+    Returns:
+    Dictionary.
+    """
+    counts = {}
+    for document in documents:
+        found = set()
+        for text in document:
+            words = re.findall(rb'\S+\s*', text)
+            for length in range(1, max_words + 1):
+                for i in range(len(words) - length + 1):
+                    found.add(b''.join(words[i:i + length]))
+        for string in found:
+            counts[string] = counts.get(string, 0) + 1
+    ranked = sorted(((count * len(string), string) for string, count in counts.items()
+                     if count >= min_documents and 4 <= len(string) <= max_length), reverse=True)
+    picked, total = [], 0
+    for _, string in ranked:
+        if total >= size:
+            break
+        if not any(string in other for other in picked):
+            picked.append(string)
+            total += len(string)
+    return b''.join(reversed(picked)) + SECTION_HEADERS
+
+
+def build_dictionary(paths=None):
+    """
+    Return preset dictionary of deflate trained on chat corpus, message.ZDICT is its output.
+
+    Args:
+    paths -- Paths of conversations, see read_documents, None means corpus_paths().
+
+    Returns:
+    Dictionary.
+    """
+    return train_dictionary(read_documents(corpus_paths() if paths is None else paths))
+
+
+def deflate_savings(texts, zdict):
+    """
+    Return share of bytes saved by compressing binary text messages with dictionary.
+
+    Messages are compressed like create_deflated_message does, short ones and those which don't get shorter are sent
+    as binary messages.
+
+    Args:
+    texts -- Texts of messages.
+    zdict -- Preset dictionary, empty one compresses without dictionary.
+
+    Returns:
+    Saved bytes divided by size of binary messages.
+    """
+    binary = deflated = 0
+    for text in texts:
+        frame = message.create_binary_message(type=b'text', text=text)
+        length, body = message.decode_varint(frame, 1)
+        binary += len(frame)
+        if length < message.DEFLATE_THRESHOLD:
+            deflated += len(frame)
+            continue
+        compressor = zlib.compressobj(message.DEFLATE_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=zdict)
+        compressed = compressor.compress(frame[body:]) + compressor.flush()
+        if len(compressed) + 1 >= length:
+            deflated += len(frame)
+        else:
+            deflated += 1 + len(message.encode_varint(len(compressed))) + len(compressed)
+    return 1 - deflated / binary
+
+
+def bench_dictionary(paths=None):
+    """
+    Train dictionary on half of documents and measure savings on the other half.
+
+    Documents are split alternately, so dictionary is measured on conversations it wasn't trained on. Generated chat is
+    measured too, no dictionary was built from it.
+
+    Args:
+    paths -- Paths of conversations, see read_documents, None means corpus_paths().
+
+    Returns:
+    Tuple (trained dictionary, dictionary mapping names of dictionaries to tuples (saving on held out documents,
+    saving on generated chat)).
+    """
+    documents = read_documents(corpus_paths() if paths is None else paths)
+    trained = train_dictionary(documents[::2])
+    held_out = [text for document in documents[1::2] for text in document]
+    corpus = chat_corpus()
+    savings = {name: (deflate_savings(held_out, zdict), deflate_savings(corpus, zdict))
+               for name, zdict in (('none', b''), ('ZDICT', message.ZDICT), ('trained', trained))}
+    return trained, savings
+
+
+def main():
+    parser = ArgumentParser(description='Chat server benchmarks.')
+    parser.add_argument('--duration', type=float, default=1.0, help='Time of each measurement in seconds.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=ROOM_SIZES, help='Room sizes to measure.')
+    parser.add_argument('--paste-sizes', type=int, nargs='+', default=PASTE_SIZES,
+                        help='Sizes of messages used to measure framings.')
+    parser.add_argument('--loops', choices=loops.LOOPS[1:], nargs='*', default=loops.LOOPS[1:],
+                        help='Event loops to compare, loops which are not installed are skipped.')
+    parser.add_argument('--connections', type=int, default=1000, help='Connections opened to measure accept rate.')
+    parser.add_argument('--clients', type=int, default=100, help='Clients receiving broadcast over localhost.')
+    parser.add_argument('--storm-clients', type=int, default=1000, help='Clients sending messages at once.')
+    parser.add_argument('--windows', type=int, nargs='+', default=(0, 200, 1000),
+                        help='Write windows in microseconds compared in storm.')
+    parser.add_argument('--corpus', nargs='+',
+                        help='Conversations, paragraphs are messages, chat corpus of server sources by default. '
+                             'Dictionary of deflate is trained on half of them and compared with ZDICT on the other '
+                             'half.')
+    parser.add_argument('--zdict-out', help='File dictionary trained on all conversations is written to.')
+    args = parser.parse_args()
+
+    print('{:>8} {:>14} {:>16}'.format('clients', 'messages/s', 'writes/s'))
+    for size in args.sizes:
+        messages, writes = bench_broadcast(size, duration=args.duration)
+        print('{:>8} {:>14.0f} {:>16.0f}'.format(size, messages, writes))
+
+    print()
+    print('{:>8} {:>14} {:>16}'.format('users', 'rooms', 'messages/s'))
+    for size in args.sizes:
+        for rooms in (1, 10, 100):
+            if rooms <= size:
+                print('{:>8} {:>14} {:>16.0f}'.format(size, rooms, bench_rooms(size, rooms, args.duration)))
+
+    print()
+    print('{:>8} {:>14} {:>16}'.format('users', 'all/s', 'prefix/s'))
+    for size in args.sizes:
+        everyone = bench_active(size, duration=args.duration)
+        prefixed = bench_active(size, b'user1', args.duration)
+        print('{:>8} {:>14.0f} {:>16.0f}'.format(size, everyone, prefixed))
+
+    print()
+    print('{:>8} {:>14} {:>16}'.format('bytes', 'text MB/s', 'binary MB/s'))
+    for size in args.paste_sizes:
+        text = bench_framing(size, message.TEXT_FRAMING, args.duration)
+        binary = bench_framing(size, message.BINARY_FRAMING, args.duration)
+        print('{:>8} {:>14.1f} {:>16.1f}'.format(size, text, binary))
+
+    print()
+    print('{:>8} {:>14} {:>16} {:>16}'.format('bytes', 'framing', 'eager MB/s', 'lazy MB/s'))
+    for size in args.paste_sizes:
+        for framing in (message.TEXT_FRAMING, message.BINARY_FRAMING):
+            eager = bench_forward(size, framing, False, args.duration)
+            lazy = bench_forward(size, framing, True, args.duration)
+            print('{:>8} {:>14} {:>16.1f} {:>16.1f}'.format(size, framing.decode(), eager, lazy))
+
+    print()
+    print('{:>8} {:>14} {:>16}'.format('log', 'messages/s', 'longest ms'))
+    messages, longest = bench_journal(args.duration)
+    print('{:>8} {:>14.0f} {:>16.2f}'.format('journal', messages, longest))
+
+    print()
+    print('{:>8} {:>14} {:>16}'.format('loop', 'accepts/s', 'messages/s'))
+    for loop_name in args.loops:
+        try:
+            loops.get_loop_factory(loop_name)
+        except ImportError:
+            print('{:>8} {:>14} {:>16}'.format(loop_name, '-', '-'))
+            continue
+        accepts = bench_accept(loop_name, args.connections)
+        messages = bench_loop_broadcast(loop_name, args.clients)
+        print('{:>8} {:>14.0f} {:>16.0f}'.format(loop_name, accepts, messages))
+
+    print()
+    print('{:>8} {:>14} {:>16}'.format('metrics', 'messages/s', 'overhead %'))
+    disabled = bench_metrics(False)
+    enabled = bench_metrics(True)
+    print('{:>8} {:>14.0f} {:>16}'.format('off', disabled, '-'))
+    print('{:>8} {:>14.0f} {:>16.1f}'.format('on', enabled, (disabled / enabled - 1) * 100))
+
+    print()
+    print('{:>8} {:>14} {:>16} {:>16}'.format('framing', 'bytes/message', 'messages/s', 'saved %'))
+    corpus = chat_corpus()
+    binary, _ = bench_compression(message.BINARY_FRAMING, corpus)
+    for framing in (message.TEXT_FRAMING, message.BINARY_FRAMING, message.DEFLATE):
+        received, rate = bench_compression(framing, corpus)
+        print('{:>8} {:>14.1f} {:>16.0f} {:>16.1f}'.format(framing.decode(), received, rate,
+                                                          (1 - received / binary) * 100))
+
+    _, savings = bench_dictionary(args.corpus)
+    print()
+    print('{:>8} {:>14} {:>16}'.format('zdict', 'held out %', 'generated %'))
+    for name, (held_out, generated) in savings.items():
+        print('{:>8} {:>14.1f} {:>16.1f}'.format(name, held_out * 100, generated * 100))
+    if args.zdict_out is not None:
+        with open(args.zdict_out, 'wb') as file:
+            file.write(build_dictionary(args.corpus))
+
+    print()
+    print('{:>8} {:>14} {:>16}'.format('window', 'frames/s', 'frames/write'))
+    for window in args.windows:
+        frames, per_write = bench_storm(args.storm_clients, window=window / 1e6)
+        print('{:>8} {:>14.0f} {:>16.1f}'.format(window, frames, per_write))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Module defines presence layer connecting servers on different hosts into a mesh.
+
+Every node listens for other nodes on its own address (node id) and is given ids of all other nodes, so they form a
+full mesh. There is exactly one connection between each pair of nodes, it's opened by the node with smaller id and
+reopened when it breaks. Node forwards messages of its own clients once to every peer and never forwards messages it
+got from peers, so in full mesh every message crosses each link at most once, whatever number of clients nodes have.
+
+Messages between nodes are in binary format from message module, nodes understand the following types:
+peer -- First message on connection, node section is id of connecting node.
+claim -- Node asks if nick can be taken, peer answers with claimed message with result section ok or taken.
+join, leave -- Node informs that nick was taken or released by its client.
+Every other message is handed to server with Server.deliver.
+
+Nick is taken when all connected peers agreed on it. Peer which is claiming the same nick agrees only if claiming node
+has smaller id, so one of simultaneous claims always wins.
+
+Classes:
+Federation -- Presence layer connecting servers into a mesh.
+
+Functions:
+parse_node -- Split node id to host and port.
+"""
+import asyncio
+from protocol.message import FrameParser, create_binary_message, CHUNK_SIZE, BINARY_FRAMING
+
+
+class Federation:
+    """
+    Presence layer connecting servers into a mesh.
+
+    Instance attributes:
+    node -- Id of this node, host:port on which it listens for peers.
+    peers -- Ids of all other nodes.
+    retry -- Seconds between attempts to connect to peer.
+    server -- Server using federation.
+    nicks -- Map nicks of users of other nodes to ids of those nodes.
+    links -- Map ids of connected peers to writers.
+    listener -- Server object listening for peers.
+    connecting -- Tasks keeping connections to peers with greater ids.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    start -- Start listening for peers and connecting to them.
+    stop -- Close all connections.
+    claim -- Ask all peers if nick can be taken.
+    release -- Inform peers that nick was released.
+    publish -- Send message to all peers.
+    send_to -- Send message only to peer of user with nick.
+    """
+    def __init__(self, node, peers, retry=1.0):
+        """
+        Initialize instance.
+
+        Args:
+        node -- Id of this node (bytes), host:port.
+        peers -- Iterable of ids of other nodes.
+        retry -- Seconds between attempts to connect to peer.
+        """
+        self.node = node
+        self.peers = set(peers) - {node}
+        self.retry = retry
+        self.server = None
+        self.nicks = {}
+        self.links = {}
+        self.listener = None
+        self.connecting = []
+        self._claims = {}
+
+    async def start(self, server):
+        """
+        Start listening for peers and connecting to them.
+
+        Args:
+        server -- Server which gets messages from other nodes with Server.deliver.
+        """
+        self.server = server
+        host, port = parse_node(self.node)
+        self.listener = await asyncio.start_server(self._accept, host, port)
+        for peer in sorted(self.peers):
+            if self.node < peer:
+                self.connecting.append(asyncio.ensure_future(self._connect(peer)))
+
+    def stop(self):
+        """Close all connections."""
+        if self.listener is not None:
+            self.listener.close()
+        for task in self.connecting:
+            task.cancel()
+        for writer in self.links.values():
+            writer.close()
+
+    async def claim(self, nick):
+        """
+        Ask all peers if nick can be taken.
+
+        Returns:
+        True if nick was taken for this node, False if it's used on any node.
+        """
+        if nick in self._claims or nick in self.nicks:
+            return False
+        if self.links:
+            future = asyncio.get_running_loop().create_future()
+            self._claims[nick] = (future, set(self.links))
+            self._send_all(create_binary_message(type=b'claim', nick=nick))
+            try:
+                claimed = await future
+            finally:
+                del self._claims[nick]
+            if not claimed:
+                return False
+        self._send_all(create_binary_message(type=b'join', nick=nick))
+        return True
+
+    def release(self, nick):
+        """Inform peers that nick was released."""
+        self._send_all(create_binary_message(type=b'leave', nick=nick))
+
+    def publish(self, message):
+        """
+        Send message to all peers.
+
+        Args:
+        message -- OutgoingMessage, it's encoded once for all peers.
+        """
+        self._send_all(message.encode(BINARY_FRAMING))
+
+    def send_to(self, nick, message):
+        """
+        Send message only to peer of user with nick.
+
+        Args:
+        nick -- Nick of user of other node.
+        message -- OutgoingMessage.
+        """
+        link = self.links.get(self.nicks.get(nick))
+        if link is not None:
+            link.write(message.encode(BINARY_FRAMING))
+
+    def _send_all(self, frame):
+        """Write frame to every connected peer."""
+        for writer in self.links.values():
+            writer.write(frame)
+
+    async def _connect(self, peer):
+        """Keep connection to peer open."""
+        host, port = parse_node(peer)
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(host, port)
+            except OSError:
+                await asyncio.sleep(self.retry)
+                continue
+            writer.write(create_binary_message(type=b'peer', node=self.node))
+            self._add_link(peer, writer)
+            await self._handle_link(reader, writer, peer)
+            await asyncio.sleep(self.retry)
+
+    async def _accept(self, reader, writer):
+        """Handle connection opened by peer."""
+        await self._handle_link(reader, writer)
+
+    async def _handle_link(self, reader, writer, peer=None):
+        """Read messages from peer until connection is closed."""
+        parser = FrameParser()
+        try:
+            while True:
+                data = await reader.read(CHUNK_SIZE)
+                if not data:
+                    break
+                for message in parser.feed(data):
+                    if message[b'type'] == b'peer':
+                        peer = message[b'node']
+                        self._add_link(peer, writer)
+                    elif peer is not None:
+                        self._handle(message, peer)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            if peer is not None:
+                self._remove_link(peer, writer)
+
+    def _add_link(self, peer, writer):
+        """Remember connection to peer and send it nicks of local users."""
+        self.links[peer] = writer
+        for nick in self.server.nicks_clients:
+            writer.write(create_binary_message(type=b'join', nick=nick))
+
+    def _remove_link(self, peer, writer):
+        """Forget connection to peer, nicks of its users and wait for its answers no more."""
+        if self.links.get(peer) is not writer:
+            return
+        del self.links[peer]
+        for nick in [nick for nick, node in self.nicks.items() if node == peer]:
+            del self.nicks[nick]
+            self.server.roster.discard(nick)
+        for nick, (future, waiting) in self._claims.items():
+            waiting.discard(peer)
+            if not waiting and not future.done():
+                future.set_result(True)
+
+    def _handle(self, message, peer):
+        """Handle message from peer."""
+        msg_type = message[b'type']
+        if msg_type == b'claim':
+            nick = message[b'nick']
+            taken = nick in self.server.nicks_clients or nick in self.nicks or \
+                nick in self._claims and self.node < peer
+            result = b'taken' if taken else b'ok'
+            self.links[peer].write(create_binary_message(type=b'claimed', nick=nick, result=result))
+        elif msg_type == b'claimed':
+            future, waiting = self._claims.get(message[b'nick'], (None, None))
+            if future is not None and not future.done():
+                waiting.discard(peer)
+                if message[b'result'] != b'ok':
+                    future.set_result(False)
+                elif not waiting:
+                    future.set_result(True)
+        elif msg_type == b'join':
+            self.nicks[message[b'nick']] = peer
+            self.server.roster.add(message[b'nick'])
+        elif msg_type == b'leave':
+            if self.nicks.get(message[b'nick']) == peer:
+                del self.nicks[message[b'nick']]
+                self.server.roster.discard(message[b'nick'])
+        else:
+            self.server.deliver(message)
+
+
+def parse_node(node):
+    """
+    Split node id to host and port.
+
+    Args:
+    node -- Id of node (bytes), host:port.
+
+    Returns:
+    Tuple (host, port).
+    """
+    host, _, port = node.decode().rpartition(':')
+    return host, int(port)
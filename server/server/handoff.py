@@ -0,0 +1,84 @@
+"""
+Module defines handoff of listening socket to new server process, so server can be restarted without refusing
+connections.
+
+Running server offers its listening socket on Unix socket given by --handoff. New server started with --takeover
+connects there and gets file descriptor of listening socket in SCM_RIGHTS message. Old server then stops accepting,
+tells its clients it's restarting, drains their queues and closes everything it owns (log, metrics endpoint, presence
+layer), and only then tells new server it's done. New server starts accepting on inherited socket after that, so two
+processes never share log files or ports. Connections arriving meanwhile wait in accept backlog, socket is never
+closed. Handoff works with one listening socket, address should be numeric.
+
+Functions:
+offer -- Coroutine waiting for successor, handing it listening socket and draining server.
+take_over -- Take listening socket from running server.
+"""
+import asyncio
+import logging
+import os
+import socket
+
+HELLO = b'chat-listener'
+DONE = b'done'
+
+logger = logging.getLogger(__name__)
+
+
+async def offer(serverobj, path, drain_timeout):
+    """
+    Coroutine waiting for successor, handing it listening socket and draining server.
+
+    Args:
+    serverobj -- Running Server.
+    path -- Path of Unix socket successor connects to, it's removed when coroutine ends.
+    drain_timeout -- Seconds clients have to get what was queued for them.
+    """
+    loop = asyncio.get_running_loop()
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listener.bind(path)
+    listener.listen(1)
+    listener.setblocking(False)
+    try:
+        connection, _ = await loop.sock_accept(listener)
+    finally:
+        listener.close()
+        os.unlink(path)
+    with connection:
+        sockets = serverobj.server.sockets
+        if len(sockets) != 1:
+            logger.error('Listening socket can\'t be handed off, server listens on %d sockets.', len(sockets))
+            return
+        socket.send_fds(connection, [HELLO], [sockets[0].fileno()])
+        await serverobj.drain(drain_timeout, b'Server is restarting.\n')
+        await loop.sock_sendall(connection, DONE)
+
+
+def take_over(path):
+    """
+    Take listening socket from running server.
+
+    Function blocks until old server is drained and closed, connections arriving meanwhile wait in accept backlog.
+
+    Args:
+    path -- Path of Unix socket old server offers its listening socket on.
+
+    Returns:
+    Listening socket.
+
+    Raises:
+    RuntimeError -- Server at path didn't send socket.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        data, fds, _, _ = socket.recv_fds(connection, len(HELLO), 1)
+        if data != HELLO or not fds:
+            raise RuntimeError('Server at {} didn\'t hand off its listening socket.'.format(path))
+        listening = socket.socket(fileno=fds[0])
+        # Old server closes connection when it's done, even if it failed to say so.
+        while connection.recv(len(DONE)):
+            pass
+    return listening
@@ -0,0 +1,129 @@
+"""
+Module defines bounded buffer of recent messages replayed to clients.
+
+Classes:
+History -- Buffer of recently broadcast messages limited by number of messages and their total size.
+"""
+from collections import deque
+
+MAX_MESSAGES = 100
+# Limit of contents, kept messages take up to about four times more memory, see History.
+MAX_BYTES = 64 * 1024
+
+
+class History:
+    """
+    Buffer of recently broadcast messages limited by number of messages and their total size.
+
+    One buffer is shared by all rooms, so memory stays bounded however many rooms there are. Messages are kept as
+    OutgoingMessage instances, frames encoded for broadcast are reused when messages are replayed. Each message gets
+    next sequence number in seq section, so it has to be appended before it's encoded. Clients resuming session say
+    which number they got last and get only messages after it.
+
+    Only contents of sections count towards max_bytes. Each kept message also holds its encoded frames, at most one
+    for each framing: binary and compressed ones aren't longer than contents with headers, text one is up to twice as
+    long when contents are mostly escaped characters. So buffer takes up to about four times max_bytes, plus headers
+    of frames of at most max_messages messages. Frames are encoded after message is appended, so they aren't measured
+    on the hot path.
+
+    Instance attributes:
+    max_messages -- Maximal number of kept messages.
+    max_bytes -- Maximal total size of contents of kept messages, encoded frames aren't counted, so replayed batch is
+    limited separately by free space of queue of client.
+    entries -- Kept tuples (sequence, room, sender, message, size), oldest first.
+    size -- Total size of contents of kept messages.
+    sequence -- Sequence number of the last appended message.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+    __len__ -- Number of kept messages.
+
+    Methods:
+    append -- Remember message, oldest messages are forgotten when buffer is full.
+    frames -- Return encoded recent messages of room.
+    missed -- Return encoded messages client missed since given sequence number.
+    """
+    def __init__(self, max_messages=MAX_MESSAGES, max_bytes=MAX_BYTES):
+        """Initialize instance."""
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.entries = deque()
+        self.size = 0
+        self.sequence = 0
+
+    def __len__(self):
+        """Number of kept messages."""
+        return len(self.entries)
+
+    def append(self, message, room=None, sender=None):
+        """
+        Remember message and give it sequence number, oldest messages are forgotten when buffer is full.
+
+        Args:
+        message -- OutgoingMessage which wasn't encoded yet.
+        room -- Room message was sent to, None if it was sent to everyone.
+        sender -- Nick of client which sent message, None if it came from other server.
+        """
+        self.sequence += 1
+        message.sections['seq'] = b'%d' % self.sequence
+        size = sum(map(len, message.sections.values()))
+        self.entries.append((self.sequence, room, sender, message, size))
+        self.size += size
+        while len(self.entries) > self.max_messages or self.size > self.max_bytes:
+            size = self.entries.popleft()[-1]
+            self.size -= size
+
+    def frames(self, framing, room=None, count=None, max_bytes=None):
+        """
+        Return encoded recent messages of room.
+
+        Args:
+        framing -- Framing of returned messages.
+        room -- Room of messages, None means messages sent to everyone.
+        count -- Maximal number of returned messages, None means all kept.
+        max_bytes -- Maximal total length of returned frames, None means no limit. The newest messages are returned.
+
+        Returns:
+        List of frames, oldest first.
+        """
+        frames = []
+        length = 0
+        for _, entry_room, _, message, _ in reversed(self.entries):
+            if count is not None and len(frames) >= count:
+                break
+            if entry_room == room:
+                frame = message.encode(framing)
+                length += len(frame)
+                if max_bytes is not None and length > max_bytes:
+                    break
+                frames.append(frame)
+        frames.reverse()
+        return frames
+
+    def missed(self, framing, after, rooms, nick, max_bytes=None):
+        """
+        Return encoded messages client missed since given sequence number.
+
+        Args:
+        framing -- Framing of returned messages.
+        after -- Sequence number of the last message client got.
+        rooms -- Rooms client is member of, messages sent to everyone are returned too.
+        nick -- Nick of client, its own messages aren't returned.
+        max_bytes -- Maximal total length of returned frames, None means no limit. The newest messages are returned.
+
+        Returns:
+        List of frames, oldest first.
+        """
+        frames = []
+        length = 0
+        for sequence, room, sender, message, _ in reversed(self.entries):
+            if sequence <= after:
+                break
+            if (room is None or room in rooms) and sender != nick:
+                frame = message.encode(framing)
+                length += len(frame)
+                if max_bytes is not None and length > max_bytes:
+                    break
+                frames.append(frame)
+        frames.reverse()
+        return frames
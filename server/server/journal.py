@@ -0,0 +1,207 @@
+"""
+Module defines persistent log of messages sent through server.
+
+Log is a directory of append-only segments. Segment is a pair of files named after number of its first message:
+NUMBER.log -- Messages in binary format from message module, one after another.
+NUMBER.idx -- End offsets of messages in .log file, 8 bytes each in native byte order.
+Messages are appended to memory and written with fsync in batches by executor thread, so event loop never waits for
+disk. Index is written after messages, data in .log file behind last indexed offset (left by crash) is cut off when
+log is opened again. Last messages are read by memory mapping both files of newest segments and slicing them, files
+are never scanned.
+
+Classes:
+Journal -- Persistent segmented log of messages.
+"""
+import asyncio
+import mmap
+import os
+import threading
+from array import array
+from protocol.message import BINARY_FRAMING
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+FLUSH_INTERVAL = 0.1
+OFFSET_SIZE = array('Q').itemsize
+
+
+class Journal:
+    """
+    Persistent segmented log of messages.
+
+    Instance attributes:
+    directory -- Directory with segments.
+    segment_size -- Size of .log file after which new segment is started.
+    flush_interval -- Seconds between writes of appended messages.
+    segments -- Numbers of first messages of segments, oldest first.
+    count -- Number of messages in log, including those not written yet.
+    pending -- Frames appended since last write.
+    task -- Task writing appended messages periodically.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+    __len__ -- Number of messages in log.
+
+    Methods:
+    start -- Start writing appended messages periodically.
+    append -- Append message to log.
+    flush -- Coroutine writing appended messages in executor.
+    read -- Coroutine returning last messages of log.
+    close -- Stop periodic writes and write what is left.
+    """
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, flush_interval=FLUSH_INTERVAL):
+        """
+        Initialize instance, open log in directory or create it.
+
+        Args:
+        directory -- Directory with segments, it's created if it doesn't exist.
+        segment_size -- Size of .log file after which new segment is started.
+        flush_interval -- Seconds between writes of appended messages.
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.task = None
+        self._lock = asyncio.Lock()
+        # Executor thread holds this while it touches files, so close() doesn't write or close them in the middle of
+        # flush. Batch handed to executor waits in _writing, whoever takes the lock first writes it.
+        self._file_lock = threading.Lock()
+        self._writing = []
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith('.idx'))
+        if not self.segments:
+            self.segments.append(0)
+        self._open_segment(self.segments[-1])
+        self.count = self.segments[-1] + len(self._offsets)
+
+    def __len__(self):
+        """Number of messages in log."""
+        return self.count
+
+    def start(self):
+        """Start writing appended messages periodically."""
+        self.task = asyncio.ensure_future(self._run())
+
+    def append(self, message):
+        """
+        Append message to log, it's written with the next flush.
+
+        Args:
+        message -- OutgoingMessage, its binary frame is reused if it was already sent to binary clients.
+        """
+        self.pending.append(message.encode(BINARY_FRAMING))
+        self.count += 1
+
+    async def flush(self):
+        """Coroutine writing appended messages in executor, at most one write runs at a time."""
+        async with self._lock:
+            if self.pending:
+                self._writing, self.pending = self.pending, []
+                await asyncio.get_running_loop().run_in_executor(None, self._write_batch)
+
+    async def read(self, count):
+        """
+        Coroutine returning last messages of log.
+
+        Args:
+        count -- Maximal number of returned messages.
+
+        Returns:
+        List of binary frames, oldest first.
+        """
+        async with self._lock:
+            pending = self.pending[-count:] if count > 0 else []
+            frames = await asyncio.get_running_loop().run_in_executor(None, self._read, count - len(pending))
+        return frames + pending
+
+    def close(self):
+        """
+        Stop periodic writes and write what is left, it blocks until messages are on disk.
+
+        Batch of flush still running in executor is written here if executor didn't get to it yet, otherwise close
+        waits for it, files are closed only after both.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        with self._file_lock:
+            frames, self._writing, self.pending = self._writing + self.pending, [], []
+            self._write(frames)
+            self._log.close()
+            self._index.close()
+
+    async def _run(self):
+        """Write appended messages every flush_interval seconds."""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def _path(self, first, suffix):
+        """Return path of file of segment."""
+        return os.path.join(self.directory, '%020d%s' % (first, suffix))
+
+    def _open_segment(self, first):
+        """Open files of segment for appending, cut off messages which were not indexed."""
+        self._offsets = array('Q')
+        with open(self._path(first, '.idx'), 'ab+') as index:
+            index.seek(0)
+            data = index.read()
+        self._offsets.frombytes(data[:len(data) - len(data) % OFFSET_SIZE])
+        self._log = open(self._path(first, '.log'), 'ab')
+        self._log.truncate(self._offsets[-1] if self._offsets else 0)
+        self._index = open(self._path(first, '.idx'), 'ab')
+        self._index.truncate(len(self._offsets) * OFFSET_SIZE)
+
+    def _write_batch(self):
+        """Write batch handed to executor by flush, nothing is written if close already wrote it."""
+        with self._file_lock:
+            frames, self._writing = self._writing, []
+            self._write(frames)
+
+    def _write(self, frames):
+        """Write frames and their offsets, fsync both files, start new segment if this one is full, lock is held."""
+        if not frames:
+            return
+        end = self._offsets[-1] if self._offsets else 0
+        offsets = array('Q')
+        for frame in frames:
+            end += len(frame)
+            offsets.append(end)
+        self._log.write(b''.join(frames))
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._index.write(offsets.tobytes())
+        self._index.flush()
+        os.fsync(self._index.fileno())
+        self._offsets.extend(offsets)
+        if end >= self.segment_size:
+            self._log.close()
+            self._index.close()
+            first = self.segments[-1] + len(self._offsets)
+            self.segments.append(first)
+            self._open_segment(first)
+
+    def _read(self, count):
+        """Return count last written frames, newest segments are memory mapped until there are enough of them."""
+        frames = []
+        with self._file_lock:
+            for first in reversed(self.segments):
+                if len(frames) >= count:
+                    break
+                frames[:0] = self._read_segment(first, count - len(frames))
+        return frames
+
+    def _read_segment(self, first, count):
+        """Return count last frames of segment."""
+        with open(self._path(first, '.idx'), 'rb') as index:
+            number = os.fstat(index.fileno()).st_size // OFFSET_SIZE
+            if number == 0:
+                return []
+            start = max(0, number - count - 1)
+            with mmap.mmap(index.fileno(), number * OFFSET_SIZE, access=mmap.ACCESS_READ) as index_map:
+                offsets = array('Q', index_map[start * OFFSET_SIZE:number * OFFSET_SIZE])
+        if number <= count:
+            offsets.insert(0, 0)
+        with open(self._path(first, '.log'), 'rb') as log:
+            with mmap.mmap(log.fileno(), offsets[-1], access=mmap.ACCESS_READ) as log_map:
+                return [log_map[begin:end] for begin, end in zip(offsets, offsets[1:])]
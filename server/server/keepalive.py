@@ -0,0 +1,178 @@
+"""
+Module defines keepalive pings and reaper of idle connections.
+
+Client records time of its last read, which costs one assignment per chunk. Every client is checked when it could
+become idle: clients which agreed on keepalive feature are sent ping message after ping interval without data and
+answer with pong, those which sent nothing for idle timeout are disconnected and removed by the usual
+Server.remove_client path. Clients without keepalive can't answer pings and may be quiet for hours, so they are
+disconnected only if they didn't finish hello within idle timeout. Checks are kept on hashed timer wheel instead of
+one call_later for each client, so scheduling and cancelling a check is a dictionary operation and each tick looks
+only at its own slot.
+
+Classes:
+TimerWheel -- Hashed timer wheel calling function for items whose deadline passed.
+Keepalive -- Pings clients and disconnects those which are idle for too long.
+"""
+import asyncio
+import time
+from protocol.message import KEEPALIVE
+
+TICK = 1.0
+SLOTS = 512
+PING_INTERVAL = 30.0
+IDLE_TIMEOUT = 120.0
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel calling function for items whose deadline passed.
+
+    Time is split to ticks, item is kept in slot number of its deadline tick modulo number of slots. Each tick only
+    its slot is looked at, items of later rounds stay there. Deadlines are rounded up to whole ticks.
+
+    Instance attributes:
+    callback -- Function called with item whose deadline passed, it can add item again.
+    tick -- Seconds of one tick.
+    slots -- List of dictionaries mapping items to deadlines.
+    slot_of -- Map items to indexes of their slots.
+    current -- Number of the last processed tick.
+    task -- Task advancing wheel.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+    __len__ -- Number of items.
+
+    Methods:
+    add -- Schedule item, previous deadline of item is forgotten.
+    discard -- Forget item if it's scheduled.
+    advance -- Process ticks up to time now.
+    start -- Start advancing wheel every tick.
+    stop -- Stop advancing wheel.
+    """
+    def __init__(self, callback, tick=TICK, slots=SLOTS):
+        """Initialize instance."""
+        self.callback = callback
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        self.slot_of = {}
+        self.current = int(time.monotonic() // tick)
+        self.task = None
+
+    def __len__(self):
+        """Number of items."""
+        return len(self.slot_of)
+
+    def add(self, item, deadline):
+        """
+        Schedule item, previous deadline of item is forgotten.
+
+        Args:
+        item -- Hashable object passed to callback.
+        deadline -- time.monotonic() after which callback is called.
+        """
+        self.discard(item)
+        index = max(int(deadline // self.tick), self.current + 1) % len(self.slots)
+        self.slots[index][item] = deadline
+        self.slot_of[item] = index
+
+    def discard(self, item):
+        """Forget item if it's scheduled."""
+        index = self.slot_of.pop(item, None)
+        if index is not None:
+            del self.slots[index][item]
+
+    def advance(self, now):
+        """Process ticks up to time now, callback is called for items of those ticks."""
+        last = int(now // self.tick)
+        while self.current < last:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            end = (self.current + 1) * self.tick
+            due = [item for item, deadline in slot.items() if deadline < end]
+            for item in due:
+                del slot[item]
+                del self.slot_of[item]
+            for item in due:
+                self.callback(item)
+
+    def start(self):
+        """Start advancing wheel every tick."""
+        self.task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        """Stop advancing wheel."""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        """Advance wheel every tick."""
+        while True:
+            await asyncio.sleep(self.tick)
+            self.advance(time.monotonic())
+
+
+class Keepalive:
+    """
+    Pings clients and disconnects those which are idle for too long.
+
+    Instance attributes:
+    ping_interval -- Seconds without data after which client is pinged.
+    idle_timeout -- Seconds without data after which client is disconnected, client without keepalive only before hello.
+    wheel -- TimerWheel of checks of clients.
+    pings -- Number of sent pings.
+    reaped -- Number of disconnected clients.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    start -- Start checking clients.
+    stop -- Stop checking clients.
+    watch -- Start checking client.
+    unwatch -- Stop checking client.
+    """
+    def __init__(self, ping_interval=PING_INTERVAL, idle_timeout=IDLE_TIMEOUT, tick=TICK):
+        """Initialize instance."""
+        if ping_interval >= idle_timeout:
+            raise ValueError('Ping interval is not shorter than idle timeout.')
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.wheel = TimerWheel(self._check, tick)
+        self.pings = 0
+        self.reaped = 0
+
+    def start(self):
+        """Start checking clients."""
+        self.wheel.start()
+
+    def stop(self):
+        """Stop checking clients."""
+        self.wheel.stop()
+
+    def watch(self, client):
+        """Start checking client, its last_read has to be set."""
+        self.wheel.add(client, client.last_read + self.ping_interval)
+
+    def unwatch(self, client):
+        """Stop checking client."""
+        self.wheel.discard(client)
+
+    def _check(self, client):
+        """Ping client or disconnect it if it's idle, schedule next check otherwise, stop checking quiet user."""
+        if KEEPALIVE not in client.features and client.nick is not None:
+            return
+        now = time.monotonic()
+        idle = now - client.last_read
+        if idle >= self.idle_timeout:
+            self.reaped += 1
+            client.disconnect()
+            return
+        if KEEPALIVE not in client.features:
+            self.wheel.add(client, client.last_read + self.idle_timeout)
+        elif idle >= self.ping_interval:
+            self.pings += 1
+            client.send(client.create_message(type=b'ping'), key=b'ping')
+            self.wheel.add(client, min(now + self.ping_interval, client.last_read + self.idle_timeout))
+        else:
+            self.wheel.add(client, client.last_read + self.ping_interval)
@@ -0,0 +1,126 @@
+"""
+Module defines limits protecting server from clients which connect or send too much.
+
+Server refuses connections above maximal number of connected clients or above accept rate, refused client gets text
+message telling why and connection is closed. Each client has token buckets for received messages and bytes, when
+one of them runs out client isn't read until it refills. Unread data stays in kernel buffers, so flooding client is
+slowed down by TCP flow control and nothing it sent is lost, while other clients are served as usual. Message can't
+be longer than maximal frame size, it's refused while it's still arriving.
+
+Classes:
+TokenBucket -- Token bucket refilled at constant rate.
+Limits -- Limits of connections and of data received from each client.
+"""
+import time
+
+# Buckets hold tokens for this many seconds of their rate.
+BURST = 1.0
+
+
+class TokenBucket:
+    """
+    Token bucket refilled at constant rate.
+
+    Tokens can be taken even when there are not enough of them, bucket goes below zero and caller waits until it's
+    back at zero. So amount taken at once isn't limited by capacity and long-term rate is kept exactly.
+
+    Instance attributes:
+    rate -- Tokens added per second.
+    capacity -- Maximal number of tokens.
+    tokens -- Number of tokens at time updated, it's negative when tokens are owed.
+    updated -- time.monotonic() when tokens were computed.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    take -- Take tokens and return how long caller has to wait.
+    """
+    def __init__(self, rate, burst=BURST):
+        """
+        Initialize instance, bucket starts full.
+
+        Args:
+        rate -- Tokens added per second.
+        burst -- Capacity of bucket in seconds of rate, it holds at least one token.
+        """
+        self.rate = rate
+        self.capacity = max(1.0, rate * burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, amount=1):
+        """
+        Take tokens and return how long caller has to wait.
+
+        Args:
+        amount -- Number of taken tokens.
+
+        Returns:
+        Seconds until bucket is back at zero, 0 if there were enough tokens.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate) - amount
+        self.updated = now
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class Limits:
+    """
+    Limits of connections and of data received from each client.
+
+    Instance attributes:
+    max_connections -- Maximal number of connected clients, None means no limit.
+    accept_rate -- Maximal number of accepted connections per second, None means no limit.
+    message_rate -- Maximal number of messages per second read from each client, None means no limit.
+    byte_rate -- Maximal number of bytes per second read from each client, None means no limit.
+    max_frame_size -- Maximal length of received message in bytes, None means no limit.
+    accepts -- TokenBucket of accepted connections, None without accept rate.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    admit -- Return reason for refusing new connection.
+    message_bucket -- Return new TokenBucket of messages of one client.
+    byte_bucket -- Return new TokenBucket of bytes of one client.
+    """
+    def __init__(self, max_connections=None, accept_rate=None, message_rate=None, byte_rate=None,
+                 max_frame_size=None):
+        """Initialize instance."""
+        self.max_connections = max_connections
+        self.accept_rate = accept_rate
+        self.message_rate = message_rate
+        self.byte_rate = byte_rate
+        self.max_frame_size = max_frame_size
+        self.accepts = TokenBucket(accept_rate) if accept_rate is not None else None
+
+    def admit(self, connected):
+        """
+        Return reason for refusing new connection.
+
+        Accepted connection takes token from accept bucket, refused connections don't.
+
+        Args:
+        connected -- Number of clients connected now.
+
+        Returns:
+        Text for refused client, None if connection is accepted.
+        """
+        if self.max_connections is not None and connected >= self.max_connections:
+            return b'Server is full, try again later.\n'
+        if self.accepts is not None:
+            if self.accepts.take():
+                self.accepts.tokens += 1
+                return b'Server is busy, try again later.\n'
+        return None
+
+    def message_bucket(self):
+        """Return new TokenBucket of messages of one client, None without message rate."""
+        return TokenBucket(self.message_rate) if self.message_rate is not None else None
+
+    def byte_bucket(self):
+        """Return new TokenBucket of bytes of one client, None without byte rate."""
+        return TokenBucket(self.byte_rate) if self.byte_rate is not None else None
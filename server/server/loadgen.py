@@ -0,0 +1,291 @@
+"""
+Load generator driving real server over localhost connections.
+
+Simulated users speak the same protocol as client.Client: they send hello, join a room and then send text messages to
+it at fixed rate. Every text carries time it was sent, so its receivers measure end-to-end latency. Server is started
+in separate process, so it doesn't share CPU with load generator, and its memory is read from /proc. Results are
+printed as JSON. Run with python -m server.loadgen.
+
+Classes:
+User -- Simulated user connected to server.
+
+Functions:
+percentile -- Return value below which given fraction of sorted samples lies.
+run_load -- Coroutine connecting users to server and measuring it.
+read_rss -- Return resident memory of process in kilobytes.
+free_port -- Return port on localhost which is free now.
+start_server -- Start server process and wait until it accepts connections.
+main -- Main script.
+"""
+import asyncio
+import json
+import socket
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from protocol import message
+from protocol import loops
+
+TEXT_PREFIX = b'load '
+
+
+class User:
+    """
+    Simulated user connected to server.
+
+    Instance attributes:
+    nick -- Nick of user.
+    room -- Room user sends messages to.
+    framing -- Framing requested in hello message.
+    reader -- Reader from server.
+    writer -- Writer to server.
+    joined -- Future done when server confirmed that user joined room.
+    latencies -- Latencies of received texts in nanoseconds.
+    sent -- Number of sent texts.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    connect -- Coroutine opening connection, sending hello and joining room.
+    receive -- Coroutine reading messages until connection is closed.
+    send -- Coroutine sending texts at given rate until it's cancelled.
+    """
+    def __init__(self, nick, room, framing):
+        """Initialize instance."""
+        self.nick = nick
+        self.room = room
+        self.framing = framing
+        self.reader = None
+        self.writer = None
+        self.joined = asyncio.get_running_loop().create_future()
+        self.latencies = []
+        self.sent = 0
+
+    async def connect(self, host, port):
+        """Coroutine opening connection, sending hello and joining room."""
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        if self.framing == message.DEFLATE:
+            hello = message.create_message(type=b'hello', nick=self.nick,
+                                           features=message.BINARY_FRAMING + b' ' + message.DEFLATE)
+        elif self.framing == message.BINARY_FRAMING:
+            hello = message.create_message(type=b'hello', nick=self.nick, features=self.framing)
+        else:
+            hello = message.create_message(type=b'hello', nick=self.nick)
+        self.writer.write(hello + message.create_message(type=b'join', room=self.room))
+
+    async def receive(self):
+        """Coroutine reading messages until connection is closed, texts of other users are timed."""
+        parser = message.FrameParser()
+        while True:
+            data = await self.reader.read(message.CHUNK_SIZE)
+            if not data:
+                break
+            now = time.perf_counter_ns()
+            for received in parser.feed(data):
+                text = received.get(b'text', b'')
+                if text.startswith(TEXT_PREFIX):
+                    self.latencies.append(now - int(text[len(TEXT_PREFIX):]))
+                elif text.startswith(b'You joined room') and not self.joined.done():
+                    self.joined.set_result(True)
+
+    async def send(self, rate, delay=0):
+        """
+        Coroutine sending texts to room until it's cancelled.
+
+        Args:
+        rate -- Texts sent per second.
+        delay -- Seconds before the first text is sent.
+        """
+        encode = message.ENCODERS[self.framing]
+        interval = 1 / rate
+        await asyncio.sleep(delay)
+        next_time = time.perf_counter()
+        while True:
+            text = TEXT_PREFIX + b'%d\n' % time.perf_counter_ns()
+            self.writer.write(encode(type=b'text', text=text, room=self.room))
+            self.sent += 1
+            next_time += interval
+            await asyncio.sleep(max(0, next_time - time.perf_counter()))
+
+
+def percentile(samples, fraction):
+    """
+    Return value below which given fraction of sorted samples lies.
+
+    Args:
+    samples -- Sorted list.
+    fraction -- Number between 0 and 1.
+
+    Returns:
+    Sample at the fraction, None if there are no samples.
+    """
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+async def run_load(host, port, users=1000, room_size=10, rate=1.0, duration=10.0, framing=message.BINARY_FRAMING,
+                   concurrency=100, drain=1.0):
+    """
+    Coroutine connecting users to server and measuring it.
+
+    Users are connected in batches, each of them joins room shared with room_size - 1 other users. Then every user
+    sends rate texts per second to its room for duration seconds, start of sending is spread over the first interval.
+    Texts in flight are awaited for drain seconds after sending stops.
+
+    Args:
+    host, port -- Address of server.
+    users -- Number of simulated users.
+    room_size -- Number of users in each room.
+    rate -- Texts sent by each user per second.
+    duration -- Seconds of sending.
+    framing -- Framing requested by users.
+    concurrency -- Number of connections opened at once.
+    drain -- Seconds to wait for texts in flight.
+
+    Returns:
+    Dictionary with results, latencies are in milliseconds.
+    """
+    loop = asyncio.get_running_loop()
+    connected = [User(b'load%d' % i, b'room%d' % (i // room_size), framing) for i in range(users)]
+    start = time.perf_counter()
+    for i in range(0, users, concurrency):
+        await asyncio.gather(*(user.connect(host, port) for user in connected[i:i + concurrency]))
+    receiving = [loop.create_task(user.receive()) for user in connected]
+    await asyncio.gather(*(user.joined for user in connected))
+    connect_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sending = [loop.create_task(user.send(rate, i / users / rate)) for i, user in enumerate(connected)]
+    await asyncio.sleep(duration)
+    for task in sending:
+        task.cancel()
+    send_time = time.perf_counter() - start
+    await asyncio.sleep(drain)
+
+    for user in connected:
+        user.writer.close()
+    await asyncio.gather(*receiving, return_exceptions=True)
+
+    latencies = sorted(latency for user in connected for latency in user.latencies)
+    sent = sum(user.sent for user in connected)
+    members = {}
+    for user in connected:
+        members[user.room] = members.get(user.room, 0) + 1
+    expected = sum(user.sent * (members[user.room] - 1) for user in connected)
+    return {
+        'users': users,
+        'room_size': room_size,
+        'rate': rate,
+        'duration': duration,
+        'framing': framing.decode(),
+        'connect_per_second': users / connect_time,
+        'sent_per_second': sent / send_time,
+        'delivered_per_second': len(latencies) / send_time,
+        'sent': sent,
+        'delivered': len(latencies),
+        'lost': expected - len(latencies),
+        'latency_ms': {
+            name: None if value is None else value / 1e6
+            for name, value in (('p50', percentile(latencies, 0.5)), ('p99', percentile(latencies, 0.99)),
+                                ('p999', percentile(latencies, 0.999)), ('max', latencies[-1] if latencies else None))
+        },
+    }
+
+
+def read_rss(pid):
+    """
+    Return resident memory of process in kilobytes.
+
+    Returns:
+    Tuple (current RSS, peak RSS), values are None where /proc isn't available.
+    """
+    values = {}
+    try:
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                name, _, value = line.partition(':')
+                if name in ('VmRSS', 'VmHWM'):
+                    values[name] = int(value.split()[0])
+    except OSError:
+        pass
+    return values.get('VmRSS'), values.get('VmHWM')
+
+
+def free_port():
+    """Return port on localhost which is free now."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port, server_args=(), timeout=10.0):
+    """
+    Start server process and wait until it accepts connections.
+
+    Args:
+    port -- Port on localhost server listens on.
+    server_args -- Additional command line arguments of server.
+    timeout -- Seconds to wait for server.
+
+    Returns:
+    subprocess.Popen instance.
+    """
+    process = subprocess.Popen([sys.executable, '-m', 'server.script', '127.0.0.1', str(port)] + list(server_args))
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return process
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError('Server didn\'t start.')
+            time.sleep(0.05)
+
+
+def main():
+    parser = ArgumentParser(description='Load generator measuring chat server, results are printed as JSON. '
+                                        'Unknown arguments are passed to started server.')
+    parser.add_argument('--users', type=int, default=1000, help='Number of simulated users.')
+    parser.add_argument('--room-size', type=int, default=10, help='Number of users in each room.')
+    parser.add_argument('--rate', type=float, default=1.0, help='Texts sent by each user per second.')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of sending.')
+    parser.add_argument('--framing', choices=('text', 'binary', 'deflate'), default='binary',
+                        help='Framing used by users.')
+    parser.add_argument('--loop', choices=loops.LOOPS, default='auto', help='Event loop of load generator.')
+    parser.add_argument('--connect', metavar='HOST:PORT',
+                        help='Address of running server, server is started by load generator without it.')
+    parser.add_argument('--output', help='File results are written to, standard output is used without it.')
+    args, server_args = parser.parse_known_args()
+
+    if args.connect is None:
+        host, port = '127.0.0.1', free_port()
+        process = start_server(port, server_args)
+    else:
+        host, _, port = args.connect.rpartition(':')
+        process = None
+    loop = loops.new_event_loop(args.loop)
+    try:
+        results = loop.run_until_complete(run_load(host, int(port), args.users, args.room_size, args.rate,
+                                                   args.duration, args.framing.encode()))
+        rss, peak_rss = read_rss(process.pid) if process is not None else (None, None)
+        results.update(server_args=server_args, server_rss_kb=rss, server_peak_rss_kb=peak_rss)
+    finally:
+        loop.close()
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    if args.output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+"""
+Module defines counters of server and endpoint serving them in Prometheus text format.
+
+Hot paths only add to integers and lists of bucket counts, everything else is computed when metrics are scraped.
+Server without Metrics instance doesn't count anything, apart from plain counters of outbound queues. Received frames
+are counted by type, sent ones only in total: they are queued already encoded, compressed ones included, so outbound
+queue doesn't know their types and broadcast of one message to whole room stays one encoding and one append per
+receiver.
+
+Classes:
+Histogram -- Histogram of durations with log-linear buckets.
+Metrics -- Counters of one server and HTTP endpoint serving them.
+"""
+import asyncio
+
+# Each power of two is split to 2 ** SUB_BUCKET_BITS buckets, so recorded values are precise to 1/8.
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# Durations are recorded in nanoseconds, values above 2 ** 40 ns (about 18 minutes) fall to the last bucket.
+MAX_EXPONENT = 40
+# Upper bounds of exported buckets in nanoseconds, powers of two from about 1 microsecond to about 69 seconds.
+EXPORTED_BOUNDS = tuple(2 ** exponent for exponent in range(10, 37))
+CONTENT_TYPE = b'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """
+    Histogram of durations with log-linear buckets.
+
+    Like HDR histogram it keeps fixed number of buckets whose width grows with value, so relative error is bounded and
+    recording is one index computation.
+
+    Instance attributes:
+    counts -- Number of values in each bucket.
+    count -- Number of recorded values.
+    total -- Sum of recorded values.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    record -- Record value.
+    percentile -- Return upper bound of bucket below which given fraction of values lies.
+    cumulative -- Return number of values not greater than each of bounds.
+    """
+    def __init__(self):
+        """Initialize instance."""
+        self.counts = [0] * ((MAX_EXPONENT + 1) * SUB_BUCKETS)
+        self.count = 0
+        self.total = 0
+
+    def record(self, value):
+        """
+        Record value.
+
+        Args:
+        value -- Non-negative integer, usually nanoseconds.
+        """
+        # Values below 2 * SUB_BUCKETS have bucket each, above them the exponent selects row of SUB_BUCKETS.
+        exponent = value.bit_length() - SUB_BUCKET_BITS - 1
+        if exponent <= 0:
+            self.counts[value] += 1
+        elif exponent >= MAX_EXPONENT:
+            self.counts[-1] += 1
+        else:
+            self.counts[(exponent << SUB_BUCKET_BITS) + (value >> exponent)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, fraction):
+        """
+        Return upper bound of bucket below which given fraction of values lies.
+
+        Returns:
+        Bound, 0 if nothing was recorded.
+        """
+        needed = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= needed:
+                return _upper_bound(index)
+        return 0
+
+    def cumulative(self, bounds):
+        """
+        Return number of values not greater than each of bounds.
+
+        Args:
+        bounds -- Ascending powers of two, bucket edges fall on them.
+
+        Returns:
+        List of counts.
+        """
+        result = []
+        seen = 0
+        index = 0
+        for bound in bounds:
+            while index < len(self.counts) and _upper_bound(index) <= bound:
+                seen += self.counts[index]
+                index += 1
+            result.append(seen)
+        return result
+
+
+def _upper_bound(index):
+    """Return smallest value which is greater than every value of bucket."""
+    if index < 2 * SUB_BUCKETS:
+        return index + 1
+    exponent, sub_bucket = divmod(index, SUB_BUCKETS)
+    return (sub_bucket + SUB_BUCKETS + 1) << (exponent - 1)
+
+
+class Metrics:
+    """
+    Counters of one server and HTTP endpoint serving them.
+
+    Instance attributes:
+    connections -- Number of accepted connections.
+    bytes_in -- Number of bytes read from clients.
+    handler_ns -- Map types of received messages to Histogram of time their handlers took in nanoseconds, counts of
+    histograms are numbers of received messages.
+    loop_lag_ns -- Histogram of event loop lag in nanoseconds, filled by Watchdog.
+    slow_handlers -- Map types of received messages to number of handler invocations Watchdog found slow.
+    address, port -- Address HTTP endpoint listens on, there is no endpoint if both port and path are None.
+    path -- Path of Unix socket HTTP endpoint listens on, it's used instead of address and port.
+    server -- Server counted by metrics.
+    endpoint -- Server object of HTTP endpoint.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    handled -- Count message and time its handler took.
+    render -- Return metrics in Prometheus text format.
+    start -- Coroutine starting HTTP endpoint.
+    stop -- Stop HTTP endpoint.
+    """
+    def __init__(self, port=None, path=None, address='127.0.0.1'):
+        """Initialize instance."""
+        self.address = address
+        self.port = port
+        self.path = path
+        self.connections = 0
+        self.bytes_in = 0
+        self.handler_ns = {}
+        self.loop_lag_ns = Histogram()
+        self.slow_handlers = {}
+        self.server = None
+        self.endpoint = None
+
+    def handled(self, msg_type, duration):
+        """
+        Count message and time its handler took.
+
+        Args:
+        msg_type -- Type of message.
+        duration -- Nanoseconds handler took.
+        """
+        histogram = self.handler_ns.get(msg_type)
+        if histogram is None:
+            histogram = self.handler_ns[msg_type] = Histogram()
+        histogram.record(duration)
+
+    def render(self):
+        """Return metrics of server in Prometheus text format (bytes)."""
+        stats = self.server.outbound_stats()
+        lines = [
+            '# TYPE chat_connections_total counter',
+            'chat_connections_total {}'.format(self.connections),
+            '# TYPE chat_connections gauge',
+            'chat_connections {}'.format(stats['clients']),
+            '# TYPE chat_rejected_connections_total counter',
+            'chat_rejected_connections_total {}'.format(self.server.rejected),
+            '# TYPE chat_reaped_connections_total counter',
+            'chat_reaped_connections_total {}'.format(self.server.keepalive.reaped if self.server.keepalive else 0),
+            '# TYPE chat_bytes_received_total counter',
+            'chat_bytes_received_total {}'.format(self.bytes_in),
+            '# TYPE chat_frames_received_total counter',
+        ]
+        for msg_type, histogram in sorted(self.handler_ns.items()):
+            lines.append('chat_frames_received_total{{type="{}"}} {}'.format(_label(msg_type), histogram.count))
+        # Outbound queues see only encoded frames, so sent frames have no type label.
+        lines += [
+            '# TYPE chat_frames_sent_total counter',
+            'chat_frames_sent_total {}'.format(stats['written_frames']),
+            '# TYPE chat_bytes_sent_total counter',
+            'chat_bytes_sent_total {}'.format(stats['written_bytes']),
+            '# TYPE chat_writes_total counter',
+            'chat_writes_total {}'.format(stats['writes']),
+            '# TYPE chat_outbound_bytes gauge',
+            'chat_outbound_bytes {}'.format(stats['bytes']),
+            '# TYPE chat_outbound_max_bytes gauge',
+            'chat_outbound_max_bytes {}'.format(stats['max_bytes']),
+            '# TYPE chat_outbound_frames gauge',
+            'chat_outbound_frames {}'.format(stats['frames']),
+            '# TYPE chat_dropped_frames_total counter',
+            'chat_dropped_frames_total {}'.format(stats['dropped']),
+            '# TYPE chat_dropped_bytes_total counter',
+            'chat_dropped_bytes_total {}'.format(stats['dropped_bytes']),
+            '# TYPE chat_handler_seconds histogram',
+        ]
+        for msg_type, histogram in sorted(self.handler_ns.items()):
+            lines += _histogram_lines('chat_handler_seconds', 'type="{}",'.format(_label(msg_type)), histogram)
+        lines.append('# TYPE chat_slow_handlers_total counter')
+        for msg_type, count in sorted(self.slow_handlers.items()):
+            lines.append('chat_slow_handlers_total{{type="{}"}} {}'.format(_label(msg_type), count))
+        lines.append('# TYPE chat_loop_lag_seconds histogram')
+        lines += _histogram_lines('chat_loop_lag_seconds', '', self.loop_lag_ns)
+        return ('\n'.join(lines) + '\n').encode()
+
+    async def start(self, server):
+        """
+        Coroutine starting HTTP endpoint, every request gets current metrics whatever its path is.
+
+        Args:
+        server -- Server counted by metrics.
+        """
+        self.server = server
+        if self.path is not None:
+            self.endpoint = await asyncio.start_unix_server(self._serve, self.path)
+        elif self.port is not None:
+            self.endpoint = await asyncio.start_server(self._serve, self.address, self.port)
+
+    def stop(self):
+        """Stop HTTP endpoint."""
+        if self.endpoint is not None:
+            self.endpoint.close()
+
+    async def _serve(self, reader, writer):
+        """Read HTTP request and answer it with metrics."""
+        try:
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            body = self.render()
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: ' + CONTENT_TYPE +
+                         b'\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def _histogram_lines(name, labels, histogram):
+    """
+    Return lines of histogram of nanoseconds exported in seconds.
+
+    Args:
+    name -- Name of metric.
+    labels -- Labels of metric followed by comma, empty string if it has none.
+    histogram -- Histogram.
+    """
+    lines = []
+    for bound, count in zip(EXPORTED_BOUNDS, histogram.cumulative(EXPORTED_BOUNDS)):
+        lines.append('{}_bucket{{{}le="{:.9g}"}} {}'.format(name, labels, bound / 1e9, count))
+    lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(name, labels, histogram.count))
+    labels = labels.rstrip(',')
+    if labels:
+        labels = '{' + labels + '}'
+    lines.append('{}_sum{} {:.9f}'.format(name, labels, histogram.total / 1e9))
+    lines.append('{}_count{} {}'.format(name, labels, histogram.count))
+    return lines
+
+
+def _label(value):
+    """Return bytes as value of Prometheus label."""
+    return value.decode(errors='replace').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
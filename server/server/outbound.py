@@ -0,0 +1,245 @@
+"""
+Module defines bounded queue of frames waiting to be written to a client.
+
+Each client has its own queue drained by a dedicated writer task, which awaits drain() after every write, so one
+stalled client can't make transport buffers grow without limit. Writer task combines all frames queued since its
+last write, optionally waiting a short window for more of them, and hands them to transport with one writelines call,
+so a burst of small frames costs one send instead of one per frame. When queued bytes go above high watermark the slow
+consumer policy is applied until they are back at low watermark:
+drop_oldest -- Oldest frames are dropped.
+coalesce -- Older frames superseded by newer frame with the same key are dropped, then oldest frames are dropped.
+disconnect -- Queue is discarded and client is disconnected.
+
+Classes:
+OutboundQueue -- Bounded queue of frames waiting to be written to one client.
+"""
+import asyncio
+from collections import deque
+
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+POLICIES = (DROP_OLDEST, COALESCE, DISCONNECT)
+
+HIGH_WATER = 256 * 1024
+LOW_WATER = 64 * 1024
+
+
+class OutboundQueue:
+    """
+    Bounded queue of frames waiting to be written to one client.
+
+    Instance attributes:
+    writer -- Writer to client.
+    high_water -- Number of queued bytes above which policy is applied.
+    low_water -- Number of queued bytes policy tries to get back to.
+    policy -- Slow consumer policy, one of POLICIES.
+    on_disconnect -- Function called without arguments when disconnect policy is applied.
+    window -- Seconds writer task waits for more frames after it's woken up, 0 means only frames queued in the same
+    loop iteration are combined.
+    frames -- Queued pairs (data, key), data is frame or list of frames written together.
+    size -- Number of queued bytes.
+    dropped -- Number of dropped frames.
+    dropped_bytes -- Number of dropped bytes.
+    overflows -- Number of times high watermark was exceeded.
+    writes -- Number of write calls made to writer.
+    written_frames -- Number of frames handed to writer.
+    written_bytes -- Number of bytes handed to writer.
+    closed -- If true, frames are no longer accepted.
+    task -- Writer task.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+    __len__ -- Number of queued frames.
+
+    Methods:
+    put -- Add frame to queue.
+    put_many -- Add frames written with one call to queue.
+    room -- Return number of bytes which can be queued without getting above low watermark.
+    start -- Start writer task.
+    run -- Coroutine writing queued frames.
+    flush -- Write all queued frames immediately.
+    close -- Stop writer task and write what is left.
+    stats -- Return counters of queue.
+    """
+    def __init__(self, writer, high_water=HIGH_WATER, low_water=LOW_WATER, policy=DROP_OLDEST, on_disconnect=None,
+                 window=0):
+        """Initialize instance."""
+        if policy not in POLICIES:
+            raise ValueError('Unknown slow consumer policy {!r}.'.format(policy))
+        if low_water > high_water:
+            raise ValueError('Low watermark is greater than high watermark.')
+        self.writer = writer
+        self.high_water = high_water
+        self.low_water = low_water
+        self.policy = policy
+        self.on_disconnect = on_disconnect
+        self.window = window
+        self.frames = deque()
+        self.size = 0
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.overflows = 0
+        self.writes = 0
+        self.written_frames = 0
+        self.written_bytes = 0
+        self.closed = False
+        self.task = None
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        """Number of queued frames."""
+        return len(self.frames)
+
+    def put(self, frame, key=None):
+        """
+        Add frame to queue.
+
+        Args:
+        frame -- Encoded message.
+        key -- Frames with equal keys (other than None) supersede each other under coalesce policy.
+        """
+        self._append(frame, len(frame), key)
+
+    def put_many(self, frames, key=None):
+        """
+        Add frames written with one call to queue.
+
+        Frames are one entry of queue, they are written and dropped together.
+
+        Args:
+        frames -- List of encoded messages.
+        key -- Entries with equal keys (other than None) supersede each other under coalesce policy.
+        """
+        self._append(frames, _size(frames), key)
+
+    def room(self):
+        """Return number of bytes which can be queued without getting above low watermark."""
+        return max(0, self.low_water - self.size)
+
+    def start(self):
+        """Start writer task."""
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        """Coroutine writing all queued frames at once, it waits for transport to drain after each write."""
+        while True:
+            if not self.frames:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            if self.window:
+                await asyncio.sleep(self.window)
+            if self.frames:
+                self._write()
+                await self.writer.drain()
+
+    def flush(self):
+        """Write all queued frames immediately, without waiting for transport."""
+        if self.frames:
+            self._write()
+
+    def close(self):
+        """
+        Stop writer task and write what is left.
+
+        Frames left in queue are handed to transport, which sends them before it is closed.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self.flush()
+        self.closed = True
+
+    def stats(self):
+        """Return dictionary with counters of queue."""
+        return {
+            'frames': len(self.frames),
+            'bytes': self.size,
+            'dropped': self.dropped,
+            'dropped_bytes': self.dropped_bytes,
+            'overflows': self.overflows,
+            'writes': self.writes,
+            'written_frames': self.written_frames,
+            'written_bytes': self.written_bytes,
+        }
+
+    def _write(self):
+        """Hand all queued frames to writer with one call."""
+        frames = []
+        for data, _ in self.frames:
+            if isinstance(data, list):
+                frames.extend(data)
+            else:
+                frames.append(data)
+        self.frames.clear()
+        self.writes += 1
+        self.written_frames += len(frames)
+        self.written_bytes += self.size
+        self.size = 0
+        if len(frames) == 1:
+            self.writer.write(frames[0])
+        else:
+            self.writer.writelines(frames)
+
+    def _append(self, data, size, key):
+        """Add entry to queue and apply policy if it's too long."""
+        if self.closed:
+            self._drop(data)
+            return
+        self.frames.append((data, key))
+        self.size += size
+        if self.size > self.high_water:
+            self._overflow()
+        self._wakeup.set()
+
+    def _drop(self, data):
+        """Count frame or list of frames as dropped."""
+        if isinstance(data, list):
+            self.dropped += len(data)
+        else:
+            self.dropped += 1
+        self.dropped_bytes += _size(data)
+
+    def _drop_oldest(self):
+        """Drop oldest frames until size is at low watermark, newest frame is always kept."""
+        while self.size > self.low_water and len(self.frames) > 1:
+            data, _ = self.frames.popleft()
+            self.size -= _size(data)
+            self._drop(data)
+
+    def _coalesce(self):
+        """Drop frames superseded by newer frame with the same key."""
+        seen = set()
+        kept = deque()
+        for data, key in reversed(self.frames):
+            if key is not None:
+                if key in seen:
+                    self.size -= _size(data)
+                    self._drop(data)
+                    continue
+                seen.add(key)
+            kept.appendleft((data, key))
+        self.frames = kept
+
+    def _overflow(self):
+        """Apply slow consumer policy."""
+        self.overflows += 1
+        if self.policy == DISCONNECT:
+            for data, _ in self.frames:
+                self._drop(data)
+            self.frames.clear()
+            self.size = 0
+            self.closed = True
+            if self.on_disconnect is not None:
+                self.on_disconnect()
+            return
+        if self.policy == COALESCE:
+            self._coalesce()
+        self._drop_oldest()
+
+
+def _size(data):
+    """Return number of bytes in frame or list of frames."""
+    if isinstance(data, list):
+        return sum(map(len, data))
+    return len(data)
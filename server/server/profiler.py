@@ -0,0 +1,136 @@
+"""
+Module defines sampling profiler which can be turned on and off in running server.
+
+Profiler thread looks at stack of event loop thread at fixed interval and counts how many times each stack was seen.
+Server keeps running at full speed between samples, so profiler can be used under production traffic, and nothing
+is counted while it's off. When profiler is stopped, counts are written in collapsed stack format understood by
+flamegraph.pl, speedscope and similar tools, one stack per line:
+outermost;...;innermost count
+Each function is written as name (file:first line). Samples taken while event loop waits for events end in selector
+functions, so they show how busy server was.
+
+Classes:
+Profiler -- Sampling profiler of one thread.
+"""
+import os
+import sys
+import threading
+import time
+
+INTERVAL = 0.001
+
+
+class Profiler:
+    """
+    Sampling profiler of one thread.
+
+    Properties:
+    running -- If true, profiler is sampling.
+
+    Instance attributes:
+    directory -- Directory collapsed stacks are written to.
+    interval -- Seconds between samples.
+    thread_id -- Identifier of profiled thread.
+    stacks -- Map tuples of code objects, outermost first, to number of samples they were seen in.
+    samples -- Number of taken samples.
+    started -- Time profiler was started at, None when it's not running.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    start -- Start sampling calling thread.
+    stop -- Stop sampling and write collapsed stacks.
+    toggle -- Start profiler if it's stopped, stop it otherwise.
+    collapsed -- Return collected stacks in collapsed format.
+    """
+    def __init__(self, directory=None, interval=INTERVAL):
+        """
+        Initialize instance.
+
+        Args:
+        directory -- Directory collapsed stacks are written to, current directory is used if it's None.
+        interval -- Seconds between samples.
+        """
+        self.directory = directory if directory is not None else os.getcwd()
+        self.interval = interval
+        self.thread_id = None
+        self.stacks = {}
+        self.samples = 0
+        self.started = None
+        self._thread = None
+        self._stopping = threading.Event()
+
+    @property
+    def running(self):
+        """If true, profiler is sampling."""
+        return self._thread is not None
+
+    def start(self):
+        """Start sampling calling thread, counts of previous run are discarded."""
+        if self.running:
+            return
+        self.thread_id = threading.get_ident()
+        self.stacks = {}
+        self.samples = 0
+        self.started = time.time()
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop sampling and write collapsed stacks.
+
+        Returns:
+        Path of written file, named profile-PID-TIME.folded, None if profiler wasn't running.
+        """
+        if not self.running:
+            return None
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        name = 'profile-%d-%s.folded' % (os.getpid(), time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started)))
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as output:
+            output.write(self.collapsed())
+        self.started = None
+        return path
+
+    def toggle(self):
+        """
+        Start profiler if it's stopped, stop it otherwise.
+
+        Returns:
+        Path of written file if profiler was stopped, None if it was started.
+        """
+        if self.running:
+            return self.stop()
+        self.start()
+        return None
+
+    def collapsed(self):
+        """Return collected stacks in collapsed format, the most frequent first."""
+        labels = {}
+        lines = []
+        for stack, count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+            for code in stack:
+                if code not in labels:
+                    labels[code] = '%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno)
+            lines.append('%s %d\n' % (';'.join(labels[code] for code in stack), count))
+        return ''.join(lines)
+
+    def _run(self):
+        """Take samples until profiler is stopped."""
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code)
+                frame = frame.f_back
+            stack.reverse()
+            stack = tuple(stack)
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
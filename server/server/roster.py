@@ -0,0 +1,222 @@
+"""
+Module defines sorted index of active nicks answering active messages and feed pushing its changes to clients.
+
+Clients which agreed on presence feature get presence message with joined section listing all active nicks when they
+are welcomed. Then they get presence messages with joined and left sections whenever users come and go, each section
+lists nicks each followed by newline. Changes are collected for interval and sent as one message, a nick which joined
+and left within the interval isn't sent at all, so mass reconnect costs each subscriber a few messages instead of one
+per user.
+
+Classes:
+Roster -- Sorted nicks of active users with cached listing.
+RosterFeed -- Batched notifications of changes of roster for clients which agreed on presence feature.
+
+Functions:
+prefix_end -- Return the smallest bytes greater than every bytes starting with prefix.
+"""
+import asyncio
+from bisect import bisect_left
+from itertools import accumulate
+from protocol.message import OutgoingMessage
+
+YOU = b' (you)'
+INTERVAL = 0.05
+
+
+class Roster:
+    """
+    Sorted nicks of active users with cached listing.
+
+    Nicks are kept in sorted list updated with bisect when users come and go, so nothing is sorted when users are
+    listed. Listing of all nicks, each followed by newline, is joined once after membership changes and reused by
+    every request until the next change. Nicks starting with prefix are a contiguous part of the listing found by
+    bisection, so listing them costs only copying their bytes.
+
+    Instance attributes:
+    nicks -- Sorted list of nicks.
+    on_change -- Function called with nick and True when it's added or False when it's removed, None if nothing
+    listens to changes.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+    __contains__ -- Check if nick is active.
+    __iter__ -- Iterate over nicks in order.
+    __len__ -- Number of nicks.
+
+    Methods:
+    add -- Add nick.
+    discard -- Remove nick if it's present.
+    listing -- Return nicks starting with prefix, each followed by newline.
+    """
+    def __init__(self, nicks=(), on_change=None):
+        """Initialize instance."""
+        self.nicks = sorted(set(nicks))
+        self.on_change = on_change
+        self._listing = None
+        self._offsets = None
+
+    def __contains__(self, nick):
+        """Check if nick is active."""
+        index = bisect_left(self.nicks, nick)
+        return index < len(self.nicks) and self.nicks[index] == nick
+
+    def __iter__(self):
+        """Iterate over nicks in order."""
+        return iter(self.nicks)
+
+    def __len__(self):
+        """Number of nicks."""
+        return len(self.nicks)
+
+    def add(self, nick):
+        """Add nick, cached listing is dropped."""
+        index = bisect_left(self.nicks, nick)
+        if index == len(self.nicks) or self.nicks[index] != nick:
+            self.nicks.insert(index, nick)
+            self._listing = None
+            if self.on_change is not None:
+                self.on_change(nick, True)
+
+    def discard(self, nick):
+        """Remove nick if it's present, cached listing is dropped."""
+        index = bisect_left(self.nicks, nick)
+        if index < len(self.nicks) and self.nicks[index] == nick:
+            del self.nicks[index]
+            self._listing = None
+            if self.on_change is not None:
+                self.on_change(nick, False)
+
+    def listing(self, prefix=b'', you=None):
+        """
+        Return nicks starting with prefix, each followed by newline.
+
+        Args:
+        prefix -- Only nicks starting with it are listed, empty prefix lists everyone.
+        you -- Nick of asking user, it's marked with (you) if it's listed.
+
+        Returns:
+        Bytes.
+        """
+        if self._listing is None:
+            self._listing = b''.join(nick + b'\n' for nick in self.nicks)
+            self._offsets = [0]
+            self._offsets.extend(accumulate(len(nick) + 1 for nick in self.nicks))
+        start, end = 0, len(self.nicks)
+        if prefix:
+            start = bisect_left(self.nicks, prefix)
+            after = prefix_end(prefix)
+            if after is not None:
+                end = bisect_left(self.nicks, after, start)
+        begin, finish = self._offsets[start], self._offsets[end]
+        if you is not None:
+            index = bisect_left(self.nicks, you, start, end)
+            if index < end and self.nicks[index] == you:
+                split = self._offsets[index] + len(you)
+                return b''.join((self._listing[begin:split], YOU, self._listing[split:finish]))
+        if begin == 0 and finish == len(self._listing):
+            return self._listing
+        return self._listing[begin:finish]
+
+
+class RosterFeed:
+    """
+    Batched notifications of changes of roster for clients which agreed on presence feature.
+
+    Instance attributes:
+    roster -- Roster whose changes are sent, feed sets its on_change.
+    interval -- Seconds changes are collected for before they are sent.
+    subscribers -- Clients getting notifications.
+    pending -- Map nicks to True if they joined or False if they left since last notification.
+    handle -- Handle of scheduled notification, None if nothing is scheduled.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    subscribe -- Send roster to client and notify it about its changes from now on.
+    unsubscribe -- Stop notifying client.
+    changed -- Remember change of roster and schedule notification.
+    flush -- Send collected changes to subscribers.
+    stop -- Cancel scheduled notification.
+    """
+    def __init__(self, roster, interval=INTERVAL):
+        """Initialize instance."""
+        self.roster = roster
+        self.interval = interval
+        self.subscribers = set()
+        self.pending = {}
+        self.handle = None
+        self._snapshot = (None, None)
+        roster.on_change = self.changed
+
+    def subscribe(self, client):
+        """
+        Send roster to client and notify it about its changes from now on.
+
+        Clients welcomed between two changes get the same message, it's encoded once for each framing.
+        """
+        listing = self.roster.listing()
+        cached, message = self._snapshot
+        if cached is not listing:
+            message = OutgoingMessage(type=b'presence', joined=listing)
+            self._snapshot = (listing, message)
+        client.send(message.encode(client.framing))
+        self.subscribers.add(client)
+
+    def unsubscribe(self, client):
+        """Stop notifying client."""
+        self.subscribers.discard(client)
+
+    def changed(self, nick, joined):
+        """
+        Remember change of roster and schedule notification.
+
+        Args:
+        nick -- Changed nick.
+        joined -- True if nick was added, False if it was removed.
+        """
+        if not self.subscribers:
+            return
+        if self.pending.get(nick, joined) != joined:
+            # Nick came back or left within interval, subscribers still know it the way they knew it before.
+            del self.pending[nick]
+        else:
+            self.pending[nick] = joined
+        if self.handle is None:
+            self.handle = asyncio.get_running_loop().call_later(self.interval, self.flush)
+
+    def flush(self):
+        """Send collected changes to subscribers as one message."""
+        self.handle = None
+        if not self.pending:
+            return
+        sections = {}
+        joined = b''.join(nick + b'\n' for nick, has_joined in self.pending.items() if has_joined)
+        if joined:
+            sections['joined'] = joined
+        left = b''.join(nick + b'\n' for nick, has_joined in self.pending.items() if not has_joined)
+        if left:
+            sections['left'] = left
+        self.pending = {}
+        message = OutgoingMessage(type=b'presence', **sections)
+        for client in self.subscribers:
+            client.send(message.encode(client.framing))
+
+    def stop(self):
+        """Cancel scheduled notification."""
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+
+
+def prefix_end(prefix):
+    """
+    Return the smallest bytes greater than every bytes starting with prefix.
+
+    Returns:
+    Bytes, None if there is no such bytes (prefix consists of 0xff bytes).
+    """
+    prefix = prefix.rstrip(b'\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + bytes([prefix[-1] + 1])
@@ -3,14 +3,36 @@ Main script for chat server.
 
 Functions:
 sigint_handler -- Handle keyboard interrupt.
-coro_wrapper -- Wrapper around coroutine handling connection.
-clean_up -- Release resources.
+sigterm_handler -- Shut server down gracefully.
+sigusr1_handler -- Start or stop profiler.
+stop_workers -- Ask worker processes to stop.
+profile_workers -- Ask worker processes to start or stop their profilers.
+run_server -- Run server until it's stopped.
+run_workers -- Run bus and worker processes until they are stopped.
 main -- Main script.
 """
 import asyncio
+import logging
+import multiprocessing
+import os
+import shutil
 import signal
+import tempfile
+from protocol import loops
 from . import server
-from . import message
+from . import outbound
+from . import workers
+from . import federation
+from . import history
+from . import journal
+from . import metrics
+from . import profiler
+from . import watchdog
+from . import roster
+from . import limits
+from . import keepalive
+from . import handoff
+from . import sessions
 from argparse import ArgumentParser, SUPPRESS
 
 
@@ -23,20 +45,246 @@ def sigint_handler(serverobj):
     serverobj.stop_server()
 
 
+def sigterm_handler(serverobj, drain_timeout, signals):
+    """
+    Shut server down gracefully.
+
+    Clients are told server is shutting down and get what was queued for them, second of signals stops server at once.
+    """
+    for signum in signals:
+        serverobj.loop.add_signal_handler(signum, sigint_handler, serverobj)
+    serverobj.loop.create_task(serverobj.drain(drain_timeout))
+
+
+def sigusr1_handler(profilerobj):
+    """
+    Start or stop profiler.
+
+    Collapsed stacks are written when profiler is stopped.
+    """
+    profilerobj.toggle()
+
+
+def stop_workers(processes):
+    """
+    Ask worker processes to stop.
+
+    Keyboard interrupt reaches whole process group, so workers ignore SIGINT and are sent SIGTERM from here instead,
+    once per signal master process gets. First one drains them, second one stops them at once.
+    """
+    for process in processes:
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGTERM)
+
+
+def profile_workers(processes):
+    """Ask worker processes to start or stop their profilers, each of them writes its own file."""
+    for process in processes:
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGUSR1)
+
+
+def run_server(args, bus_path=None, worker=None):
+    """
+    Run server until it's stopped.
+
+    Args:
+    args -- Parsed command line arguments.
+    bus_path -- Path of Unix socket of bus, if it's given server runs as one of workers.
+    worker -- Number of worker, each worker keeps its log in its own subdirectory.
+    """
+    # Blocks until old server is drained, so it's done before anything here opens log or ports.
+    sock = handoff.take_over(args.takeover) if args.takeover is not None else None
+    loop = loops.new_event_loop(args.loop)
+    outbound_options = dict(high_water=args.high_water, low_water=args.low_water, policy=args.slow_policy,
+                            window=args.write_window / 1e6)
+    if bus_path is not None:
+        presence = workers.BusLink(bus_path)
+    elif args.node is not None:
+        presence = federation.Federation(args.node.encode(), [peer.encode() for peer in args.peer])
+    else:
+        presence = None
+    if args.history_messages > 0 and args.history_bytes > 0:
+        recent = history.History(args.history_messages, args.history_bytes)
+    else:
+        recent = None
+    if args.journal is not None:
+        directory = args.journal if worker is None else os.path.join(args.journal, 'worker-%d' % worker)
+        log = journal.Journal(directory, args.segment_size, args.flush_interval)
+    else:
+        log = None
+    if args.metrics_port is None and args.metrics_path is None:
+        counters = None
+    elif worker is None:
+        counters = metrics.Metrics(args.metrics_port, args.metrics_path)
+    else:
+        counters = metrics.Metrics(None if args.metrics_port is None else args.metrics_port + worker,
+                                   None if args.metrics_path is None else '%s.%d' % (args.metrics_path, worker))
+    if args.slow_threshold > 0:
+        monitor = watchdog.Watchdog(args.lag_interval, args.slow_threshold, counters)
+    else:
+        monitor = None
+    if any(limit is not None for limit in (args.max_connections, args.accept_rate, args.message_rate, args.byte_rate,
+                                           args.max_frame_size)):
+        bounds = limits.Limits(args.max_connections, args.accept_rate, args.message_rate, args.byte_rate,
+                               args.max_frame_size)
+    else:
+        bounds = None
+    if args.idle_timeout > 0:
+        reaper = keepalive.Keepalive(args.ping_interval, args.idle_timeout)
+    else:
+        reaper = None
+    parked = sessions.Sessions(args.resume_timeout) if args.resume_timeout > 0 else None
+    serverobj = server.Server(loop, server.RECV_HANDLERS, args.address, args.port, outbound_options, presence=presence,
+                              reuse_port=bus_path is not None, history=recent, journal=log, metrics=counters,
+                              watchdog=monitor, roster_interval=args.roster_interval, limits=bounds,
+                              keepalive=reaper, sock=sock, sessions=parked)
+    if worker is None:
+        signals = (signal.SIGINT, signal.SIGTERM)
+    else:
+        # Master process passes keyboard interrupt on, see stop_workers.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signals = (signal.SIGTERM,)
+    for signum in signals:
+        loop.add_signal_handler(signum, sigterm_handler, serverobj, args.drain_timeout, signals)
+    profilerobj = profiler.Profiler(args.profile_dir, args.profile_interval)
+    loop.add_signal_handler(signal.SIGUSR1, sigusr1_handler, profilerobj)
+
+    if args.handoff is not None:
+        loop.run_until_complete(serverobj.create_server())
+        offering = loop.create_task(handoff.offer(serverobj, args.handoff, args.drain_timeout))
+        loop.run_until_complete(serverobj.listening)
+        offering.cancel()
+        loop.run_until_complete(asyncio.gather(offering, return_exceptions=True))
+    else:
+        serverobj.start_server()
+    loop.run_until_complete(serverobj.server.wait_closed())
+    profilerobj.stop()
+    loop.close()
+
+
+def run_workers(args):
+    """
+    Run bus and worker processes until they are stopped.
+
+    Workers are started with spawn method, so they don't inherit event loop of master process.
+    """
+    directory = tempfile.mkdtemp(prefix='chatserver-')
+    path = os.path.join(directory, 'bus')
+    loop = loops.new_event_loop(args.loop)
+    bus = workers.Bus()
+    bus_server = loop.run_until_complete(asyncio.start_unix_server(bus.handle_link, path))
+
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_server, args=(args, path, i)) for i in range(args.workers)]
+    for process in processes:
+        process.start()
+    loop.add_signal_handler(signal.SIGINT, stop_workers, processes)
+    loop.add_signal_handler(signal.SIGTERM, stop_workers, processes)
+    loop.add_signal_handler(signal.SIGUSR1, profile_workers, processes)
+    loop.run_until_complete(asyncio.gather(*(loop.run_in_executor(None, process.join) for process in processes)))
+
+    bus_server.close()
+    loop.run_until_complete(bus_server.wait_closed())
+    loop.close()
+    shutil.rmtree(directory)
+
+
 def main():
     parser = ArgumentParser(description='Chat server.')
     parser.add_argument('address', default=SUPPRESS, help='Server address.')
     parser.add_argument('port', default=SUPPRESS, help="Server port.")
+    parser.add_argument('--high-water', type=int, default=outbound.HIGH_WATER,
+                        help='Bytes queued for client above which slow consumer policy is applied.')
+    parser.add_argument('--low-water', type=int, default=outbound.LOW_WATER,
+                        help='Bytes queued for client slow consumer policy tries to get back to.')
+    parser.add_argument('--slow-policy', choices=outbound.POLICIES, default=outbound.DROP_OLDEST,
+                        help='What to do with client which doesn\'t keep up with its messages.')
+    parser.add_argument('--write-window', type=int, default=0,
+                        help='Microseconds to wait for more frames before writing to client, 0 combines only frames '
+                             'queued in one loop iteration.')
+    parser.add_argument('--loop', choices=loops.LOOPS, default='auto',
+                        help='Event loop implementation, auto uses uvloop when it is installed.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of worker processes listening on the same port.')
+    parser.add_argument('--node', help='Address host:port on which server listens for other servers of mesh.')
+    parser.add_argument('--peer', action='append', default=[],
+                        help='Address host:port of other server of mesh, it should be given for every server.')
+    parser.add_argument('--history-messages', type=int, default=history.MAX_MESSAGES,
+                        help='Number of recent messages replayed to joining users, 0 turns history off.')
+    parser.add_argument('--history-bytes', type=int, default=history.MAX_BYTES,
+                        help='Maximal total size of contents of recent messages kept for replay, 0 turns history '
+                             'off. Encoded frames are kept with them, so history takes up to about four times more '
+                             'memory.')
+    parser.add_argument('--journal', help='Directory of persistent log of messages, nothing is logged without it.')
+    parser.add_argument('--segment-size', type=int, default=journal.SEGMENT_SIZE,
+                        help='Size of log file in bytes after which new one is started.')
+    parser.add_argument('--flush-interval', type=float, default=journal.FLUSH_INTERVAL,
+                        help='Seconds between writes of logged messages to disk.')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Localhost port of HTTP endpoint with metrics in Prometheus format, worker N listens on '
+                             'port plus N. Metrics are turned off without it or --metrics-path.')
+    parser.add_argument('--metrics-path',
+                        help='Path of Unix socket of HTTP endpoint with metrics, worker N listens on path.N.')
+    parser.add_argument('--profile-dir',
+                        help='Directory profiles are written to, current directory is used without it. SIGUSR1 starts '
+                             'sampling profiler, next SIGUSR1 stops it and writes profile-PID-TIME.folded.')
+    parser.add_argument('--profile-interval', type=float, default=profiler.INTERVAL,
+                        help='Seconds between samples of profiler.')
+    parser.add_argument('--roster-interval', type=float, default=roster.INTERVAL,
+                        help='Seconds joins and leaves of users are collected for before they are pushed to clients '
+                             'which agreed on presence feature.')
+    parser.add_argument('--slow-threshold', type=float, default=0,
+                        help='Seconds of event loop lag or handler time above which warning is logged. Watchdog is '
+                             'off by default, handlers aren\'t timed then, give positive value (e.g. {}) to turn it '
+                             'on.'.format(watchdog.THRESHOLD))
+    parser.add_argument('--lag-interval', type=float, default=watchdog.INTERVAL,
+                        help='Seconds between measurements of event loop lag.')
+    parser.add_argument('--max-connections', type=int,
+                        help='Maximal number of connected clients, with workers it\'s limit of each worker.')
+    parser.add_argument('--accept-rate', type=float,
+                        help='Maximal number of accepted connections per second, with workers it\'s limit of each '
+                             'worker.')
+    parser.add_argument('--message-rate', type=float,
+                        help='Maximal number of messages per second read from each client, client isn\'t read while '
+                             'it\'s above the rate.')
+    parser.add_argument('--byte-rate', type=float,
+                        help='Maximal number of bytes per second read from each client.')
+    parser.add_argument('--max-frame-size', type=int,
+                        help='Maximal length of received message in bytes, client sending longer message is '
+                             'disconnected.')
+    parser.add_argument('--ping-interval', type=float, default=keepalive.PING_INTERVAL,
+                        help='Seconds without data from client after which it\'s pinged, if it agreed on keepalive.')
+    parser.add_argument('--idle-timeout', type=float, default=keepalive.IDLE_TIMEOUT,
+                        help='Seconds without data from client after which it\'s disconnected, clients without '
+                             'keepalive only before they said hello. 0 keeps idle clients forever.')
+    parser.add_argument('--drain-timeout', type=float, default=server.DRAIN_TIMEOUT,
+                        help='Seconds clients have to get queued messages when server shuts down on SIGTERM or '
+                             'SIGINT, second signal stops server at once.')
+    parser.add_argument('--handoff',
+                        help='Path of Unix socket on which listening socket is offered to new server started with '
+                             '--takeover, old server drains and exits once it\'s taken.')
+    parser.add_argument('--takeover',
+                        help='Path of Unix socket of running server started with --handoff, its listening socket is '
+                             'taken over instead of opening new one.')
+    parser.add_argument('--resume-timeout', type=float, default=sessions.TIMEOUT,
+                        help='Seconds nick and rooms of client which agreed on resume are kept after its connection '
+                             'was lost, 0 turns resume off.')
     args = parser.parse_args()
+    if 0 < args.idle_timeout <= args.ping_interval:
+        parser.error('--ping-interval has to be shorter than --idle-timeout')
+    if args.low_water > args.high_water:
+        parser.error('--low-water can\'t be greater than --high-water')
+    logging.basicConfig(format='%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s')
+    if args.node is not None and args.workers > 1:
+        parser.error('--node can\'t be used with more than one worker')
+    if (args.handoff is not None or args.takeover is not None) and args.workers > 1:
+        parser.error('--handoff and --takeover can\'t be used with more than one worker')
 
-    loop = asyncio.get_event_loop()
-    handlers = message.get_handlers(server)
-    serverobj = server.Server(loop, handlers, args.address, args.port)
-    loop.add_signal_handler(signal.SIGINT, sigint_handler, serverobj)
-
-    serverobj.start_server()
-    loop.run_until_complete(serverobj.server.wait_closed())
-    loop.close()
+    if args.workers > 1:
+        run_workers(args)
+    else:
+        run_server(args)
 
 
 if __name__ == '__main__':
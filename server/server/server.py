@@ -1,5 +1,6 @@
 """
-Module defines classes and functions to handle client connections.
+Module defines classes and functions to handle client connections, handlers of messages are registered in
+RECV_HANDLERS.
 
 Classes:
 DisconnectedError -- Exception raised when connection is closed.
@@ -7,13 +8,43 @@ Client -- Class storing information about client.
 Server -- Class storing information about server.
 
 Functions:
+broadcast -- Write one message to many clients.
+welcome -- Remember nickname of client and agree on features.
+replay -- Send recent messages of room from history to client.
+resumable -- Return session client resumes with its hello message.
 recv_hello -- Handler called when client checks if nickname is available.
 recv_text -- Handler called when client sends text message.
 recv_active -- Handler called when client wants to know active users.
+recv_msg -- Handler called when client sends private message.
+recv_join -- Handler called when client joins room.
+recv_part -- Handler called when client leaves room.
+recv_rooms -- Handler called when client wants to know rooms.
+recv_history -- Handler called when client wants last messages from log.
+recv_ping -- Handler called when client checks if connection works.
+recv_pong -- Handler called when client answered ping.
 """
 import asyncio
 import functools
-from .message import cut_message, create_message
+import time
+from protocol.message import FrameParser, FrameTooLargeError, CorruptFrameError, MalformedMessageError
+from protocol.message import OutgoingMessage, Registry
+from protocol.message import create_message, payload
+from protocol.message import CHUNK_SIZE
+from protocol.message import ENCODERS, TEXT_FRAMING, BINARY_FRAMING, DEFLATE, PRESENCE, KEEPALIVE, RESUME
+from .outbound import OutboundQueue
+from .roster import Roster, RosterFeed, INTERVAL as ROSTER_INTERVAL
+from .sessions import Session
+
+# Features server can agree on in hello message.
+FEATURES = frozenset([BINARY_FRAMING, DEFLATE, PRESENCE, KEEPALIVE, RESUME])
+# Maximal number of messages client can get from log at once.
+HISTORY_LIMIT = 1000
+# Seconds refused client has to close connection after it got reason, its data is discarded meanwhile.
+REFUSE_TIMEOUT = 1.0
+# Seconds clients have to get frames queued for them when server shuts down gracefully.
+DRAIN_TIMEOUT = 5.0
+# Handlers of messages received from clients, functions below register themselves.
+RECV_HANDLERS = Registry()
 
 
 class DisconnectedError(Exception):
@@ -27,173 +58,917 @@ class Client:
 
     Properties:
     nicks_clients -- Mapping nicks of all active users to client instances.
+    roster -- Sorted nicks of active users of this server and of other servers sharing presence layer.
+    roster_feed -- Notifications of changes of roster for clients which agreed on presence feature, None if there are
+    none.
+    rooms_clients -- Mapping names of rooms to sets of their members.
+    presence -- Presence layer shared with other servers or worker processes, None if server is alone.
+    history -- Recently broadcast messages replayed to joining clients, None if they aren't kept.
+    journal -- Persistent log of messages, None if messages aren't logged.
+    metrics -- Counters of server, None if metrics are turned off.
+    watchdog -- Monitor of event loop lag and slow handlers, None if it's turned off.
+    limits -- Limits of data received from client, None if there are none.
+    keepalive -- Reaper of idle clients, None if they are kept forever.
+    sessions -- Sessions of clients whose connection was lost, None if sessions can't be resumed.
 
     Instance attributes:
     reader -- Reader from client.
     writer -- Writer to client.
-    recv_handlers -- Handlers called when message is received.
+    recv_handlers -- Registry of handlers called when message is received.
     nick -- Nickname of client.
     receivers -- Receivers of messages, if it is empty messages go to everyone.
     con_handling -- Task handling connection.
+    outbound -- Queue of frames waiting to be written to client.
+    features -- Features agreed on in hello message.
+    framing -- Framing of messages sent to client, deflate or binary if it was agreed on.
+    rooms -- Names of rooms client is member of.
+    last_read -- time.monotonic() when data was last read from client.
+    token -- Token client can resume its session with, None if it didn't agree on resume.
+    parser -- Parser of data read from client, None until connection is handled.
 
     Magic methods:
     __init__ -- Initialize instance.
 
     Methods:
     handle_connection -- Read message from client and handle it.
+    send -- Queue frame to be written to client.
+    send_many -- Queue frames to be written to client with one call.
+    create_message -- Create message in framing of client.
+    disconnect -- Stop handling connection.
+    join -- Become member of room.
+    part -- Stop being member of room.
     """
     _nicks_clients = {}
+    _roster = Roster()
+    _roster_feed = None
+    _rooms_clients = {}
+    _presence = None
+    _history = None
+    _journal = None
+    _metrics = None
+    _watchdog = None
+    _limits = None
+    _keepalive = None
+    _sessions = None
+
+    def __init__(self, reader, writer, recv_handlers, nick=None, outbound_options=None):
+        """
+        Initialize instance.
 
-    def __init__(self, reader, writer, recv_handlers, nick=None):
-        """Initialize instance."""
+        Args:
+        outbound_options -- Keyword arguments of OutboundQueue (high_water, low_water, policy).
+        """
         self.reader = reader
         self.writer = writer
         self.recv_handlers = recv_handlers
         self.nick = nick
         self.receivers = set()
         self.con_handling = None
+        self.outbound = OutboundQueue(writer, on_disconnect=self.disconnect, **(outbound_options or {}))
+        self.features = frozenset()
+        self.framing = TEXT_FRAMING
+        self.rooms = set()
+        self.last_read = time.monotonic()
+        self.token = None
+        self.parser = None
 
     @property
     def nicks_clients(self):
         return self.__class__._nicks_clients
 
+    @property
+    def roster(self):
+        return self.__class__._roster
+
+    @property
+    def roster_feed(self):
+        return self.__class__._roster_feed
+
+    @property
+    def rooms_clients(self):
+        return self.__class__._rooms_clients
+
+    @property
+    def presence(self):
+        return self.__class__._presence
+
+    @property
+    def history(self):
+        return self.__class__._history
+
+    @property
+    def journal(self):
+        return self.__class__._journal
+
+    @property
+    def metrics(self):
+        return self.__class__._metrics
+
+    @property
+    def watchdog(self):
+        return self.__class__._watchdog
+
+    @property
+    def limits(self):
+        return self.__class__._limits
+
+    @property
+    def keepalive(self):
+        return self.__class__._keepalive
+
+    @property
+    def sessions(self):
+        return self.__class__._sessions
+
     async def handle_connection(self):
         """
         Read message from client and handle it.
 
-        Data is read line by line until line indicating end of message is read. Then message is interpreted and handled.
+        Data is read in large chunks and fed to FrameParser in lazy mode, each message completed by the chunk is handled
+        in order. Sections are unescaped only when handlers read them, text is forwarded without being copied.
+        Handler can return coroutine, next message is handled after it's done. With metrics or watchdog turned on,
+        handlers are timed, metrics count them with received bytes, including coroutines they return, parsing of their
+        message and lookup of handler. Watchdog reports
+        handlers whose call took longer than its threshold, coroutine waiting for presence layer or log doesn't block
+        event loop, so it isn't counted. With limits, client isn't read while its token buckets of
+        bytes or messages are empty, message longer than maximal frame size ends connection. Malformed binary message,
+        one which can't be inflated, one sent before its framing was agreed on and message of unknown type or without
+        section its handler needs end connection too, client is told why. Time of each read is remembered for
+        keepalive.
+        Frames queued for client are written by separate task started here, what is left in queue when connection
+        ends for any reason is handed to transport before it is closed.
         """
+        self.outbound.start()
+        limits = self.limits
+        # Binary and compressed messages are accepted once their framing is agreed on in hello, see welcome.
+        if limits is not None:
+            parser = FrameParser(lazy=True, max_size=limits.max_frame_size, binary=False, deflate=False)
+            messages, received = limits.message_bucket(), limits.byte_bucket()
+        else:
+            parser = FrameParser(lazy=True, binary=False, deflate=False)
+            messages, received = None, None
+        self.parser = parser
+        check = self.recv_handlers.check
+        metrics = self.metrics
+        handled = metrics.handled if metrics is not None else None
+        watchdog = self.watchdog
+        perf_counter_ns = time.perf_counter_ns
         try:
             while True:
-                msg_lines = []
-                while True:
-                    msg_line = await self.reader.readline()
-                    if not msg_line:
-                        raise DisconnectedError
-                    msg_lines.append(msg_line)
-                    if msg_line == b'#\n':
-                        break
-                message = cut_message(msg_lines)
-                self.recv_handlers[message[b'type']](message=message, client=self)
+                data = await self.reader.read(CHUNK_SIZE)
+                if not data:
+                    raise DisconnectedError
+                self.last_read = time.monotonic()
+                if received is not None:
+                    delay = received.take(len(data))
+                    if delay:
+                        await asyncio.sleep(delay)
+                if metrics is None and watchdog is None and messages is None:
+                    for message in parser.feed(data):
+                        _, handler = check(message)
+                        result = handler(message=message, client=self)
+                        if asyncio.iscoroutine(result):
+                            await result
+                    continue
+                if metrics is not None:
+                    metrics.bytes_in += len(data)
+                # Timestamps are chained, end of one message is start of the next one, so counted message costs one
+                # clock read. Parsing and lookup of handler are counted with the message.
+                start = perf_counter_ns()
+                for message in parser.feed(data):
+                    if messages is not None:
+                        delay = messages.take()
+                        if delay:
+                            await asyncio.sleep(delay)
+                            start = perf_counter_ns()
+                    msg_type, handler = check(message)
+                    result = handler(message=message, client=self)
+                    if watchdog is not None:
+                        blocked = perf_counter_ns() - start
+                        if blocked > watchdog.threshold_ns:
+                            watchdog.slow_handler(msg_type, len(message.frame), blocked, self.nick)
+                    if asyncio.iscoroutine(result):
+                        await result
+                    if handled is not None:
+                        end = perf_counter_ns()
+                        handled(msg_type, end - start)
+                        start = end
+                    elif watchdog is not None:
+                        start = perf_counter_ns()
         except (asyncio.CancelledError, DisconnectedError):
             pass
+        except FrameTooLargeError:
+            self.send(self.create_message(type=b'text', text=b'Message is longer than %d bytes.\n' %
+                                          limits.max_frame_size))
+        except CorruptFrameError:
+            self.send(self.create_message(type=b'text', text=b'Message is corrupted.\n'))
+        except MalformedMessageError:
+            self.send(self.create_message(type=b'text', text=b'Message is malformed.\n'))
+        finally:
+            # Connection is closed also when handler failed in other way, exception is still raised.
+            self.outbound.close()
+            self.writer.close()
+
+    def send(self, frame, key=None):
+        """
+        Queue frame to be written to client.
+
+        Args:
+        frame -- Encoded message.
+        key -- Frames with equal keys supersede each other when queue is coalesced.
+        """
+        self.outbound.put(frame, key)
+
+    def send_many(self, frames, key=None):
+        """
+        Queue frames to be written to client with one call.
+
+        Args:
+        frames -- List of encoded messages.
+        key -- Frames with equal keys supersede each other when queue is coalesced.
+        """
+        self.outbound.put_many(frames, key)
 
-        self.writer.close()
+    def create_message(self, **kwargs):
+        """Create message in framing of client, kwargs are the same as of message.create_message."""
+        return ENCODERS[self.framing](**kwargs)
+
+    def disconnect(self):
+        """Stop handling connection."""
+        if self.con_handling is not None:
+            self.con_handling.cancel()
+
+    def join(self, room):
+        """Become member of room, room is created if it doesn't exist."""
+        self.rooms.add(room)
+        self.rooms_clients.setdefault(room, set()).add(self)
+
+    def part(self, room):
+        """Stop being member of room, room is removed when it has no members."""
+        self.rooms.discard(room)
+        members = self.rooms_clients.get(room)
+        if members is not None:
+            members.discard(self)
+            if not members:
+                del self.rooms_clients[room]
 
 
 class Server:
     """
     Class storing information about server.
 
+    Properties:
+    nicks_clients -- Mapping nicks of users of this server to client instances.
+    roster -- Sorted nicks of active users, presence layer adds and removes users of other servers.
+    roster_feed -- Notifications of changes of roster for clients which agreed on presence feature.
+    rooms_clients -- Mapping names of rooms to sets of their members on this server.
+
     Instance attributes:
     loop -- Event loop bound to server.
-    recv_handlers -- Handlers called when message is received.
+    recv_handlers -- Registry of handlers called when message is received.
     address -- Address on which server is listening.
     port -- Port on which server is listening.
     server -- Server object returned after server is created.
     clients -- All clients connected.
+    presence -- Presence layer shared with other servers or worker processes, None if server is alone.
+    history -- Recently broadcast messages replayed to joining clients, None if they aren't kept.
+    journal -- Persistent log of messages, None if messages aren't logged.
+    metrics -- Counters of server and their HTTP endpoint, None if metrics are turned off.
+    watchdog -- Monitor of event loop lag and slow handlers, None if it's turned off.
+    limits -- Limits of connections and of data received from clients, None if there are none.
+    keepalive -- Reaper of idle clients, None if they are kept forever.
+    sessions -- Sessions of clients whose connection was lost, None if sessions can't be resumed.
+    reuse_port -- If true, listening socket is opened with SO_REUSEPORT.
+    sock -- Already listening socket used instead of address and port, for example one taken over from old server.
+    client_class -- Subclass of Client used for clients of this server, it has its own nicks_clients, roster,
+    roster_feed, rooms_clients, history, journal, metrics, watchdog, limits, keepalive and sessions.
     listening -- Future marking if server is listening.
+    outbound_options -- Keyword arguments of OutboundQueue of each client.
+    dropped -- Number of frames dropped for clients which are already disconnected.
+    dropped_bytes -- Number of bytes dropped for clients which are already disconnected.
+    writes -- Number of write calls made for clients which are already disconnected.
+    written_frames -- Number of frames written to clients which are already disconnected.
+    written_bytes -- Number of bytes written to clients which are already disconnected.
+    rejected -- Number of connections refused by limits.
 
     Methods:
     remove_client -- Remove client from clients when connection is closed.
     con_handler -- Wrapper around client_handler.
+    create_server -- Coroutine starting presence layer and listening socket.
     start_server -- Start listening.
     stop_server -- Stop listening.
+    drain -- Coroutine shutting server down gracefully.
+    outbound_stats -- Return counters of outbound queues.
+    deliver -- Handle message received from presence layer.
     """
-    def __init__(self, loop, recv_handlers, address, port):
+    def __init__(self, loop, recv_handlers, address, port, outbound_options=None, presence=None, reuse_port=False,
+                 history=None, journal=None, metrics=None, watchdog=None, roster_interval=ROSTER_INTERVAL,
+                 limits=None, keepalive=None, sock=None, sessions=None):
         self.loop = loop
         self.recv_handlers = recv_handlers
         self.address = address
         self.port = port
         self.server = None
         self.clients = set()
-        self.listening = asyncio.Future()
+        self.presence = presence
+        self.history = history
+        self.journal = journal
+        self.metrics = metrics
+        self.watchdog = watchdog
+        self.limits = limits
+        self.keepalive = keepalive
+        self.sessions = sessions
+        self.reuse_port = reuse_port
+        self.sock = sock
+        roster = Roster()
+        self.client_class = type(Client.__name__, (Client,), {'_nicks_clients': {}, '_roster': roster,
+                                                              '_roster_feed': RosterFeed(roster, roster_interval),
+                                                              '_rooms_clients': {}, '_presence': presence,
+                                                              '_history': history, '_journal': journal,
+                                                              '_metrics': metrics, '_watchdog': watchdog,
+                                                              '_limits': limits, '_keepalive': keepalive,
+                                                              '_sessions': sessions})
+        self.listening = loop.create_future()
+        self.outbound_options = outbound_options or {}
+        self.dropped = 0
+        self.dropped_bytes = 0
+        self.writes = 0
+        self.written_frames = 0
+        self.written_bytes = 0
+        self.rejected = 0
+
+    @property
+    def nicks_clients(self):
+        return self.client_class._nicks_clients
+
+    @property
+    def roster(self):
+        return self.client_class._roster
+
+    @property
+    def roster_feed(self):
+        return self.client_class._roster_feed
+
+    @property
+    def rooms_clients(self):
+        return self.client_class._rooms_clients
 
     def remove_client(self, future, client):
         """
         Remove client from clients when connection is closed.
 
+        Session of client which agreed on resume is kept, its nick can't be taken by other clients of this server until
+        session expires. Nick is released in presence layer anyway, since other workers or nodes don't know the token.
+
         Args:
         future -- It's here just so method can be used as callback.
         client -- Client to be removed.
         """
         self.clients.remove(client)
-        if client.nick is not None:
+        self.roster_feed.unsubscribe(client)
+        if self.keepalive is not None:
+            self.keepalive.unwatch(client)
+        self.dropped += client.outbound.dropped
+        self.dropped_bytes += client.outbound.dropped_bytes
+        self.writes += client.outbound.writes
+        self.written_frames += client.outbound.written_frames
+        self.written_bytes += client.outbound.written_bytes
+        # Client whose session was resumed by new connection doesn't own its nick any more.
+        owner = client.nick is not None and client.nicks_clients.get(client.nick) is client
+        if owner and client.token is not None and self.sessions is not None:
+            self.sessions.park(client.token, client.nick, client.rooms)
+        for room in list(client.rooms):
+            client.part(room)
+        if owner:
             del client.nicks_clients[client.nick]
+            client.roster.discard(client.nick)
+            if self.presence is not None:
+                self.presence.release(client.nick)
 
     async def con_handler(self, reader, writer):
         """
         Connection handler.
 
         It just adds created client to clients and sets remove_client to be called after connection is closed.
+        Connection refused by limits gets text message with reason and it's closed.
 
         Args:
         reader -- Reader from client.
         writer -- Writer to client.
         """
-        client = Client(reader, writer, self.recv_handlers)
+        if self.limits is not None:
+            reason = self.limits.admit(len(self.clients))
+            if reason is not None:
+                self.rejected += 1
+                await self._refuse(reader, writer, reason)
+                return None
+        client = self.client_class(reader, writer, self.recv_handlers, outbound_options=self.outbound_options)
         self.clients.add(client)
+        if self.metrics is not None:
+            self.metrics.connections += 1
+        if self.keepalive is not None:
+            self.keepalive.watch(client)
         coro = client.handle_connection()
         handler = self.loop.create_task(coro)
         client.con_handling = handler
         handler.add_done_callback(functools.partial(self.remove_client, client=client))
         return handler
 
+    async def _refuse(self, reader, writer, reason):
+        """
+        Send reason to refused client and close connection.
+
+        Data client sent is read until it closes connection, since closing socket with unread data resets connection
+        and client wouldn't get the reason.
+        """
+        async def discard():
+            while await reader.read(CHUNK_SIZE):
+                pass
+
+        writer.write(create_message(type=b'text', text=reason))
+        try:
+            writer.write_eof()
+            await asyncio.wait_for(discard(), REFUSE_TIMEOUT)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def create_server(self):
+        """Coroutine starting presence layer, log writer, metrics endpoint, watchdog and listening socket."""
+        if self.presence is not None:
+            await self.presence.start(self)
+        if self.metrics is not None:
+            await self.metrics.start(self)
+        if self.watchdog is not None:
+            self.watchdog.start()
+        if self.keepalive is not None:
+            self.keepalive.start()
+        if self.journal is not None:
+            self.journal.start()
+        if self.sock is not None:
+            self.server = await asyncio.start_server(self.con_handler, sock=self.sock)
+        else:
+            self.server = await asyncio.start_server(self.con_handler, self.address, self.port,
+                                                     reuse_port=self.reuse_port or None)
+
     def start_server(self):
         """Start listening."""
-        server_creation = asyncio.start_server(self.con_handler, self.address, self.port)
-        self.server = self.loop.run_until_complete(server_creation)
+        self.loop.run_until_complete(self.create_server())
         self.loop.run_until_complete(self.listening)
 
     def stop_server(self):
-        """Stop listening."""
-        self.listening.set_result(True)
+        """Stop listening, connections are cancelled at once and frames transport didn't send yet can be lost."""
+        if not self.listening.done():
+            self.listening.set_result(True)
         for client in self.clients:
             client.con_handling.cancel()
         self.server.close()
+        self.roster_feed.stop()
+        if self.presence is not None:
+            self.presence.stop()
+        if self.journal is not None:
+            self.journal.close()
+        if self.metrics is not None:
+            self.metrics.stop()
+        if self.watchdog is not None:
+            self.watchdog.stop()
+        if self.keepalive is not None:
+            self.keepalive.stop()
+        if self.sessions is not None:
+            self.sessions.stop()
+
+    async def drain(self, timeout=DRAIN_TIMEOUT, notice=b'Server is shutting down.\n'):
+        """
+        Coroutine shutting server down gracefully.
+
+        Server stops accepting connections, every client gets notice, its queue is handed to transport and connection
+        is closed once transport wrote everything. Connections still writing after timeout are aborted, then server is
+        stopped.
+
+        Args:
+        timeout -- Seconds clients have to get what was queued for them.
+        notice -- Text sent to every client.
+        """
+        self.server.close()
+        clients = list(self.clients)
+        broadcast(OutgoingMessage(type=b'text', text=notice), clients)
+        for client in clients:
+            client.con_handling.cancel()
+        closing = {asyncio.ensure_future(_wait_closed(client.writer)): client.writer for client in clients}
+        if closing:
+            _, pending = await asyncio.wait(closing, timeout=timeout)
+            for future in pending:
+                closing[future].transport.abort()
+                future.cancel()
+        self.stop_server()
+
+    def outbound_stats(self):
+        """
+        Return counters of outbound queues.
 
+        Returns:
+        Dictionary with number of clients, frames and bytes queued in total, size of the longest queue in bytes,
+        number of overflows of connected clients, numbers of frames and bytes dropped, write calls, frames and bytes
+        written since server started.
+        """
+        stats = {
+            'clients': len(self.clients),
+            'frames': 0,
+            'bytes': 0,
+            'max_bytes': 0,
+            'dropped': self.dropped,
+            'dropped_bytes': self.dropped_bytes,
+            'overflows': 0,
+            'writes': self.writes,
+            'written_frames': self.written_frames,
+            'written_bytes': self.written_bytes,
+        }
+        for client in self.clients:
+            queue = client.outbound
+            stats['frames'] += len(queue)
+            stats['bytes'] += queue.size
+            stats['max_bytes'] = max(stats['max_bytes'], queue.size)
+            stats['dropped'] += queue.dropped
+            stats['dropped_bytes'] += queue.dropped_bytes
+            stats['overflows'] += queue.overflows
+            stats['writes'] += queue.writes
+            stats['written_frames'] += queue.written_frames
+            stats['written_bytes'] += queue.written_bytes
+        return stats
+
+    def deliver(self, message):
+        """
+        Handle message received from presence layer.
 
+        Text messages are broadcast to all clients of this server or to members of room and kept in history and log,
+        private messages are sent to their receiver if it's client of this server. Every worker has its own log, so
+        each of them logs all messages and history command gets the same answer from any of them.
+
+        Args:
+        message -- Cut message.
+        """
+        if message[b'type'] == b'msg':
+            receiver = self.nicks_clients.get(message[b'nick'])
+            if receiver is not None:
+                receiver.send(receiver.create_message(type=b'text', text=payload(message, b'text')))
+        elif message[b'type'] == b'text':
+            room = message.get(b'room')
+            if room is None:
+                answer = OutgoingMessage(type=b'text', text=message[b'text'])
+            else:
+                answer = OutgoingMessage(type=b'text', text=message[b'text'], room=room)
+            if self.history is not None:
+                self.history.append(answer, room)
+            if self.journal is not None:
+                self.journal.append(answer)
+            if room is None:
+                broadcast(answer, self.nicks_clients.values())
+            else:
+                broadcast(answer, self.rooms_clients.get(room, ()))
+
+
+async def _wait_closed(writer):
+    """Wait until transport of writer is closed, connection reset counts as closed."""
+    try:
+        await writer.wait_closed()
+    except ConnectionError:
+        pass
+
+
+def broadcast(message, receivers, sender=None):
+    """
+    Write one message to many clients.
+
+    Message is encoded at most once for each framing and the same bytes object is queued for every receiver using that
+    framing, so cost of broadcast is one append per receiver and no copying or escaping.
+
+    Args:
+    message -- OutgoingMessage.
+    receivers -- Iterable of clients, for example nicks_clients.values().
+    sender -- Client which shouldn't get the message, None means nobody is skipped.
+    """
+    for receiver in receivers:
+        if receiver is not sender:
+            receiver.send(message.encode(receiver.framing))
+
+
+def welcome(message, client, session=None):
+    """
+    Remember nickname of client and agree on features.
+
+    If client listed features it supports in hello message, server answers with features message containing those it
+    agreed on, messages after the answer use them. Clients not listing features get no answer, as before. Clients
+    which agreed on deflate feature, only together with binary framing, get compressed messages. Clients which agreed
+    on presence feature get active nicks and their changes from then on. Binary and compressed messages are accepted
+    from client only after it agreed on their framing. Clients which agreed on resume get token in
+    features message. Then recent messages sent to everyone are replayed from history. Client resuming session gets
+    its old token, rejoins its rooms and gets only messages it missed since sequence number in seq section.
+    """
+    nick = message[b'nick']
+    client.nicks_clients[nick] = client
+    client.roster.add(nick)
+    client.nick = nick
+    if b'features' in message:
+        features = [feature for feature in message[b'features'].split() if feature in FEATURES]
+        # Compressed messages are binary ones, sessions can be resumed only if server keeps them.
+        if DEFLATE in features and BINARY_FRAMING not in features:
+            features.remove(DEFLATE)
+        if RESUME in features and client.sessions is None:
+            features.remove(RESUME)
+        if RESUME in features:
+            client.token = session.token if session is not None else client.sessions.new_token()
+            answer = create_message(type=b'features', features=b' '.join(features), token=client.token)
+        else:
+            answer = create_message(type=b'features', features=b' '.join(features))
+        client.send(answer)
+        client.features = frozenset(features)
+        if client.parser is not None:
+            client.parser.binary = BINARY_FRAMING in client.features
+            client.parser.deflate = DEFLATE in client.features
+        if DEFLATE in client.features:
+            client.framing = DEFLATE
+        elif BINARY_FRAMING in client.features:
+            client.framing = BINARY_FRAMING
+        if PRESENCE in client.features and client.roster_feed is not None:
+            client.roster_feed.subscribe(client)
+    if session is None:
+        replay(client)
+        return
+    for room in session.rooms:
+        client.join(room)
+    if client.history is not None:
+        try:
+            after = int(message.get(b'seq', b'0'))
+        except ValueError:
+            after = 0
+        frames = client.history.missed(client.framing, after, session.rooms, nick, client.outbound.room())
+        if frames:
+            client.send_many(frames)
+
+
+def replay(client, room=None):
+    """
+    Send recent messages of room from history to client.
+
+    Messages are queued as one batch, so they are written with one writelines call. Batch fits below low watermark
+    of queue of client, so replay never applies slow consumer policy to client which just came, older messages are
+    left out.
+    """
+    if client.history is not None:
+        frames = client.history.frames(client.framing, room, max_bytes=client.outbound.room())
+        if frames:
+            client.send_many(frames)
+
+
+def resumable(message, client):
+    """
+    Return session client resumes with its hello message.
+
+    Session is parked when server notices connection was lost. If old connection of client still looks alive, it's
+    closed and its nick and rooms are taken over, old client then doesn't own nick and isn't parked.
+
+    Returns:
+    Session, None if hello message doesn't resume session.
+    """
+    token = message.get(b'token')
+    if token is None or client.sessions is None or RESUME not in message.get(b'features', b'').split():
+        return None
+    nick = message[b'nick']
+    old = client.nicks_clients.get(nick)
+    if old is not None:
+        if old.token != token:
+            return None
+        old.disconnect()
+        return Session(token, nick, set(old.rooms))
+    return client.sessions.resume(token, nick)
+
+
+@RECV_HANDLERS.register(b'hello', sections=(b'nick',))
 def recv_hello(message, client, **kwargs):
     """
     Handler called when client checks if nickname is available.
 
-    If nickname is not available connection is closed otherwise nickname is remembered.
+    If nickname is not available connection is closed otherwise client is welcomed. With presence layer nickname has to
+    be claimed there too, so handler returns coroutine which waits for the claim. Nickname of parked session is taken
+    for other clients of this server until session expires, client with its token resumes it. Parked nickname isn't
+    claimed in presence layer, so it's claimed again on resume and resume fails if user of other server took it.
     """
     nick = message[b'nick']
-    if nick in client.nicks_clients:
+    presence = client.presence
+    session = resumable(message, client)
+    if session is not None and session.handle is not None and presence is not None:
+        return _claim_nick(message, client, session)
+    elif session is not None:
+        welcome(message, client, session)
+    elif (nick in client.nicks_clients or presence is not None and nick in presence.nicks
+          or client.sessions is not None and nick in client.sessions.nicks):
         answer = create_message(type=b'hello', nick=nick)
-        client.writer.write(answer)
+        client.send(answer)
         client.con_handling.cancel()
+    elif presence is not None:
+        return _claim_nick(message, client)
+    else:
+        welcome(message, client)
+
+
+async def _claim_nick(message, client, session=None):
+    """
+    Claim nickname in presence layer and welcome client, resuming its session if any, if it succeeded.
+
+    Session whose nickname couldn't be claimed is parked again, so its rooms are kept and client can retry with its
+    token until the session expires.
+    """
+    nick = message[b'nick']
+    try:
+        claimed = await client.presence.claim(nick)
+    except asyncio.CancelledError:
+        client.presence.release(nick)
+        if session is not None:
+            client.sessions.restore(session)
+        raise
+    if claimed:
+        welcome(message, client, session)
     else:
-        client.nicks_clients[nick] = client
-        client.nick = nick
+        if session is not None:
+            client.sessions.restore(session)
+        answer = create_message(type=b'hello', nick=nick)
+        client.send(answer)
+        client.con_handling.cancel()
 
 
+@RECV_HANDLERS.register(b'text', sections=(b'text',))
 def recv_text(message, client, **kwargs):
     """
     Handler called when client sends text message.
 
-    Message is just propagated to all receivers of the client.
+    Message is just propagated to all receivers of the client. It is encoded once no matter how many receivers there
+    are. Message with room section goes only to other members of the room, sender has to be one of them. Without room
+    and explicit receivers it goes to every active user except the sender, nicks_clients is iterated directly since
+    it is already kept up to date by recv_hello and Server.remove_client. Text is forwarded with message.payload, so
+    it's copied only into encoded frames.
     """
+    room = message.get(b'room')
+    if room is not None:
+        if room not in client.rooms:
+            answer = client.create_message(type=b'text', text=b'You are not member of room ' + room + b'.\n')
+            client.send(answer)
+            return
+        answer = OutgoingMessage(type=message[b'type'], text=payload(message, b'text'), room=room)
+        if client.history is not None:
+            client.history.append(answer, room, client.nick)
+        broadcast(answer, client.rooms_clients[room], client)
+        if client.presence is not None:
+            client.presence.publish(answer)
+        if client.journal is not None:
+            client.journal.append(answer)
+        return
+
+    answer = OutgoingMessage(type=message[b'type'], text=payload(message, b'text'))
     if not client.receivers:
-        receivers = set(client.nicks_clients.values()) - {client}
+        if client.history is not None:
+            client.history.append(answer, sender=client.nick)
+        broadcast(answer, client.nicks_clients.values(), client)
+        if client.presence is not None:
+            client.presence.publish(answer)
+        if client.journal is not None:
+            client.journal.append(answer)
     else:
-        receivers = client.receivers
-    for receiver in receivers:
-        answer = create_message(type=message[b'type'], text=message[b'text'])
-        receiver.writer.write(answer)
+        broadcast(answer, client.receivers)
 
 
-def recv_active(client, **kwargs):
+@RECV_HANDLERS.register(b'active')
+def recv_active(client, message=None, **kwargs):
     """
     Handler called when client wants to know active users.
 
-    Function sends to the client newline separated list of active users (nicknames).
+    Function sends to the client newline separated sorted list of active users (nicknames), including users of other
+    servers sharing presence layer. If message has nick section, only nicks starting with it are listed. Listing is
+    cut from cached listing of roster, which is rebuilt only after users come or go.
+    """
+    prefix = message.get(b'nick', b'') if message is not None else b''
+    active = client.roster.listing(prefix, client.nick)
+    if not active:
+        active = b'There is no active user starting with ' + prefix + b'.\n'
+    answer = client.create_message(type=b'text', text=active)
+    client.send(answer, key=b'active')
+
+
+@RECV_HANDLERS.register(b'msg', sections=(b'nick', b'text'))
+def recv_msg(message, client, **kwargs):
+    """
+    Handler called when client sends private message.
+
+    Receiver is found by nick in nicks_clients and message is written only to it. If receiver is user of other server
+    message is handed to presence layer, which passes it only to that server. Sender is told if receiver doesn't exist.
+    """
+    nick = message[b'nick']
+    receiver = client.nicks_clients.get(nick)
+    if receiver is not None:
+        receiver.send(receiver.create_message(type=b'text', text=payload(message, b'text')))
+    elif client.presence is not None and nick in client.presence.nicks:
+        client.presence.send_to(nick, OutgoingMessage(type=b'msg', nick=nick, text=payload(message, b'text')))
+    else:
+        answer = client.create_message(type=b'text', text=b'There is no user ' + nick + b'.\n')
+        client.send(answer)
+
+
+@RECV_HANDLERS.register(b'join', sections=(b'room',))
+def recv_join(message, client, **kwargs):
+    """
+    Handler called when client joins room.
+
+    Client becomes member of room, gets confirmation and recent messages of room.
     """
-    nicks = set(client.nicks_clients.keys())
-    if client.nick in nicks:
-        nicks.add(client.nick + b' (you)')
-        nicks.remove(client.nick)
-    active = b'\n'.join(sorted(nicks)) + b'\n'
-    answer = create_message(type=b'text', text=active)
-    client.writer.write(answer)
+    room = message[b'room']
+    if not room:
+        answer = client.create_message(type=b'text', text=b'Room name is empty.\n')
+        client.send(answer)
+    else:
+        client.join(room)
+        answer = client.create_message(type=b'text', text=b'You joined room ' + room + b'.\n')
+        client.send(answer)
+        replay(client, room)
+
+
+@RECV_HANDLERS.register(b'part', sections=(b'room',))
+def recv_part(message, client, **kwargs):
+    """
+    Handler called when client leaves room.
+
+    Client stops being member of room and gets confirmation.
+    """
+    room = message[b'room']
+    if room not in client.rooms:
+        answer = client.create_message(type=b'text', text=b'You are not member of room ' + room + b'.\n')
+    else:
+        client.part(room)
+        answer = client.create_message(type=b'text', text=b'You left room ' + room + b'.\n')
+    client.send(answer)
+
+
+@RECV_HANDLERS.register(b'rooms')
+def recv_rooms(client, **kwargs):
+    """
+    Handler called when client wants to know rooms.
+
+    Function sends to the client newline separated list of rooms of this server with numbers of their members, rooms
+    the client is member of are marked.
+    """
+    lines = []
+    for room in sorted(client.rooms_clients):
+        line = room + b' (%d)' % len(client.rooms_clients[room])
+        if room in client.rooms:
+            line += b' (you)'
+        lines.append(line + b'\n')
+    answer = client.create_message(type=b'text', text=b''.join(lines))
+    client.send(answer, key=b'rooms')
+
+
+@RECV_HANDLERS.register(b'history')
+def recv_history(message, client, **kwargs):
+    """
+    Handler called when client wants last messages from log.
+
+    Count section says how many messages are read, from 1 to HISTORY_LIMIT, messages sent to rooms client isn't member
+    of are left out. Log is read in executor, so handler returns coroutine.
+    """
+    if client.journal is None:
+        client.send(client.create_message(type=b'text', text=b'Messages are not logged.\n'))
+        return
+    try:
+        count = int(message.get(b'count', b'').strip())
+    except ValueError:
+        client.send(client.create_message(type=b'text', text=b'Number of messages is not a number.\n'))
+        return
+    if count < 1:
+        client.send(client.create_message(type=b'text', text=b'Number of messages has to be positive.\n'))
+        return
+    return _send_history(client, min(count, HISTORY_LIMIT))
+
+
+async def _send_history(client, count):
+    """Read last messages from log and send them to client as one batch."""
+    frames = await client.journal.read(count)
+    answers = []
+    for logged in FrameParser().feed(b''.join(frames)):
+        room = logged.get(b'room')
+        if room is not None and room not in client.rooms:
+            continue
+        # Sequence numbers of logged messages can be from earlier run of server, they aren't sent again.
+        answers.append(client.create_message(**{header.decode(): content for header, content in logged.items()
+                                                if header != b'seq'}))
+    if answers:
+        client.send_many(answers)
+
+
+@RECV_HANDLERS.register(b'ping')
+def recv_ping(client, **kwargs):
+    """Handler called when client checks if connection works, it's answered with pong message."""
+    client.send(client.create_message(type=b'pong'), key=b'pong')
+
+
+@RECV_HANDLERS.register(b'pong')
+def recv_pong(client, **kwargs):
+    """Handler called when client answered ping, time of read was already remembered by Client.handle_connection."""
+    pass
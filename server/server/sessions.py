@@ -0,0 +1,139 @@
+"""
+Module defines sessions clients can resume after their connection was lost.
+
+Client which agreed on resume feature gets token in features message. When its connection is lost, its nick and rooms
+are kept for resume timeout and nobody else connected to the same server can take the nick. Client connecting again
+with the token and the nick in hello message gets them back, it also says which sequence number it got last and
+history replays only messages it missed. Sessions live in memory of one server process, so nick of parked session is
+released in presence layer shared with other workers or nodes. After restart or on other worker token is unknown and
+client is welcomed as new one, if nobody took its nick in the meantime.
+
+Classes:
+Session -- Nick and rooms of client whose connection was lost.
+Sessions -- Sessions kept until they are resumed or expire.
+"""
+import asyncio
+import secrets
+
+TIMEOUT = 60.0
+
+
+class Session:
+    """
+    Nick and rooms of client whose connection was lost.
+
+    Instance attributes:
+    token -- Token client resumes session with.
+    nick -- Nickname of client.
+    rooms -- Names of rooms client was member of.
+    handle -- Handle of scheduled expiry, None if session is resumed from live connection.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+    """
+    def __init__(self, token, nick, rooms, handle=None):
+        """Initialize instance."""
+        self.token = token
+        self.nick = nick
+        self.rooms = rooms
+        self.handle = handle
+
+
+class Sessions:
+    """
+    Sessions kept until they are resumed or expire.
+
+    Instance attributes:
+    timeout -- Seconds session is kept after connection was lost.
+    parked -- Map tokens to sessions.
+    nicks -- Map nicks of parked sessions to their tokens, they can't be taken by other clients.
+    resumed -- Number of resumed sessions.
+    expired -- Number of sessions which expired.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+    __len__ -- Number of parked sessions.
+
+    Methods:
+    new_token -- Return new random token.
+    park -- Keep session of client whose connection was lost.
+    resume -- Return parked session and forget it.
+    restore -- Park again session whose resume failed.
+    stop -- Cancel expiry of parked sessions.
+    """
+    def __init__(self, timeout=TIMEOUT):
+        """Initialize instance."""
+        self.timeout = timeout
+        self.parked = {}
+        self.nicks = {}
+        self.resumed = 0
+        self.expired = 0
+
+    def __len__(self):
+        """Number of parked sessions."""
+        return len(self.parked)
+
+    @staticmethod
+    def new_token():
+        """Return new random token."""
+        return secrets.token_hex(16).encode()
+
+    def park(self, token, nick, rooms):
+        """
+        Keep session of client whose connection was lost.
+
+        Args:
+        token -- Token of client.
+        nick -- Nickname of client.
+        rooms -- Names of rooms client was member of.
+        """
+        handle = asyncio.get_running_loop().call_later(self.timeout, self._expire, token)
+        self.parked[token] = Session(token, nick, set(rooms), handle)
+        self.nicks[nick] = token
+
+    def resume(self, token, nick):
+        """
+        Return parked session and forget it.
+
+        Args:
+        token -- Token sent by client.
+        nick -- Nickname sent by client, it has to be nick of session.
+
+        Returns:
+        Session, None if there is no such session.
+        """
+        session = self.parked.get(token)
+        if session is None or session.nick != nick:
+            return None
+        del self.parked[token]
+        del self.nicks[nick]
+        session.handle.cancel()
+        self.resumed += 1
+        return session
+
+    def restore(self, session):
+        """
+        Park again session whose resume failed, so client can retry with the same token.
+
+        Session expires when it would have expired if it wasn't resumed.
+
+        Args:
+        session -- Session returned by resume.
+        """
+        session.handle = asyncio.get_running_loop().call_at(session.handle.when(), self._expire, session.token)
+        self.parked[session.token] = session
+        self.nicks[session.nick] = session.token
+        self.resumed -= 1
+
+    def stop(self):
+        """Cancel expiry of parked sessions, they are forgotten."""
+        for session in self.parked.values():
+            session.handle.cancel()
+        self.parked.clear()
+        self.nicks.clear()
+
+    def _expire(self, token):
+        """Forget session which wasn't resumed in time."""
+        session = self.parked.pop(token)
+        del self.nicks[session.nick]
+        self.expired += 1
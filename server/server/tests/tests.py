@@ -1,12 +1,56 @@
 import asyncio
+import os
+import shutil
+import socket
+import tempfile
+import time
 import unittest
 import unittest.mock as um
+from protocol import message
 from .. import server
-from .. import message
+from .. import outbound
+from .. import workers
+from .. import federation
+from .. import history
+from .. import journal
+from .. import loadgen
+from .. import metrics
+from .. import profiler
+from .. import watchdog
+from .. import roster
+from .. import limits
+from .. import keepalive
+from .. import handoff
+from .. import sessions
+from .. import benchmark
 import warnings
 warnings.simplefilter('always', ResourceWarning)
 
 
+def queued(client):
+    """Return frames queued for client."""
+    return [frame for frame, _ in client.outbound.frames]
+
+
+async def connect(port, nick):
+    """Open connection to server on localhost and send hello message."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(message.create_message(type=b'hello', nick=nick))
+    return reader, writer
+
+
+async def read_messages(reader, count):
+    """Read count messages from reader."""
+    parser = message.FrameParser()
+    messages = []
+    while len(messages) < count:
+        data = await asyncio.wait_for(reader.read(message.CHUNK_SIZE), 1)
+        if not data:
+            break
+        messages.extend(parser.feed(data))
+    return messages
+
+
 class TestServer(unittest.TestCase):
     def test_handle_connection(self):
         """Test if correct handlers are called."""
@@ -21,16 +65,16 @@ class TestServer(unittest.TestCase):
         ]
         i = -1
 
-        async def mock_read():
+        async def mock_read(n=-1):
             nonlocal i
             await asyncio.sleep(0.05)
             i += 1
             return msg_lines[i % len(msg_lines)]
 
         mock_reader = um.Mock()
-        mock_reader.readline = mock_read
+        mock_reader.read = mock_read
         mock_handler1, mock_handler2, mock_handler3 = um.Mock(), um.Mock(), um.Mock()
-        handlers = {b'hello': mock_handler1, b'text': mock_handler2, b'active': mock_handler3}
+        handlers = message.Registry({b'hello': mock_handler1, b'text': mock_handler2, b'active': mock_handler3})
         client = server.Client(mock_reader, um.Mock(), handlers)
         client.__class__._recv_handlers = handlers
         loop = asyncio.get_event_loop()
@@ -44,66 +88,45 @@ class TestServer(unittest.TestCase):
 
         loop.close()
 
+    def test_malformed_message(self):
+        """Test if client is told why and connection is closed on message of unknown type or without section."""
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        for frame in (message.create_message(type=b'unknown'), message.create_message(text=b'No type.\n'),
+                      message.create_message(type=b'join')):
+            with self.subTest(frame=frame):
+                async def mock_read(n=-1):
+                    return frame
 
-class TestMessage(unittest.TestCase):
-    def test_cut_message(self):
-        all_msg_lines = (
-            [
-                b'#type\n',
-                b'text\\\n',
-                b'\n',
-                b'#content\n',
-                b'message\n',
-                b'#\n',
-            ],
-            [
-                b'#type\n',
-                b'#\n',
-            ],
-            [
-                b'#\n',
-            ]
-        )
-        real_results = (
-            {
-                b'type': b'text\n',
-                b'content': b'message',
-            },
-            {
-                b'type': b'',
-            },
-            {}
-        )
-
-        for msg_lines, real_result in zip(all_msg_lines, real_results):
-            with self.subTest(msg_lines=msg_lines, real_result=real_result):
-                self.assertDictEqual(message.cut_message(msg_lines), real_result)
-
-    def test_create_message(self):
-        args = (
-            dict(type=b'text', content=b'Text message.\n'),
-            dict(type=b''),
-            dict(),
-        )
-        real_msgs = (
-            b'#type\ntext\n#content\nText message.\\\n\n#\n',
-            b'#type\n\n#\n',
-            b'#\n',
-        )
-
-        for arg, real_msg in zip(args, real_msgs):
-            with self.subTest(arg=arg, real_msg=real_msg):
-                self.assertEqual(message.create_message(**arg), real_msg)
+                mock_reader = um.Mock()
+                mock_reader.read = mock_read
+                writer = um.Mock()
+                writer.drain = um.AsyncMock()
+                client = server.Client(mock_reader, writer, server.RECV_HANDLERS)
+                client.nick = b'nick'
+                loop.run_until_complete(client.handle_connection())
+                self.assertIsNone(client.outbound.task)
+                writer.write.assert_called_once_with(message.create_message(type=b'text',
+                                                                            text=b'Message is malformed.\n'))
+                writer.close.assert_called_once()
 
-    def test_get_handlers(self):
-        mock_module = um.Mock()
-        mock_module.f = lambda: None
-        mock_module.recv_hello = lambda: None
-        mock_module.recv_text = lambda: None
-        mock_module.recvhi = lambda: None
+    def test_handler_error(self):
+        """Test if exception raised by handler isn't reported as malformed message and connection is still closed."""
+        async def mock_read(n=-1):
+            return message.create_message(type=b'text', text=b'Hi.\n')
 
-        handlers = message.get_handlers(mock_module)
-        self.assertDictEqual(handlers, {b'hello': mock_module.recv_hello, b'text': mock_module.recv_text})
+        mock_reader = um.Mock()
+        mock_reader.read = mock_read
+        writer = um.Mock()
+        writer.drain = um.AsyncMock()
+        handlers = message.Registry({b'text': um.Mock(side_effect=KeyError(b'bug'))})
+        client = server.Client(mock_reader, writer, handlers)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with self.assertRaises(KeyError):
+            loop.run_until_complete(client.handle_connection())
+        writer.write.assert_not_called()
+        writer.close.assert_called_once()
 
 
 class TestHandlers(unittest.TestCase):
@@ -118,6 +141,7 @@ class TestHandlers(unittest.TestCase):
         }
         patcher.start()
         self.addCleanup(patcher.stop)
+        server.Client._roster = roster.Roster()
 
     def test_recv_hello(self):
         server.Client._nicks_clients = {b'user': um.Mock(), b'nick': um.Mock()}
@@ -130,7 +154,7 @@ class TestHandlers(unittest.TestCase):
         }
 
         server.recv_hello(msg, mock_client)
-        mock_client.writer.write.assert_called()
+        self.assertEqual(queued(mock_client), [b'#type\nhello\n#nick\nuser\n#\n'])
         mock_client.con_handling.cancel.assert_called()
 
         msg = {
@@ -141,6 +165,39 @@ class TestHandlers(unittest.TestCase):
         server.recv_hello(msg, mock_client)
         self.assertIn(b'new_user', mock_client.nicks_clients)
 
+    def test_recv_hello_features(self):
+        """Test if supported features are agreed on and binary framing is switched on."""
+        server.Client._nicks_clients = {}
+        mock_client = server.Client(um.Mock(), um.Mock(), um.Mock())
+        msg = {
+            b'type': b'hello',
+            b'nick': b'user',
+            b'features': b'binary unknown',
+        }
+
+        server.recv_hello(msg, mock_client)
+        self.assertEqual(queued(mock_client), [b'#type\nfeatures\n#features\nbinary\n#\n'])
+        self.assertEqual(mock_client.framing, message.BINARY_FRAMING)
+
+    def test_recv_hello_deflate(self):
+        """Test if deflate is agreed on only with binary framing and long texts are compressed once for receivers."""
+        server.Client._nicks_clients = {}
+        clients = [server.Client(um.Mock(), um.Mock(), um.Mock()) for _ in range(3)]
+        for cl, nick, features in zip(clients, (b'a', b'b', b'c'), (b'deflate', b'binary deflate', b'deflate binary')):
+            server.recv_hello({b'type': b'hello', b'nick': nick, b'features': features}, cl)
+        self.assertEqual(queued(clients[0]), [b'#type\nfeatures\n#features\n\n#\n'])
+        self.assertEqual([cl.framing for cl in clients], [message.TEXT_FRAMING, message.DEFLATE, message.DEFLATE])
+
+        text = b'2017-05-01 12:00:00 INFO worker-3 request handled in 12 ms\n' * 20
+        create = um.Mock(wraps=message.create_deflated_message)
+        with um.patch.dict(message.ENCODERS, {message.DEFLATE: create}):
+            server.recv_text({b'type': b'text', b'text': text}, clients[0])
+        create.assert_called_once()
+        frame = queued(clients[1])[-1]
+        self.assertIs(frame, queued(clients[2])[-1])
+        self.assertEqual(frame[0], message.DEFLATE_MAGIC)
+        self.assertEqual(message.FrameParser().feed(frame), [{b'type': b'text', b'text': text}])
+
     def test_recv_text(self):
         server.Client._nicks_clients = {b'user': server.Client(um.Mock(), um.Mock(), um.Mock()),
                                         b'nick': server.Client(um.Mock(), um.Mock(), um.Mock())}
@@ -151,17 +208,1076 @@ class TestHandlers(unittest.TestCase):
         }
 
         server.recv_text(msg, mock_client)
-        mock_client.nicks_clients[b'user'].writer.write.assert_called_with(b'#type\ntext\n#text\nText.\\\n\n#\n')
-        mock_client.nicks_clients[b'nick'].writer.write.assert_called_with(b'#type\ntext\n#text\nText.\\\n\n#\n')
+        self.assertEqual(queued(mock_client.nicks_clients[b'user']), [b'#type\ntext\n#text\nText.\\\n\n#\n'])
+        self.assertEqual(queued(mock_client.nicks_clients[b'nick']), [b'#type\ntext\n#text\nText.\\\n\n#\n'])
+
+    def test_recv_text_encodes_once(self):
+        """Test if every receiver gets the same frame object and sender gets nothing."""
+        server.Client._nicks_clients = {}
+        clients = [server.Client(um.Mock(), um.Mock(), um.Mock(), nick) for nick in (b'a', b'b', b'c')]
+        for cl in clients:
+            cl.nicks_clients[cl.nick] = cl
+        msg = {
+            b'type': b'text',
+            b'text': b'Text.\n'
+        }
+
+        create = um.Mock(wraps=message.create_message)
+        with um.patch.dict(message.ENCODERS, {message.TEXT_FRAMING: create}):
+            server.recv_text(msg, clients[0])
+        create.assert_called_once()
+        self.assertEqual(queued(clients[0]), [])
+        self.assertIs(queued(clients[1])[0], queued(clients[2])[0])
+
+    def test_recv_text_framings(self):
+        """Test if message is encoded once for each framing used by receivers."""
+        server.Client._nicks_clients = {}
+        clients = [server.Client(um.Mock(), um.Mock(), um.Mock(), nick) for nick in (b'a', b'b', b'c', b'd')]
+        for cl in clients:
+            cl.nicks_clients[cl.nick] = cl
+        clients[2].framing = clients[3].framing = message.BINARY_FRAMING
+        msg = {
+            b'type': b'text',
+            b'text': b'Text.\n'
+        }
+
+        server.recv_text(msg, clients[0])
+        self.assertEqual(queued(clients[1]), [b'#type\ntext\n#text\nText.\\\n\n#\n'])
+        self.assertEqual(queued(clients[2]), [b'\x00\x0e\x01\x04text\x03\x06Text.\n'])
+        self.assertIs(queued(clients[2])[0], queued(clients[3])[0])
+
+    def test_rooms(self):
+        """Test if room messages reach only members and rooms are removed when empty."""
+        server.Client._nicks_clients = {}
+        server.Client._rooms_clients = {}
+        clients = [server.Client(um.Mock(), um.Mock(), um.Mock(), nick) for nick in (b'a', b'b', b'c')]
+        for cl in clients:
+            cl.nicks_clients[cl.nick] = cl
+        for cl in clients[:2]:
+            server.recv_join({b'type': b'join', b'room': b'python'}, cl)
+            cl.outbound.frames.clear()
+
+        server.recv_text({b'type': b'text', b'text': b'Hi.', b'room': b'python'}, clients[0])
+        self.assertEqual(queued(clients[0]), [])
+        self.assertEqual(queued(clients[1]), [b'#type\ntext\n#text\nHi.\n#room\npython\n#\n'])
+        self.assertEqual(queued(clients[2]), [])
+
+        server.recv_text({b'type': b'text', b'text': b'Hi.', b'room': b'python'}, clients[2])
+        self.assertEqual(queued(clients[2]), [b'#type\ntext\n#text\nYou are not member of room python.\\\n\n#\n'])
+
+        server.recv_rooms(clients[0])
+        self.assertEqual(queued(clients[0])[-1], b'#type\ntext\n#text\npython (2) (you)\\\n\n#\n')
+
+        for cl in clients[:2]:
+            server.recv_part({b'type': b'part', b'room': b'python'}, cl)
+        self.assertEqual(server.Client._rooms_clients, {})
+        self.assertEqual(clients[0].rooms, set())
+
+    def test_recv_msg(self):
+        """Test if private message is written only to its receiver."""
+        server.Client._nicks_clients = {}
+        clients = [server.Client(um.Mock(), um.Mock(), um.Mock(), nick) for nick in (b'a', b'b', b'c')]
+        for cl in clients:
+            cl.nicks_clients[cl.nick] = cl
+
+        server.recv_msg({b'type': b'msg', b'nick': b'b', b'text': b'a (private): Hi.\n'}, clients[0])
+        self.assertEqual(queued(clients[0]), [])
+        self.assertEqual(queued(clients[1]), [b'#type\ntext\n#text\na (private): Hi.\\\n\n#\n'])
+        self.assertEqual(queued(clients[2]), [])
+
+        server.recv_msg({b'type': b'msg', b'nick': b'd', b'text': b'a (private): Hi.\n'}, clients[0])
+        self.assertEqual(queued(clients[0]), [b'#type\ntext\n#text\nThere is no user d.\\\n\n#\n'])
 
     def test_recv_active(self):
         mock_client = server.Client(um.Mock(), um.Mock(), um.Mock(), b'new_user')
-        server.Client._nicks_clients = {b'user': server.Client(um.Mock(), um.Mock(), um.Mock()),
-                                        b'nick': server.Client(um.Mock(), um.Mock(), um.Mock())}
+        server.Client._roster = roster.Roster([b'user', b'nick'])
 
         server.recv_active(mock_client)
-        mock_client.writer.write.assert_called_with(b'#type\ntext\n#text\nnick\\\nuser\\\n\n#\n')
+        self.assertEqual(queued(mock_client)[-1], b'#type\ntext\n#text\nnick\\\nuser\\\n\n#\n')
 
-        mock_client._nicks_clients[b'new_user'] = mock_client
+        mock_client.roster.add(b'new_user')
         server.recv_active(mock_client)
-        mock_client.writer.write.assert_called_with(b'#type\ntext\n#text\nnew_user (you)\\\nnick\\\nuser\\\n\n#\n')
+        self.assertEqual(queued(mock_client)[-1], b'#type\ntext\n#text\nnew_user (you)\\\nnick\\\nuser\\\n\n#\n')
+
+    def test_recv_active_prefix(self):
+        """Test if only nicks starting with nick section are listed."""
+        mock_client = server.Client(um.Mock(), um.Mock(), um.Mock(), b'nick2')
+        server.Client._roster = roster.Roster([b'nick1', b'nick2', b'nickname', b'user', b'nic'])
+
+        server.recv_active(mock_client, {b'type': b'active', b'nick': b'nick'})
+        self.assertEqual(queued(mock_client)[-1],
+                         b'#type\ntext\n#text\nnick1\\\nnick2 (you)\\\nnickname\\\n\n#\n')
+
+        server.recv_active(mock_client, {b'type': b'active', b'nick': b'x'})
+        self.assertEqual(queued(mock_client)[-1],
+                         b'#type\ntext\n#text\nThere is no active user starting with x.\\\n\n#\n')
+
+
+class TestRoster(unittest.TestCase):
+    def test_roster(self):
+        """Test if nicks stay sorted and cached listing follows changes."""
+        nicks = roster.Roster([b'b', b'a'])
+        nicks.add(b'c')
+        nicks.add(b'a')
+        self.assertEqual(list(nicks), [b'a', b'b', b'c'])
+        listing = nicks.listing()
+        self.assertEqual(listing, b'a\nb\nc\n')
+        self.assertIs(nicks.listing(), listing)
+        nicks.discard(b'b')
+        nicks.discard(b'x')
+        self.assertEqual(nicks.listing(you=b'c'), b'a\nc (you)\n')
+        self.assertIn(b'a', nicks)
+        self.assertNotIn(b'b', nicks)
+        self.assertEqual(len(nicks), 2)
+
+    def test_feed(self):
+        """Test if changes within interval are sent as one message and changes cancelling out aren't sent at all."""
+        async def run():
+            nicks = roster.Roster([b'old', b'gone'])
+            feed = roster.RosterFeed(nicks, 0.01)
+            subscriber = um.Mock(framing=message.TEXT_FRAMING)
+            feed.subscribe(subscriber)
+            for i in range(100):
+                nicks.add(b'user%d' % i)
+            nicks.discard(b'user0')
+            nicks.discard(b'gone')
+            nicks.add(b'gone')
+            nicks.discard(b'old')
+            await asyncio.sleep(0.05)
+            return [message.cut_frame(call.args[0]) for call in subscriber.send.call_args_list]
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        frames = loop.run_until_complete(run())
+        self.assertEqual(frames[0], {b'type': b'presence', b'joined': b'gone\nold\n'})
+        self.assertEqual(len(frames), 2)
+        self.assertEqual(frames[1][b'joined'].splitlines(), [b'user%d' % i for i in range(1, 100)])
+        self.assertEqual(frames[1][b'left'], b'old\n')
+
+    def test_presence(self):
+        """Test if client which agreed on presence feature gets active users and their changes."""
+        async def run():
+            serverobj = server.Server(loop, server.RECV_HANDLERS, '127.0.0.1', 0, roster_interval=0.01)
+            await serverobj.create_server()
+            port = serverobj.server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(message.create_message(type=b'hello', nick=b'user', features=b'presence'))
+            answers = await read_messages(reader, 2)
+            _, other_writer = await connect(port, b'other')
+            await asyncio.sleep(0.05)
+            other_writer.close()
+            answers += await read_messages(reader, 2)
+            writer.close()
+            serverobj.stop_server()
+            await serverobj.server.wait_closed()
+            await asyncio.sleep(0.1)
+            return answers
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual(loop.run_until_complete(run()), [
+            {b'type': b'features', b'features': b'presence'},
+            {b'type': b'presence', b'joined': b'user\n'},
+            {b'type': b'presence', b'joined': b'other\n'},
+            {b'type': b'presence', b'left': b'other\n'},
+        ])
+
+    def test_prefix_end(self):
+        self.assertEqual(roster.prefix_end(b'ab'), b'ac')
+        self.assertEqual(roster.prefix_end(b'a\xff'), b'b')
+        self.assertIsNone(roster.prefix_end(b'\xff'))
+        nicks = roster.Roster([b'\xff\xff', b'\xff', b'a'])
+        self.assertEqual(nicks.listing(b'\xff'), b'\xff\n\xff\xff\n')
+
+
+class TestLimits(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_token_bucket(self):
+        """Test if bucket allows burst and then makes caller wait for tokens it owes."""
+        bucket = limits.TokenBucket(100)
+        self.assertEqual(bucket.take(100), 0)
+        self.assertAlmostEqual(bucket.take(50), 0.5, delta=0.05)
+        self.assertGreater(bucket.take(), 0.5)
+
+    def test_admit(self):
+        """Test if connections above maximum or above accept rate are refused."""
+        bounds = limits.Limits(max_connections=2)
+        self.assertIsNone(bounds.admit(1))
+        self.assertEqual(bounds.admit(2), b'Server is full, try again later.\n')
+        bounds = limits.Limits(accept_rate=2)
+        self.assertEqual([bounds.admit(0) for _ in range(3)], [None, None, b'Server is busy, try again later.\n'])
+
+    def run_server(self, bounds, run):
+        """Run coroutine function run with port of server started with bounds."""
+        async def wrapper():
+            serverobj = server.Server(self.loop, server.RECV_HANDLERS, '127.0.0.1', 0, limits=bounds)
+            await serverobj.create_server()
+            try:
+                return await run(serverobj.server.sockets[0].getsockname()[1])
+            finally:
+                serverobj.stop_server()
+                await serverobj.server.wait_closed()
+                await asyncio.sleep(0.1)
+
+        return self.loop.run_until_complete(wrapper())
+
+    def test_max_connections(self):
+        """Test if client above maximal number of connections gets reason and connection is closed."""
+        async def run(port):
+            _, writer = await connect(port, b'user')
+            await asyncio.sleep(0.05)
+            reader, refused = await connect(port, b'other')
+            answers = await read_messages(reader, 2)
+            refused.close()
+            writer.close()
+            return answers
+
+        self.assertEqual(self.run_server(limits.Limits(max_connections=1), run),
+                         [{b'type': b'text', b'text': b'Server is full, try again later.\n'}])
+
+    def test_message_rate(self):
+        """Test if messages above rate are delayed, not dropped."""
+        async def run(port):
+            reader, writer = await connect(port, b'user')
+            start = time.monotonic()
+            writer.write(message.create_message(type=b'active') * 30)
+            answers = await read_messages(reader, 30)
+            writer.close()
+            return answers, time.monotonic() - start
+
+        answers, elapsed = self.run_server(limits.Limits(message_rate=20), run)
+        self.assertEqual(len(answers), 30)
+        self.assertGreaterEqual(elapsed, 0.4)
+
+    def test_max_frame_size(self):
+        """Test if client sending too long message is disconnected before whole message arrives."""
+        async def run(port):
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(message.create_message(type=b'hello', nick=b'user', features=b'binary'))
+            await read_messages(reader, 1)
+            writer.write(message.create_binary_message(type=b'text', text=b'x' * 10000)[:100])
+            answers = await read_messages(reader, 2)
+            writer.close()
+            return answers
+
+        self.assertEqual(self.run_server(limits.Limits(max_frame_size=1000), run),
+                         [{b'type': b'text', b'text': b'Message is longer than 1000 bytes.\n'}])
+
+    def test_framing_not_agreed(self):
+        """Test if binary and compressed messages are refused as corrupted until their framing is agreed on."""
+        frames = (message.create_binary_message(type=b'text', text=b'Hi.\n'),
+                  message.create_deflated_message(type=b'text', text=b'x' * 1000))
+        for hello, frame in ((message.create_message(type=b'hello', nick=b'user'), frames[0]),
+                             (message.create_message(type=b'hello', nick=b'user', features=b'binary'), frames[1])):
+            with self.subTest(hello=hello, frame=frame):
+                async def run(port):
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                    writer.write(frame)
+                    answers = await read_messages(reader, 1)
+                    writer.close()
+                    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                    writer.write(hello)
+                    await asyncio.sleep(0.05)
+                    writer.write(frame)
+                    answers += await read_messages(reader, 3)
+                    writer.close()
+                    return answers
+
+                answers = self.run_server(None, run)
+                self.assertEqual(answers[0], {b'type': b'text', b'text': b'Message is corrupted.\n'})
+                self.assertEqual(answers[-1], {b'type': b'text', b'text': b'Message is corrupted.\n'})
+
+
+class TestKeepalive(unittest.TestCase):
+    def test_timer_wheel(self):
+        """Test if items are called back in the tick of their deadline, including items of later rounds."""
+        called = []
+        wheel = keepalive.TimerWheel(called.append, tick=1.0, slots=4)
+        now = wheel.current
+        wheel.add('a', now + 1.5)
+        wheel.add('b', now + 5.5)
+        wheel.add('c', now + 2.5)
+        wheel.add('c', now + 3.5)
+        wheel.add('d', now - 10)
+        wheel.discard('d')
+        self.assertEqual(len(wheel), 3)
+        wheel.advance(now + 1.0)
+        self.assertEqual(called, ['a'])
+        wheel.advance(now + 4.0)
+        self.assertEqual(called, ['a', 'c'])
+        wheel.advance(now + 6.0)
+        self.assertEqual(called, ['a', 'c', 'b'])
+        self.assertEqual(len(wheel), 0)
+
+    def test_reap(self):
+        """
+        Test if client answering pings stays and silent client is removed like disconnected one.
+
+        Client without keepalive stays after hello, connection which never said hello is removed.
+        """
+        async def run():
+            reaper = keepalive.Keepalive(ping_interval=0.1, idle_timeout=0.3, tick=0.02)
+            serverobj = server.Server(loop, server.RECV_HANDLERS, '127.0.0.1', 0, keepalive=reaper)
+            await serverobj.create_server()
+            port = serverobj.server.sockets[0].getsockname()[1]
+            connections = []
+            for nick in (b'silent', b'alive'):
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(message.create_message(type=b'hello', nick=nick, features=b'keepalive'))
+                await read_messages(reader, 1)
+                connections.append((reader, writer))
+            quiet = await connect(port, b'quiet')
+            mute = await asyncio.open_connection('127.0.0.1', port)
+            silent = await read_messages(connections[0][0], 1)
+            for _ in range(4):
+                answer = await read_messages(connections[1][0], 1)
+                self.assertEqual(answer, [{b'type': b'ping'}])
+                connections[1][1].write(message.create_message(type=b'pong'))
+            # Silent client can get more pings before it's disconnected, read returns when connection is closed.
+            rest = await connections[0][0].read()
+            self.assertEqual(await mute[0].read(), b'')
+            nicks = list(serverobj.nicks_clients)
+            for _, writer in connections + [quiet, mute]:
+                writer.close()
+            serverobj.stop_server()
+            await serverobj.server.wait_closed()
+            await asyncio.sleep(0.1)
+            return silent, rest, nicks, reaper
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        silent, rest, nicks, reaper = loop.run_until_complete(run())
+        self.assertEqual(silent, [{b'type': b'ping'}])
+        self.assertTrue(all(answer == {b'type': b'ping'} for answer in message.FrameParser().feed(rest)))
+        self.assertEqual(nicks, [b'alive', b'quiet'])
+        self.assertEqual(reaper.reaped, 2)
+
+
+class TestShutdown(unittest.TestCase):
+    def test_drain(self):
+        """Test if client gets frames queued for it and notice before connection is closed and server stopped."""
+        async def run():
+            serverobj = server.Server(loop, server.RECV_HANDLERS, '127.0.0.1', 0)
+            await serverobj.create_server()
+            reader, writer = await connect(serverobj.server.sockets[0].getsockname()[1], b'user')
+            writer.write(message.create_message(type=b'active'))
+            await asyncio.sleep(0.05)
+            await serverobj.drain(1.0)
+            answers = message.FrameParser().feed(await asyncio.wait_for(reader.read(), 1))
+            writer.close()
+            await serverobj.server.wait_closed()
+            return answers, serverobj
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        answers, serverobj = loop.run_until_complete(run())
+        self.assertEqual([answer[b'type'] for answer in answers], [b'text', b'text'])
+        self.assertEqual(answers[-1][b'text'], b'Server is shutting down.\n')
+        self.assertTrue(serverobj.listening.done())
+        self.assertFalse(serverobj.clients)
+
+    def test_handoff(self):
+        """Test if new server accepts on listening socket of old one, including connections made during handoff."""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'handoff')
+
+        async def run():
+            old = server.Server(loop, server.RECV_HANDLERS, '127.0.0.1', 0)
+            await old.create_server()
+            port = old.server.sockets[0].getsockname()[1]
+            offering = asyncio.ensure_future(handoff.offer(old, path, 1.0))
+            old_reader, old_writer = await connect(port, b'user')
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            sock = await loop.run_in_executor(None, handoff.take_over, path)
+            await offering
+            notice = message.FrameParser().feed(await asyncio.wait_for(old_reader.read(), 1))
+            old_writer.close()
+            # Old server is closed, connection waits in backlog of inherited socket until new server accepts it.
+            new_reader, new_writer = await connect(port, b'user')
+            new = server.Server(loop, server.RECV_HANDLERS, '127.0.0.1', port, sock=sock)
+            await new.create_server()
+            new_writer.write(message.create_message(type=b'active'))
+            answers = await read_messages(new_reader, 1)
+            new_writer.close()
+            new.stop_server()
+            await new.server.wait_closed()
+            await asyncio.sleep(0.05)
+            return notice, answers, old
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        notice, answers, old = loop.run_until_complete(run())
+        self.assertEqual(notice, [{b'type': b'text', b'text': b'Server is restarting.\n'}])
+        self.assertTrue(old.listening.done())
+        self.assertEqual(answers[0][b'type'], b'text')
+        self.assertFalse(os.path.exists(path))
+
+
+class TestSessions(unittest.TestCase):
+    def test_missed(self):
+        """Test if only messages after sequence number to rooms of client and not sent by it are returned."""
+        recent = history.History()
+        recent.append(message.OutgoingMessage(type=b'text', text=b'a\n'))
+        recent.append(message.OutgoingMessage(type=b'text', text=b'b\n'), sender=b'other')
+        recent.append(message.OutgoingMessage(type=b'text', text=b'c\n', room=b'r'), b'r', b'other')
+        recent.append(message.OutgoingMessage(type=b'text', text=b'd\n', room=b's'), b's', b'other')
+        recent.append(message.OutgoingMessage(type=b'text', text=b'e\n'), sender=b'user')
+        self.assertEqual(recent.sequence, 5)
+        self.assertEqual(recent.missed(message.TEXT_FRAMING, 1, {b'r'}, b'user'),
+                         [message.create_message(type=b'text', text=b'b\n', seq=b'2'),
+                          message.create_message(type=b'text', text=b'c\n', room=b'r', seq=b'3')])
+
+    def test_resume(self):
+        """Test if client resumes nick and rooms with token and gets only messages it missed."""
+        async def run():
+            parked = sessions.Sessions(timeout=0.2)
+            serverobj = server.Server(loop, server.RECV_HANDLERS, '127.0.0.1', 0, history=history.History(),
+                                      sessions=parked)
+            await serverobj.create_server()
+            port = serverobj.server.sockets[0].getsockname()[1]
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(message.create_message(type=b'hello', nick=b'user', features=b'resume') +
+                         message.create_message(type=b'join', room=b'r'))
+            features, _ = await read_messages(reader, 2)
+            _, other = await connect(port, b'other')
+            other.write(message.create_message(type=b'join', room=b'r') +
+                        message.create_message(type=b'text', text=b'seen\n'))
+            seen = await read_messages(reader, 1)
+            writer.close()
+            await asyncio.sleep(0.05)
+            other.write(message.create_message(type=b'text', text=b'missed\n', room=b'r') +
+                        message.create_message(type=b'text', text=b'missed too\n'))
+            refused_reader, refused = await connect(port, b'user')
+            taken = await read_messages(refused_reader, 1)
+            refused.close()
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(message.create_message(type=b'hello', nick=b'user', features=b'resume',
+                                                 token=features[b'token'], seq=seen[0][b'seq']))
+            resumed = await read_messages(reader, 3)
+            rooms = set(serverobj.nicks_clients[b'user'].rooms)
+            writer.close()
+            await asyncio.sleep(0.3)
+            expired = parked.expired, list(serverobj.nicks_clients), len(parked)
+            other.close()
+            serverobj.stop_server()
+            await serverobj.server.wait_closed()
+            await asyncio.sleep(0.05)
+            return features, taken, resumed, rooms, expired
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        features, taken, resumed, rooms, expired = loop.run_until_complete(run())
+        self.assertEqual(features[b'features'], b'resume')
+        self.assertEqual(taken, [{b'type': b'hello', b'nick': b'user'}])
+        self.assertEqual(resumed, [{b'type': b'features', b'features': b'resume', b'token': features[b'token']},
+                                   {b'type': b'text', b'text': b'missed\n', b'room': b'r', b'seq': b'2'},
+                                   {b'type': b'text', b'text': b'missed too\n', b'seq': b'3'}])
+        self.assertEqual(rooms, {b'r'})
+        self.assertEqual(expired, (1, [b'other'], 0))
+
+    def test_resume_claim_failed(self):
+        """Test if session is parked again when its nick can't be claimed in presence layer and can be resumed later."""
+        async def run():
+            parked = sessions.Sessions(timeout=10)
+            presence = um.Mock(nicks=set())
+            presence.claim = um.AsyncMock(side_effect=[False, True])
+            client_class = type('SessionClient', (server.Client,),
+                                {'_nicks_clients': {}, '_rooms_clients': {}, '_roster': roster.Roster(),
+                                 '_presence': presence, '_sessions': parked})
+            parked.park(b'token', b'user', {b'r'})
+            deadline = parked.parked[b'token'].handle.when()
+            hello = {b'type': b'hello', b'nick': b'user', b'features': b'resume', b'token': b'token'}
+            refused = client_class(um.Mock(), um.Mock(), um.Mock())
+            refused.con_handling = um.Mock()
+            await server.recv_hello(hello, refused)
+            after_refusal = len(parked), parked.nicks.get(b'user'), parked.parked[b'token'].handle.when()
+            resumed = client_class(um.Mock(), um.Mock(), um.Mock())
+            await server.recv_hello(hello, resumed)
+            parked.stop()
+            return refused, after_refusal, deadline, resumed, parked
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        refused, after_refusal, deadline, resumed, parked = loop.run_until_complete(run())
+        self.assertEqual(queued(refused), [message.create_message(type=b'hello', nick=b'user')])
+        refused.con_handling.cancel.assert_called_once()
+        self.assertEqual(after_refusal, (1, b'token', deadline))
+        self.assertEqual(resumed.nick, b'user')
+        self.assertEqual(set(resumed.rooms), {b'r'})
+        self.assertEqual(resumed.token, b'token')
+        self.assertEqual(parked.resumed, 1)
+
+
+class TestOutboundQueue(unittest.TestCase):
+    def test_writer_task(self):
+        """Test if frames queued in one loop iteration are written in order with one call and drained."""
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        writer = um.Mock()
+        writer.drain = um.AsyncMock()
+        queue = outbound.OutboundQueue(writer)
+
+        async def run():
+            queue.start()
+            queue.put(b'first')
+            queue.put(b'second')
+            await asyncio.sleep(0.01)
+            queue.put(b'third')
+            await asyncio.sleep(0.01)
+            queue.close()
+
+        loop.run_until_complete(run())
+        self.assertEqual(writer.writelines.call_args_list, [um.call([b'first', b'second'])])
+        self.assertEqual(writer.write.call_args_list, [um.call(b'third')])
+        self.assertEqual(writer.drain.await_count, 2)
+        self.assertEqual(queue.writes, 2)
+        self.assertEqual(queue.size, 0)
+
+    def test_window(self):
+        """Test if writer task waits for frames queued during window and writes them together."""
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        writer = um.Mock()
+        writer.drain = um.AsyncMock()
+        queue = outbound.OutboundQueue(writer, window=0.05)
+
+        async def run():
+            queue.start()
+            queue.put(b'first')
+            await asyncio.sleep(0.01)
+            queue.put(b'second')
+            await asyncio.sleep(0.1)
+            queue.close()
+
+        loop.run_until_complete(run())
+        self.assertEqual(writer.writelines.call_args_list, [um.call([b'first', b'second'])])
+        writer.write.assert_not_called()
+
+    def test_put_many(self):
+        """Test if frames put together are written with one call and dropped together."""
+        writer = um.Mock()
+        queue = outbound.OutboundQueue(writer, high_water=10, low_water=4)
+        queue.put_many([b'aaa', b'bbb'])
+        queue.put(b'cccccc')
+        self.assertEqual(queue.dropped, 2)
+        queue.put_many([b'dd', b'ee'])
+        queue.flush()
+        writer.writelines.assert_called_once_with([b'cccccc', b'dd', b'ee'])
+
+    def test_drop_oldest(self):
+        """Test if oldest frames are dropped down to low watermark."""
+        queue = outbound.OutboundQueue(um.Mock(), high_water=10, low_water=4)
+        for frame in (b'aaaa', b'bbbb', b'cccc'):
+            queue.put(frame)
+        self.assertEqual([frame for frame, _ in queue.frames], [b'cccc'])
+        self.assertEqual(queue.stats(), {'frames': 1, 'bytes': 4, 'dropped': 2, 'dropped_bytes': 8, 'overflows': 1,
+                                         'writes': 0, 'written_frames': 0, 'written_bytes': 0})
+
+    def test_coalesce(self):
+        """Test if frames superseded by newer frames with the same key are dropped first."""
+        queue = outbound.OutboundQueue(um.Mock(), high_water=10, low_water=8, policy=outbound.COALESCE)
+        queue.put(b'old1', b'active')
+        queue.put(b'text')
+        queue.put(b'new1', b'active')
+        self.assertEqual([frame for frame, _ in queue.frames], [b'text', b'new1'])
+        self.assertEqual(queue.dropped, 1)
+
+    def test_disconnect(self):
+        """Test if client is disconnected and queue discarded."""
+        on_disconnect = um.Mock()
+        queue = outbound.OutboundQueue(um.Mock(), high_water=10, low_water=4, policy=outbound.DISCONNECT,
+                                       on_disconnect=on_disconnect)
+        queue.put(b'aaaaaa')
+        queue.put(b'bbbbbb')
+        queue.put(b'cccccc')
+        on_disconnect.assert_called_once_with()
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.dropped, 3)
+
+
+class TestHistory(unittest.TestCase):
+    def test_limits(self):
+        """Test if oldest messages are forgotten when there are too many of them or they are too large."""
+        recent = history.History(max_messages=3, max_bytes=95)
+        for i in range(5):
+            recent.append(message.OutgoingMessage(type=b'text', text=b'%d\n' % i))
+        self.assertEqual(len(recent), 3)
+        self.assertEqual(recent.frames(message.TEXT_FRAMING)[0],
+                         message.create_message(type=b'text', text=b'2\n', seq=b'3'))
+        recent.append(message.OutgoingMessage(type=b'text', text=b'x' * 90))
+        self.assertEqual(len(recent), 1)
+        self.assertLessEqual(recent.size, 95)
+
+    def test_rooms(self):
+        """Test if messages are replayed only to their room and count limits them."""
+        recent = history.History()
+        recent.append(message.OutgoingMessage(type=b'text', text=b'a\n'))
+        recent.append(message.OutgoingMessage(type=b'text', text=b'b\n', room=b'r'), b'r')
+        recent.append(message.OutgoingMessage(type=b'text', text=b'c\n', room=b'r'), b'r')
+        self.assertEqual(recent.frames(message.BINARY_FRAMING),
+                         [message.create_binary_message(type=b'text', text=b'a\n', seq=b'1')])
+        self.assertEqual(recent.frames(message.TEXT_FRAMING, b'r', count=1),
+                         [message.create_message(type=b'text', text=b'c\n', room=b'r', seq=b'3')])
+
+    def test_replay(self):
+        """Test if history is replayed after hello and join as one batch."""
+        client_class = type('HistoryClient', (server.Client,),
+                            {'_nicks_clients': {}, '_rooms_clients': {}, '_history': history.History()})
+        sender = client_class(um.Mock(), um.Mock(), um.Mock(), b'sender')
+        sender.nicks_clients[sender.nick] = sender
+        sender.join(b'r')
+        server.recv_text({b'type': b'text', b'text': b'one\n'}, sender)
+        server.recv_text({b'type': b'text', b'text': b'two\n'}, sender)
+        server.recv_text({b'type': b'text', b'text': b'three\n', b'room': b'r'}, sender)
+
+        client = client_class(um.Mock(), um.Mock(), um.Mock())
+        server.recv_hello({b'type': b'hello', b'nick': b'user'}, client)
+        self.assertEqual(queued(client), [[message.create_message(type=b'text', text=b'one\n', seq=b'1'),
+                                           message.create_message(type=b'text', text=b'two\n', seq=b'2')]])
+        server.recv_join({b'type': b'join', b'room': b'r'}, client)
+        self.assertEqual(queued(client)[-1],
+                         [message.create_message(type=b'text', text=b'three\n', room=b'r', seq=b'3')])
+
+
+    def test_replay_fits_queue(self):
+        """Test if full history replayed in text framing keeps queue of new client below its low watermark."""
+        recent = history.History()
+        for i in range(history.MAX_MESSAGES):
+            recent.append(message.OutgoingMessage(type=b'text', text=b'#\n' * (history.MAX_BYTES // 3 // 100)))
+        client_class = type('HistoryClient', (server.Client,),
+                            {'_nicks_clients': {}, '_rooms_clients': {}, '_history': recent})
+        client = client_class(um.Mock(), um.Mock(), um.Mock(), outbound_options={'policy': outbound.DISCONNECT})
+        server.recv_hello({b'type': b'hello', b'nick': b'user', b'features': b'presence'}, client)
+        self.assertEqual(client.outbound.overflows, 0)
+        self.assertEqual(queued(client)[0], message.create_message(type=b'features', features=b'presence'))
+        self.assertLessEqual(client.outbound.size, client.outbound.low_water)
+        self.assertEqual(queued(client)[1][-1], recent.entries[-1][3].encode(message.TEXT_FRAMING))
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_segments(self):
+        """Test if messages are read from several segments and from memory in order they were appended."""
+        texts = [b'%d\n' % i for i in range(10)]
+
+        async def run():
+            log = journal.Journal(self.directory, segment_size=40)
+            for text in texts[:8]:
+                log.append(message.OutgoingMessage(type=b'text', text=text))
+                await log.flush()
+            for text in texts[8:]:
+                log.append(message.OutgoingMessage(type=b'text', text=text))
+            self.assertGreater(len(log.segments), 2)
+            frames = await log.read(7)
+            log.close()
+            return frames
+
+        frames = self.loop.run_until_complete(run())
+        self.assertEqual(frames, [message.create_binary_message(type=b'text', text=text) for text in texts[3:]])
+
+    def test_recovery(self):
+        """Test if log is reopened with its messages and data behind last indexed message is cut off."""
+        log = journal.Journal(self.directory)
+        log.append(message.OutgoingMessage(type=b'text', text=b'kept\n'))
+        log.close()
+        with open(os.path.join(self.directory, '%020d.log' % 0), 'ab') as log_file:
+            log_file.write(b'\x00\x10torn')
+        log = journal.Journal(self.directory)
+        self.assertEqual(len(log), 1)
+        frames = self.loop.run_until_complete(log.read(5))
+        log.close()
+        self.assertEqual(frames, [message.create_binary_message(type=b'text', text=b'kept\n')])
+
+    def test_close_during_flush(self):
+        """Test if batch of flush which didn't get to executor yet is written by close."""
+        calls = []
+
+        def run_in_executor(executor, func, *args):
+            calls.append((func, args))
+            return self.loop.create_future()
+
+        async def run():
+            log = journal.Journal(self.directory)
+            log.append(message.OutgoingMessage(type=b'text', text=b'flushed\n'))
+            with um.patch.object(self.loop, 'run_in_executor', run_in_executor):
+                flushing = asyncio.ensure_future(log.flush())
+                await asyncio.sleep(0)
+            log.append(message.OutgoingMessage(type=b'text', text=b'pending\n'))
+            log.close()
+            func, args = calls[0]
+            func(*args)
+            flushing.cancel()
+
+        self.loop.run_until_complete(run())
+        log = journal.Journal(self.directory)
+        frames = self.loop.run_until_complete(log.read(5))
+        log.close()
+        self.assertEqual(frames, [message.create_binary_message(type=b'text', text=b'flushed\n'),
+                                  message.create_binary_message(type=b'text', text=b'pending\n')])
+
+    def test_deliver(self):
+        """Test if messages delivered from other workers are logged."""
+        log = journal.Journal(self.directory)
+        serverobj = server.Server(self.loop, server.RECV_HANDLERS, '127.0.0.1', 0, journal=log)
+        serverobj.deliver({b'type': b'text', b'text': b'remote\n'})
+        frames = self.loop.run_until_complete(log.read(5))
+        log.close()
+        self.assertEqual(frames, [message.create_binary_message(type=b'text', text=b'remote\n')])
+
+    def test_recv_history(self):
+        """Test if last messages are sent in framing of client, without messages of other rooms."""
+        log = journal.Journal(self.directory)
+        client_class = type('JournalClient', (server.Client,),
+                            {'_nicks_clients': {}, '_rooms_clients': {}, '_journal': log})
+        sender = client_class(um.Mock(), um.Mock(), um.Mock(), b'sender')
+        sender.nicks_clients[sender.nick] = sender
+        sender.join(b'secret')
+        server.recv_text({b'type': b'text', b'text': b'one\n'}, sender)
+        server.recv_text({b'type': b'text', b'text': b'two\n', b'room': b'secret'}, sender)
+        server.recv_text({b'type': b'text', b'text': b'three\n'}, sender)
+
+        client = client_class(um.Mock(), um.Mock(), um.Mock(), b'user')
+        self.loop.run_until_complete(server.recv_history({b'type': b'history', b'count': b'2'}, client))
+        log.close()
+        self.assertEqual(queued(client), [[message.create_message(type=b'text', text=b'three\n')]])
+
+    def test_recv_history_count(self):
+        """Test if client is told when number of messages isn't a number or isn't positive."""
+        log = journal.Journal(self.directory)
+        self.addCleanup(log.close)
+        client_class = type('JournalClient', (server.Client,),
+                            {'_nicks_clients': {}, '_rooms_clients': {}, '_journal': log})
+        client = client_class(um.Mock(), um.Mock(), um.Mock(), b'user')
+        for count, text in ((b'many', b'Number of messages is not a number.\n'),
+                            (b'0', b'Number of messages has to be positive.\n'),
+                            (b'-5', b'Number of messages has to be positive.\n')):
+            with self.subTest(count=count):
+                client.outbound.frames.clear()
+                self.assertIsNone(server.recv_history({b'type': b'history', b'count': count}, client))
+                self.assertEqual(queued(client), [message.create_message(type=b'text', text=text)])
+
+
+class TestLoadgen(unittest.TestCase):
+    def test_percentile(self):
+        samples = list(range(1000))
+        self.assertEqual(loadgen.percentile(samples, 0.5), 500)
+        self.assertEqual(loadgen.percentile(samples, 0.999), 999)
+        self.assertIsNone(loadgen.percentile([], 0.5))
+
+    def test_run_load(self):
+        """Test if every text sent to room is delivered to other members of room and timed."""
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def run():
+            serverobj = server.Server(loop, server.RECV_HANDLERS, '127.0.0.1', 0)
+            await serverobj.create_server()
+            port = serverobj.server.sockets[0].getsockname()[1]
+            results = await loadgen.run_load('127.0.0.1', port, users=20, room_size=5, rate=20, duration=0.2,
+                                             drain=0.2)
+            serverobj.stop_server()
+            await serverobj.server.wait_closed()
+            await asyncio.sleep(0.1)
+            return results
+
+        results = loop.run_until_complete(run())
+        self.assertGreater(results['sent'], 0)
+        self.assertEqual(results['delivered'], results['sent'] * 4)
+        self.assertEqual(results['lost'], 0)
+        self.assertLessEqual(results['latency_ms']['p50'], results['latency_ms']['max'])
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_build_dictionary(self):
+        """Test if preset dictionary of protocol is the one trained on chat corpus."""
+        self.assertTrue(benchmark.corpus_paths())
+        self.assertEqual(benchmark.build_dictionary(), message.ZDICT)
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram(self):
+        """Test if values are counted in buckets precise to one eighth."""
+        histogram = metrics.Histogram()
+        for value in range(1, 1001):
+            histogram.record(value * 1000)
+        self.assertEqual(histogram.count, 1000)
+        self.assertLessEqual(abs(histogram.percentile(0.5) - 500000), 500000 / 8)
+        self.assertLessEqual(abs(histogram.percentile(0.99) - 990000), 990000 / 8)
+        self.assertEqual(histogram.cumulative([2 ** 10, 2 ** 20, 2 ** 30]), [1, 1000, 1000])
+        histogram.record(2 ** 50)
+        self.assertEqual(histogram.counts[-1], 1)
+
+    def test_endpoint(self):
+        """Test if handled messages, bytes and connections are served in Prometheus text format."""
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+
+        async def run():
+            counters = metrics.Metrics(port=0)
+            serverobj = server.Server(loop, server.RECV_HANDLERS, '127.0.0.1', 0, metrics=counters)
+            await serverobj.create_server()
+            reader, writer = await connect(serverobj.server.sockets[0].getsockname()[1], b'user')
+            writer.write(message.create_message(type=b'active'))
+            await read_messages(reader, 1)
+            metrics_reader, metrics_writer = await asyncio.open_connection(
+                '127.0.0.1', counters.endpoint.sockets[0].getsockname()[1])
+            metrics_writer.write(b'GET /metrics HTTP/1.0\r\n\r\n')
+            response = await metrics_reader.read()
+            metrics_writer.close()
+            writer.close()
+            serverobj.stop_server()
+            await serverobj.server.wait_closed()
+            await asyncio.sleep(0.1)
+            return response
+
+        response = loop.run_until_complete(run())
+        head, _, body = response.partition(b'\r\n\r\n')
+        self.assertTrue(head.startswith(b'HTTP/1.0 200 OK'))
+        lines = body.decode().splitlines()
+        self.assertIn('chat_connections_total 1', lines)
+        self.assertIn('chat_frames_received_total{type="hello"} 1', lines)
+        self.assertIn('chat_frames_sent_total 1', lines)
+        self.assertIn('chat_handler_seconds_count{type="active"} 1', lines)
+        self.assertIn('chat_handler_seconds_bucket{type="active",le="+Inf"} 1', lines)
+        self.assertIn('chat_loop_lag_seconds_count 0', lines)
+
+
+class TestWatchdog(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_lag(self):
+        """Test if blocked event loop is measured as lag and logged."""
+        async def run():
+            monitor.start()
+            await asyncio.sleep(0.03)
+            time.sleep(0.1)
+            await asyncio.sleep(0.03)
+            monitor.stop()
+
+        counters = metrics.Metrics()
+        monitor = watchdog.Watchdog(interval=0.01, threshold=0.05, metrics=counters)
+        with self.assertLogs(watchdog.logger, 'WARNING'):
+            self.loop.run_until_complete(run())
+        self.assertGreaterEqual(monitor.max_lag, 0.08)
+        self.assertEqual(monitor.stalls, 1)
+        self.assertGreater(counters.loop_lag_ns.count, 2)
+        self.assertGreaterEqual(counters.loop_lag_ns.percentile(1.0), 80000000)
+
+    def test_slow_handler(self):
+        """Test if handler blocking event loop is reported with type and size of message, waiting one isn't."""
+        async def run():
+            serverobj = server.Server(self.loop, handlers, '127.0.0.1', 0, watchdog=monitor)
+            await serverobj.create_server()
+            reader, writer = await connect(serverobj.server.sockets[0].getsockname()[1], b'user')
+            writer.write(message.create_message(type=b'active') + message.create_message(type=b'wait') +
+                         message.create_message(type=b'slow', text=b'x'))
+            await read_messages(reader, 1)
+            await asyncio.sleep(0.2)
+            writer.close()
+            serverobj.stop_server()
+            await serverobj.server.wait_closed()
+            await asyncio.sleep(0.1)
+
+        handlers = message.Registry(server.RECV_HANDLERS)
+        handlers[b'slow'] = lambda message, client, **kwargs: time.sleep(0.06)
+        handlers[b'wait'] = lambda message, client, **kwargs: asyncio.sleep(0.06)
+        monitor = watchdog.Watchdog(threshold=0.05)
+        with self.assertLogs(watchdog.logger, 'WARNING') as logs:
+            self.loop.run_until_complete(run())
+        self.assertEqual(monitor.slow_handlers, 1)
+        self.assertIn("Handler of b'slow' message", logs.output[0])
+        self.assertIn("from b'user'", logs.output[0])
+
+
+class TestProfiler(unittest.TestCase):
+    def test_collapsed(self):
+        """Test if profiler samples calling thread and writes its stacks in collapsed format."""
+        def busy_function():
+            deadline = time.monotonic() + 0.1
+            while time.monotonic() < deadline:
+                pass
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        profilerobj = profiler.Profiler(directory)
+        self.assertIsNone(profilerobj.toggle())
+        self.assertTrue(profilerobj.running)
+        busy_function()
+        path = profilerobj.toggle()
+        self.assertFalse(profilerobj.running)
+        self.assertEqual(os.path.dirname(path), directory)
+        self.assertGreater(profilerobj.samples, 10)
+
+        with open(path) as profile:
+            lines = profile.read().splitlines()
+        self.assertEqual(sum(int(line.rpartition(' ')[2]) for line in lines), profilerobj.samples)
+        frames = lines[0].rpartition(' ')[0].split(';')
+        self.assertTrue(frames[-1].startswith('busy_function ('))
+        self.assertTrue(frames[-2].startswith('test_collapsed ('))
+        self.assertIsNone(profilerobj.stop())
+
+
+class TestWorkers(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'bus')
+
+    def test_shared_presence(self):
+        """Test if nicks, text messages and active users are shared by workers."""
+        async def run():
+            bus = workers.Bus()
+            bus_server = await asyncio.start_unix_server(bus.handle_link, self.path)
+            servers = []
+            for _ in range(2):
+                serverobj = server.Server(self.loop, server.RECV_HANDLERS, '127.0.0.1', 0,
+                                          presence=workers.BusLink(self.path))
+                await serverobj.create_server()
+                servers.append(serverobj)
+            port1, port2 = (serverobj.server.sockets[0].getsockname()[1] for serverobj in servers)
+
+            reader1, writer1 = await connect(port1, b'user1')
+            reader2, writer2 = await connect(port2, b'user2')
+            await asyncio.sleep(0.1)
+            reader3, writer3 = await connect(port2, b'user1')
+            self.assertEqual(await read_messages(reader3, 1), [{b'type': b'hello', b'nick': b'user1'}])
+
+            writer1.write(message.create_message(type=b'text', text=b'user1: Hi.\n'))
+            self.assertEqual(await read_messages(reader2, 1), [{b'type': b'text', b'text': b'user1: Hi.\n'}])
+            writer2.write(message.create_message(type=b'msg', nick=b'user1', text=b'user2 (private): Hi.\n'))
+            self.assertEqual(await read_messages(reader1, 1),
+                             [{b'type': b'text', b'text': b'user2 (private): Hi.\n'}])
+            writer2.write(message.create_message(type=b'active'))
+            self.assertEqual(await read_messages(reader2, 1),
+                             [{b'type': b'text', b'text': b'user1\nuser2 (you)\n'}])
+
+            writer1.close()
+            await asyncio.sleep(0.1)
+            self.assertEqual(servers[1].presence.nicks, set())
+
+            for writer in (writer2, writer3):
+                writer.close()
+            for serverobj in servers:
+                serverobj.stop_server()
+                await serverobj.server.wait_closed()
+            bus_server.close()
+            await asyncio.sleep(0.1)
+
+        self.loop.run_until_complete(run())
+
+    def test_resume_on_other_worker(self):
+        """Test if client resumes on worker which parked its session and is welcomed as new one on other worker."""
+        async def run():
+            bus = workers.Bus()
+            bus_server = await asyncio.start_unix_server(bus.handle_link, self.path)
+            servers = []
+            for _ in range(2):
+                serverobj = server.Server(self.loop, server.RECV_HANDLERS, '127.0.0.1', 0,
+                                          presence=workers.BusLink(self.path), sessions=sessions.Sessions())
+                await serverobj.create_server()
+                servers.append(serverobj)
+            port1, port2 = (serverobj.server.sockets[0].getsockname()[1] for serverobj in servers)
+
+            async def hello(port, token=None):
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                sections = {'type': b'hello', 'nick': b'user', 'features': b'resume'}
+                if token is not None:
+                    sections.update(token=token, seq=b'0')
+                writer.write(message.create_message(**sections))
+                answer, = await read_messages(reader, 1)
+                return writer, answer
+
+            writer, features = await hello(port1)
+            writer.close()
+            await asyncio.sleep(0.1)
+            parked_nicks = set(servers[1].presence.nicks)
+            writer, resumed = await hello(port1, features[b'token'])
+            writer.close()
+            await asyncio.sleep(0.1)
+            writer, welcomed = await hello(port2, features[b'token'])
+            await asyncio.sleep(0.1)
+            claimed_nicks = set(servers[0].presence.nicks)
+
+            writer.close()
+            for serverobj in servers:
+                serverobj.stop_server()
+                await serverobj.server.wait_closed()
+            bus_server.close()
+            await asyncio.sleep(0.1)
+            return features, parked_nicks, resumed, welcomed, claimed_nicks
+
+        features, parked_nicks, resumed, welcomed, claimed_nicks = self.loop.run_until_complete(run())
+        self.assertEqual(parked_nicks, set())
+        self.assertEqual(resumed, features)
+        self.assertEqual(welcomed[b'type'], b'features')
+        self.assertNotEqual(welcomed[b'token'], features[b'token'])
+        self.assertEqual(claimed_nicks, {b'user'})
+
+
+class TestFederation(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    @staticmethod
+    def free_port():
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    def test_mesh(self):
+        """Test if nicks are unique in mesh and each message crosses each link once."""
+        async def run():
+            nodes = [b'127.0.0.1:%d' % self.free_port() for _ in range(3)]
+            servers = []
+            for node in nodes:
+                serverobj = server.Server(self.loop, server.RECV_HANDLERS, '127.0.0.1', 0,
+                                          presence=federation.Federation(node, nodes, retry=0.01))
+                await serverobj.create_server()
+                servers.append(serverobj)
+            for _ in range(100):
+                if all(len(serverobj.presence.links) == 2 for serverobj in servers):
+                    break
+                await asyncio.sleep(0.01)
+            ports = [serverobj.server.sockets[0].getsockname()[1] for serverobj in servers]
+
+            connections = [await connect(port, b'user%d%d' % (i, j)) for i, port in enumerate(ports) for j in range(2)]
+            await asyncio.sleep(0.1)
+            reader, writer = await connect(ports[2], b'user00')
+            self.assertEqual(await read_messages(reader, 1), [{b'type': b'hello', b'nick': b'user00'}])
+            writer.close()
+
+            links = list(servers[0].presence.links.values())
+            for link in links:
+                link.write = um.Mock(wraps=link.write)
+            connections[0][1].write(message.create_message(type=b'text', text=b'Hi.\n'))
+            for reader, _ in connections[1:]:
+                self.assertEqual(await read_messages(reader, 1), [{b'type': b'text', b'text': b'Hi.\n'}])
+            self.assertEqual([link.write.call_count for link in links], [1, 1])
+
+            connections[5][1].write(message.create_message(type=b'active'))
+            self.assertEqual(await read_messages(connections[5][0], 1),
+                             [{b'type': b'text', b'text': b'user00\nuser01\nuser10\nuser11\nuser20\nuser21 (you)\n'}])
+
+            for _, writer in connections:
+                writer.close()
+            for serverobj in servers:
+                serverobj.stop_server()
+                await serverobj.server.wait_closed()
+            await asyncio.sleep(0.1)
+
+        self.loop.run_until_complete(run())
@@ -0,0 +1,93 @@
+"""
+Module defines watchdog reporting event loop lag and handlers which block event loop.
+
+Every connection is handled on the same event loop, so one slow handler delays all of them. Watchdog measures lag
+continuously: it sleeps for fixed interval and checks how much later than asked it was woken up. Client times its
+handlers when watchdog is given and reports those taking longer than threshold. Both are logged as warnings and
+counted in metrics when they are turned on.
+
+Classes:
+Watchdog -- Monitor of event loop lag and slow handlers.
+"""
+import asyncio
+import logging
+
+INTERVAL = 0.1
+THRESHOLD = 0.05
+
+logger = logging.getLogger(__name__)
+
+
+class Watchdog:
+    """
+    Monitor of event loop lag and slow handlers.
+
+    Instance attributes:
+    interval -- Seconds between lag measurements.
+    threshold -- Seconds of lag or handler time above which warning is logged.
+    threshold_ns -- Threshold in nanoseconds, handlers are timed in them.
+    metrics -- Metrics lag and slow handlers are counted in, None if metrics are turned off.
+    lag -- Last measured lag in seconds.
+    max_lag -- The largest measured lag in seconds.
+    stalls -- Number of lag measurements above threshold.
+    slow_handlers -- Number of handler invocations above threshold.
+    task -- Task measuring lag.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    start -- Start measuring lag.
+    stop -- Stop measuring lag.
+    slow_handler -- Report handler invocation which took longer than threshold.
+    """
+    def __init__(self, interval=INTERVAL, threshold=THRESHOLD, metrics=None):
+        """Initialize instance."""
+        self.interval = interval
+        self.threshold = threshold
+        self.threshold_ns = int(threshold * 1e9)
+        self.metrics = metrics
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.slow_handlers = 0
+        self.task = None
+
+    def start(self):
+        """Start measuring lag."""
+        self.task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        """Stop measuring lag."""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def slow_handler(self, msg_type, size, duration, nick=None):
+        """
+        Report handler invocation which took longer than threshold.
+
+        Args:
+        msg_type -- Type of handled message.
+        size -- Size of handled message in bytes.
+        duration -- Nanoseconds handler call took, without waiting for coroutine it returned.
+        nick -- Nick of client which sent message.
+        """
+        self.slow_handlers += 1
+        if self.metrics is not None:
+            self.metrics.slow_handlers[msg_type] = self.metrics.slow_handlers.get(msg_type, 0) + 1
+        logger.warning('Handler of %r message (%d bytes) from %r took %.3f s.', msg_type, size, nick, duration / 1e9)
+
+    async def _run(self):
+        """Sleep for interval and measure how late event loop woke up."""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - start - self.interval)
+            self.max_lag = max(self.max_lag, self.lag)
+            if self.metrics is not None:
+                self.metrics.loop_lag_ns.record(int(self.lag * 1e9))
+            if self.lag > self.threshold:
+                self.stalls += 1
+                logger.warning('Event loop lagged %.3f s.', self.lag)
@@ -0,0 +1,211 @@
+"""
+Module defines presence layer shared by worker processes of one server.
+
+Workers listen on the same port with SO_REUSEPORT, so each of them has only part of users. They are connected over
+Unix socket to a bus run by master process. Bus owns registry of all nicks and relays messages between workers, every
+worker keeps a replica of nicks of users connected to other workers. Messages on the bus are in binary format from
+message module, bus understands the following types:
+claim -- Worker asks if nick can be taken, bus answers with claim message with result section ok or taken.
+release -- Worker informs that user with nick disconnected.
+join, leave -- Bus informs workers that nick was taken or released on other worker.
+msg -- Private message, it's forwarded only to worker of user with nick.
+Every other message is forwarded to all other workers.
+
+Classes:
+Bus -- Relay between worker processes, owner of registry of all nicks.
+BusLink -- Connection of worker to bus, presence layer of worker's server.
+"""
+import asyncio
+from protocol.message import FrameParser, create_binary_message, CHUNK_SIZE, BINARY_FRAMING
+
+
+class Bus:
+    """
+    Relay between worker processes, owner of registry of all nicks.
+
+    Instance attributes:
+    links -- Writers to all connected workers.
+    nicks -- Map nicks to writers of workers they are connected to.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    handle_link -- Coroutine handling connection with one worker.
+    """
+    def __init__(self):
+        """Initialize instance."""
+        self.links = set()
+        self.nicks = {}
+
+    async def handle_link(self, reader, writer):
+        """
+        Coroutine handling connection with one worker.
+
+        Worker first gets join message for every nick taken so far. When worker disconnects its nicks are released.
+        """
+        for nick in self.nicks:
+            writer.write(create_binary_message(type=b'join', nick=nick))
+        self.links.add(writer)
+        parser = FrameParser()
+        try:
+            while True:
+                data = await reader.read(CHUNK_SIZE)
+                if not data:
+                    break
+                for message in parser.feed(data):
+                    self._handle(message, writer)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.links.discard(writer)
+            for nick in [nick for nick, link in self.nicks.items() if link is writer]:
+                self._release(nick, writer)
+            writer.close()
+
+    def _handle(self, message, link):
+        """Handle message from worker."""
+        msg_type = message[b'type']
+        if msg_type == b'claim':
+            nick = message[b'nick']
+            if nick in self.nicks:
+                link.write(create_binary_message(type=b'claim', nick=nick, result=b'taken'))
+            else:
+                self.nicks[nick] = link
+                link.write(create_binary_message(type=b'claim', nick=nick, result=b'ok'))
+                self._forward(create_binary_message(type=b'join', nick=nick), link)
+        elif msg_type == b'release':
+            self._release(message[b'nick'], link)
+        elif msg_type == b'msg':
+            receiver = self.nicks.get(message[b'nick'])
+            if receiver is not None:
+                receiver.write(create_binary_message(type=b'msg', nick=message[b'nick'], text=message[b'text']))
+        else:
+            sections = {header.decode(): content for header, content in message.items()}
+            self._forward(create_binary_message(**sections), link)
+
+    def _release(self, nick, link):
+        """Release nick taken by worker and inform other workers."""
+        if self.nicks.get(nick) is link:
+            del self.nicks[nick]
+            self._forward(create_binary_message(type=b'leave', nick=nick), link)
+
+    def _forward(self, frame, origin):
+        """Write frame to every worker other than origin."""
+        for link in self.links:
+            if link is not origin:
+                link.write(frame)
+
+
+class BusLink:
+    """
+    Connection of worker to bus, presence layer of worker's server.
+
+    Instance attributes:
+    path -- Path of Unix socket of bus.
+    server -- Server using link.
+    nicks -- Nicks of users connected to other workers.
+    reader -- Reader from bus.
+    writer -- Writer to bus.
+    reading -- Task reading messages from bus.
+
+    Magic methods:
+    __init__ -- Initialize instance.
+
+    Methods:
+    start -- Connect to bus.
+    stop -- Disconnect from bus.
+    claim -- Ask bus if nick can be taken.
+    release -- Inform bus that nick was released.
+    publish -- Send message to other workers.
+    send_to -- Send message to worker of user with nick.
+    """
+    def __init__(self, path):
+        """Initialize instance."""
+        self.path = path
+        self.server = None
+        self.nicks = set()
+        self.reader = None
+        self.writer = None
+        self.reading = None
+        self._claims = {}
+
+    async def start(self, server):
+        """
+        Connect to bus.
+
+        Args:
+        server -- Server which gets messages from other workers with Server.deliver.
+        """
+        self.server = server
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+        self.reading = asyncio.ensure_future(self._read())
+
+    def stop(self):
+        """Disconnect from bus."""
+        if self.reading is not None:
+            self.reading.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+    async def claim(self, nick):
+        """
+        Ask bus if nick can be taken.
+
+        Returns:
+        True if nick was taken for this worker, False if it's used on any worker.
+        """
+        if nick in self._claims:
+            # The same nick claimed twice on one worker, only the first claim can succeed.
+            return False
+        future = self._claims[nick] = asyncio.get_running_loop().create_future()
+        self.writer.write(create_binary_message(type=b'claim', nick=nick))
+        try:
+            return await future
+        finally:
+            del self._claims[nick]
+
+    def release(self, nick):
+        """Inform bus that nick was released."""
+        self.writer.write(create_binary_message(type=b'release', nick=nick))
+
+    def publish(self, message):
+        """
+        Send message to other workers.
+
+        Args:
+        message -- OutgoingMessage.
+        """
+        self.writer.write(message.encode(BINARY_FRAMING))
+
+    def send_to(self, nick, message):
+        """
+        Send message to worker of user with nick.
+
+        Args:
+        nick -- Nick of user of other worker.
+        message -- OutgoingMessage with nick section, bus routes it by that section.
+        """
+        self.writer.write(message.encode(BINARY_FRAMING))
+
+    async def _read(self):
+        """Read messages from bus."""
+        parser = FrameParser()
+        while True:
+            data = await self.reader.read(CHUNK_SIZE)
+            if not data:
+                break
+            for message in parser.feed(data):
+                msg_type = message[b'type']
+                if msg_type == b'claim':
+                    future = self._claims.get(message[b'nick'])
+                    if future is not None and not future.done():
+                        future.set_result(message[b'result'] == b'ok')
+                elif msg_type == b'join':
+                    self.nicks.add(message[b'nick'])
+                    self.server.roster.add(message[b'nick'])
+                elif msg_type == b'leave':
+                    self.nicks.discard(message[b'nick'])
+                    self.server.roster.discard(message[b'nick'])
+                else:
+                    self.server.deliver(message)
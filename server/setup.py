@@ -7,6 +7,10 @@ setup(
     url='https://github.com/worstof3/chat',
     author='Łukasz Karpiński',
     packages=['server'],
+    install_requires=['chat-protocol'],
+    extras_require={
+        'uvloop': ['uvloop']
+    },
     test_suite='server.tests',
     entry_points={
         'console_scripts': [